@@ -23,9 +23,11 @@ from .bitcoinVarint import *
 from .btchipException import *
 from .btchipHelpers import *
 from .btchipKeyRecovery import *
+from .btchipSession import *
+from contextlib import contextmanager
 from binascii import hexlify, unhexlify
 
-class btchip:
+class btchipCodec(object):
 	BTCHIP_CLA = 0xe0
 	BTCHIP_JC_EXT_CLA = 0xf0
 
@@ -75,53 +77,51 @@ class btchip:
 	QWERTZ_KEYMAP = bytearray(unhexlify("000000000000000000000000760f00d4ffffffc7000000782c1e3420212224342627252e362d3738271e1f202122232425263333362e37381f0405060708090a0b0c0d0e0f101112131415161718191a1b1d1c2f3130232d350405060708090a0b0c0d0e0f101112131415161718191a1b1d1c2f313035"))
 	AZERTY_KEYMAP = bytearray(unhexlify("08000000010000200100007820c8ffc3feffff07000000002c38202030341e21222d352e102e3637271e1f202122232425263736362e37101f1405060708090a0b0c0d0e0f331112130415161718191d1b1c1a2f64302f2d351405060708090a0b0c0d0e0f331112130415161718191d1b1c1a2f643035"))
 
-	def __init__(self, dongle):
-		self.dongle = dongle
-		self.needKeyCache = False
-		try:
-			firmware = self.getFirmwareVersion()['version']
-			self.multiOutputSupported = tuple(map(int, (firmware.split(".")))) >= (1, 1, 4)
-			if self.multiOutputSupported:
-				self.scriptBlockLength = 50
-			else:
-				self.scriptBlockLength = 255
-		except:
-			pass				
-		try:			
-			result = self.getJCExtendedFeatures()
-			self.needKeyCache = (result['proprietaryApi'] == False)
-		except:
-			pass
+	# Largest command data the transport carries, above 255 bytes chunked commands use extended length APDUs
+	maxDataLength = 255
 
-	def setAlternateCoinVersion(self, versionRegular, versionP2SH):
-		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_SET_ALTERNATE_COIN_VERSION, 0x00, 0x00, 0x02, versionRegular, versionP2SH]
-		self.dongle.exchange(bytearray(apdu))
+	# getTrustedInput transaction sent as a byte stream cut anywhere, for firmware known to parse it
+	packedTrustedInput = False
 
-	def verifyPin(self, pin):
+	# APDU encoding and response parsing, shared by the synchronous and asyncio clients
+
+	def setMaxDataLength(self, maxDataLength):
+		self.maxDataLength = maxDataLength
+
+	def setPackedTrustedInput(self, packedTrustedInput):
+		self.packedTrustedInput = packedTrustedInput
+
+	def commandApdu(self, ins, p1, p2, params):
+		if len(params) > 255:
+			apdu = bytearray([ self.BTCHIP_CLA, ins, p1, p2, 0x00, (len(params) >> 8) & 0xff, len(params) & 0xff ])
+		else:
+			apdu = bytearray([ self.BTCHIP_CLA, ins, p1, p2, len(params) ])
+		apdu.extend(params)
+		return apdu
+
+	def setFirmwareVersion(self, firmware):
+		version = tuple(map(int, (firmware.split("."))))
+		self.multiOutputSupported = version >= (1, 1, 4)
+		if self.multiOutputSupported:
+			self.scriptBlockLength = 50
+		else:
+			self.scriptBlockLength = 255
+
+	def verifyPinApdu(self, pin):
 		if isinstance(pin, str):
-			pin = pin.encode('utf-8')		
+			pin = pin.encode('utf-8')
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_VERIFY_PIN, 0x00, 0x00, len(pin) ]
 		apdu.extend(bytearray(pin))
-		self.dongle.exchange(bytearray(apdu))
-
-	def getVerifyPinRemainingAttempts(self):
-		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_VERIFY_PIN, 0x80, 0x00, 0x01 ]
-		apdu.extend(bytearray(b'0'))
-		try:
-			self.dongle.exchange(bytearray(apdu))
-		except BTChipException as e:
-			if ((e.sw & 0xfff0) == 0x63c0):
-				return e.sw - 0x63c0
-			raise e
+		return bytearray(apdu)
 
-	def getWalletPublicKey(self, path, showOnScreen=False, segwit=False, segwitNative=False, cashAddr=False):
-		result = {}
+	def getWalletPublicKeyApdu(self, path, showOnScreen=False, segwit=False, segwitNative=False, cashAddr=False):
 		donglePath = parse_bip32_path(path)
-		if self.needKeyCache:
-			self.resolvePublicKeysInPath(path)			
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_GET_WALLET_PUBLIC_KEY, 0x01 if showOnScreen else 0x00, 0x03 if cashAddr else 0x02 if segwitNative else 0x01 if segwit else 0x00, len(donglePath) ]
 		apdu.extend(donglePath)
-		response = self.dongle.exchange(bytearray(apdu))
+		return bytearray(apdu)
+
+	def parseWalletPublicKey(self, response):
+		result = {}
 		offset = 0
 		result['publicKey'] = response[offset + 1 : offset + 1 + response[offset]]
 		offset = offset + 1 + response[offset]
@@ -130,8 +130,19 @@ class btchip:
 		result['chainCode'] = response[offset : offset + 32]
 		return result
 
-	def getTrustedInput(self, transaction, index):
-		result = {}
+	def getTrustedInputApdus(self, transaction, index):
+		if self.packedTrustedInput:
+			return self.getPackedTrustedInputApdus(transaction, index)
+		return self.getFieldTrustedInputApdus(transaction, index)
+
+	def getPackedTrustedInputApdus(self, transaction, index):
+		# Output index and transaction in APDUs filled up to maxDataLength
+		data = bytearray.fromhex("%.8x" % (index))
+		data.extend(transaction.serialize(skipWitness=True))
+		for offset in range(0, len(data), self.maxDataLength):
+			yield self.commandApdu(self.BTCHIP_INS_GET_TRUSTED_INPUT, 0x00 if offset == 0 else 0x80, 0x00, data[offset : offset + self.maxDataLength])
+
+	def getFieldTrustedInputApdus(self, transaction, index):
 		# Header
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_GET_TRUSTED_INPUT, 0x00, 0x00 ]
 		params = bytearray.fromhex("%.8x" % (index))
@@ -139,7 +150,7 @@ class btchip:
 		writeVarint(len(transaction.inputs), params)
 		apdu.append(len(params))
 		apdu.extend(params)
-		self.dongle.exchange(bytearray(apdu))
+		yield bytearray(apdu)
 		# Each input
 		for trinput in transaction.inputs:
 			apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_GET_TRUSTED_INPUT, 0x80, 0x00 ]
@@ -147,10 +158,10 @@ class btchip:
 			writeVarint(len(trinput.script), params)
 			apdu.append(len(params))
 			apdu.extend(params)
-			self.dongle.exchange(bytearray(apdu))
+			yield bytearray(apdu)
 			offset = 0
 			while True:
-				blockLength = 251
+				blockLength = self.maxDataLength - 4
 				if ((offset + blockLength) < len(trinput.script)):
 					dataLength = blockLength
 				else:
@@ -158,9 +169,7 @@ class btchip:
 				params = bytearray(trinput.script[offset : offset + dataLength])
 				if ((offset + dataLength) == len(trinput.script)):
 					params.extend(trinput.sequence)
-				apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_GET_TRUSTED_INPUT, 0x80, 0x00, len(params) ]
-				apdu.extend(params)
-				self.dongle.exchange(bytearray(apdu))
+				yield self.commandApdu(self.BTCHIP_INS_GET_TRUSTED_INPUT, 0x80, 0x00, params)
 				offset += dataLength
 				if (offset >= len(trinput.script)):
 					break
@@ -170,36 +179,36 @@ class btchip:
 		writeVarint(len(transaction.outputs), params)
 		apdu.append(len(params))
 		apdu.extend(params)
-		self.dongle.exchange(bytearray(apdu))
+		yield bytearray(apdu)
 		# Each output
-		indexOutput = 0
 		for troutput in transaction.outputs:
 			apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_GET_TRUSTED_INPUT, 0x80, 0x00 ]
 			params = bytearray(troutput.amount)
 			writeVarint(len(troutput.script), params)
 			apdu.append(len(params))
 			apdu.extend(params)
-			self.dongle.exchange(bytearray(apdu))
+			yield bytearray(apdu)
 			offset = 0
 			while (offset < len(troutput.script)):
-				blockLength = 255
+				blockLength = self.maxDataLength
 				if ((offset + blockLength) < len(troutput.script)):
 					dataLength = blockLength
 				else:
 					dataLength = len(troutput.script) - offset
-				apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_GET_TRUSTED_INPUT, 0x80, 0x00, dataLength ]
-				apdu.extend(troutput.script[offset : offset + dataLength])
-				self.dongle.exchange(bytearray(apdu))
+				yield self.commandApdu(self.BTCHIP_INS_GET_TRUSTED_INPUT, 0x80, 0x00, troutput.script[offset : offset + dataLength])
 				offset += dataLength
 		# Locktime
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_GET_TRUSTED_INPUT, 0x80, 0x00, len(transaction.lockTime) ]
 		apdu.extend(transaction.lockTime)
-		response = self.dongle.exchange(bytearray(apdu))
+		yield bytearray(apdu)
+
+	def parseTrustedInput(self, response):
+		result = {}
 		result['trustedInput'] = True
 		result['value'] = response
 		return result
 
-	def startUntrustedTransaction(self, newTransaction, inputIndex, outputList, redeemScript, version=0x01, cashAddr=False, continueSegwit=False):
+	def startUntrustedTransactionApdus(self, newTransaction, inputIndex, outputList, redeemScript, version=0x01, cashAddr=False, continueSegwit=False):
 		# Start building a fake transaction with the passed inputs
 		segwit = False
 		if newTransaction:
@@ -219,7 +228,7 @@ class btchip:
 		writeVarint(len(outputList), params)
 		apdu.append(len(params))
 		apdu.extend(params)
-		self.dongle.exchange(bytearray(apdu))
+		yield bytearray(apdu)
 		# Loop for each input
 		currentIndex = 0
 		for passedOutput in outputList:
@@ -246,7 +255,7 @@ class btchip:
 				params.extend(sequence)
 			apdu.append(len(params))
 			apdu.extend(params)
-			self.dongle.exchange(bytearray(apdu))
+			yield bytearray(apdu)
 			offset = 0
 			while(offset < len(script)):
 				blockLength = 255
@@ -259,56 +268,50 @@ class btchip:
 					params.extend(sequence)
 				apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_HASH_INPUT_START, 0x80, 0x00, len(params) ]
 				apdu.extend(params)
-				self.dongle.exchange(bytearray(apdu))
+				yield bytearray(apdu)
 				offset += blockLength
 			currentIndex += 1
 
-	def finalizeInput(self, outputAddress, amount, fees, changePath, rawTx=None):
-		alternateEncoding = False
+	def finalizeInputFullApdus(self, outputData, changePath=None):
+		if changePath is not None:
+			donglePath = parse_bip32_path(changePath)
+			if len(donglePath) != 0:
+				apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_HASH_INPUT_FINALIZE_FULL, 0xFF, 0x00 ]
+				params = []
+				params.extend(donglePath)
+				apdu.append(len(params))
+				apdu.extend(params)
+				yield bytearray(apdu)
+		offset = 0
+		while (offset < len(outputData)):
+			if self.maxDataLength > 255:
+				blockLength = self.maxDataLength
+			else:
+				blockLength = self.scriptBlockLength
+			if ((offset + blockLength) < len(outputData)):
+				dataLength = blockLength
+				p1 = 0x00
+			else:
+				dataLength = len(outputData) - offset
+				p1 = 0x80
+			yield self.commandApdu(self.BTCHIP_INS_HASH_INPUT_FINALIZE_FULL, p1, 0x00, outputData[offset : offset + dataLength])
+			offset += dataLength
+
+	def finalizeInputApdu(self, outputAddress, amount, fees, changePath):
 		donglePath = parse_bip32_path(changePath)
-		if self.needKeyCache:
-			self.resolvePublicKeysInPath(changePath)		
+		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_HASH_INPUT_FINALIZE, 0x02, 0x00 ]
+		params = []
+		params.append(len(outputAddress))
+		params.extend(bytearray(outputAddress))
+		writeHexAmountBE(btc_to_satoshi(str(amount)), params)
+		writeHexAmountBE(btc_to_satoshi(str(fees)), params)
+		params.extend(donglePath)
+		apdu.append(len(params))
+		apdu.extend(params)
+		return bytearray(apdu)
+
+	def parseFinalizeInput(self, response, outputs=None):
 		result = {}
-		outputs = None
-		if rawTx is not None:
-			try:
-				fullTx = bitcoinTransaction(bytearray(rawTx))
-				outputs = fullTx.serializeOutputs()
-				if len(donglePath) != 0:
-					apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_HASH_INPUT_FINALIZE_FULL, 0xFF, 0x00 ]
-					params = []
-					params.extend(donglePath)
-					apdu.append(len(params))
-					apdu.extend(params)
-					response = self.dongle.exchange(bytearray(apdu))
-				offset = 0
-				while (offset < len(outputs)):
-					blockLength = self.scriptBlockLength
-					if ((offset + blockLength) < len(outputs)):
-						dataLength = blockLength
-						p1 = 0x00
-					else:
-						dataLength = len(outputs) - offset
-						p1 = 0x80
-					apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_HASH_INPUT_FINALIZE_FULL, \
-						p1, 0x00, dataLength ]
-					apdu.extend(outputs[offset : offset + dataLength])
-					response = self.dongle.exchange(bytearray(apdu))
-					offset += dataLength
-				alternateEncoding = True
-			except:
-				pass
-		if not alternateEncoding:
-			apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_HASH_INPUT_FINALIZE, 0x02, 0x00 ]
-			params = []
-			params.append(len(outputAddress))
-			params.extend(bytearray(outputAddress))
-			writeHexAmountBE(btc_to_satoshi(str(amount)), params)
-			writeHexAmountBE(btc_to_satoshi(str(fees)), params)
-			params.extend(donglePath)
-			apdu.append(len(params))
-			apdu.extend(params)
-			response = self.dongle.exchange(bytearray(apdu))
 		result['confirmationNeeded'] = response[1 + response[0]] != 0x00
 		result['confirmationType'] = response[1 + response[0]]
 		if result['confirmationType'] == 0x02:
@@ -330,24 +333,12 @@ class btchip:
 			result['outputData'] = outputs
 		return result
 
-	def finalizeInputFull(self, outputData):
+	def parseFinalizeInputFull(self, responses):
 		result = {}
-		offset = 0
 		encryptedOutputData = b""
-		while (offset < len(outputData)):
-			blockLength = self.scriptBlockLength
-			if ((offset + blockLength) < len(outputData)):
-				dataLength = blockLength
-				p1 = 0x00
-			else:
-				dataLength = len(outputData) - offset
-				p1 = 0x80
-			apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_HASH_INPUT_FINALIZE_FULL, \
-			p1, 0x00, dataLength ]
-			apdu.extend(outputData[offset : offset + dataLength])
-			response = self.dongle.exchange(bytearray(apdu))
+		for response in responses:
 			encryptedOutputData = encryptedOutputData + response[1 : 1 + response[0]]
-			offset += dataLength
+		response = responses[-1]
 		if len(response) > 1: 
 			result['confirmationNeeded'] = response[1 + response[0]] != 0x00
 			result['confirmationType'] = response[1 + response[0]]
@@ -371,12 +362,10 @@ class btchip:
 			result['keycardData'] = response[offset + 1 : offset + 1 + keycardDataLength]						
 		return result
 
-	def untrustedHashSign(self, path, pin="", lockTime=0, sighashType=0x01):
+	def untrustedHashSignApdu(self, path, pin="", lockTime=0, sighashType=0x01):
 		if isinstance(pin, str):
 			pin = pin.encode('utf-8')
 		donglePath = parse_bip32_path(path)
-		if self.needKeyCache:
-			self.resolvePublicKeysInPath(path)		
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_HASH_SIGN, 0x00, 0x00 ]
 		params = []
 		params.extend(donglePath)
@@ -386,15 +375,14 @@ class btchip:
 		params.append(sighashType)
 		apdu.append(len(params))
 		apdu.extend(params)
-		result = self.dongle.exchange(bytearray(apdu))
-		result[0] = 0x30
-		return result
+		return bytearray(apdu)
 
-	def signMessagePrepareV1(self, path, message):
+	def parseUntrustedHashSign(self, response):
+		response[0] = 0x30
+		return response
+
+	def signMessagePrepareV1Apdu(self, path, message):
 		donglePath = parse_bip32_path(path)
-		if self.needKeyCache:
-			self.resolvePublicKeysInPath(path)		
-		result = {}
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_SIGN_MESSAGE, 0x00, 0x00 ]
 		params = []
 		params.extend(donglePath)
@@ -402,7 +390,10 @@ class btchip:
 		params.extend(bytearray(message))
 		apdu.append(len(params))
 		apdu.extend(params)
-		response = self.dongle.exchange(bytearray(apdu))
+		return bytearray(apdu)
+
+	def parseSignMessagePrepareV1(self, response):
+		result = {}
 		result['confirmationNeeded'] = response[0] != 0x00
 		result['confirmationType'] = response[0]
 		if result['confirmationType'] == 0x02:
@@ -411,13 +402,9 @@ class btchip:
 			result['secureScreenData'] = response[1:]
 		return result
 
-	def signMessagePrepareV2(self, path, message):
+	def signMessagePrepareV2Apdus(self, path, message):
 		donglePath = parse_bip32_path(path)
-		if self.needKeyCache:
-			self.resolvePublicKeysInPath(path)				
-		result = {}
 		offset = 0
-		encryptedOutputData = b""
 		while (offset < len(message)):
 			params = [];
 			if offset == 0:
@@ -427,18 +414,21 @@ class btchip:
 				p2 = 0x01
 			else:
 				p2 = 0x80
-			blockLength = 255 - len(params)
+			blockLength = self.maxDataLength - len(params)
 			if ((offset + blockLength) < len(message)):
 				dataLength = blockLength
 			else:
 				dataLength = len(message) - offset
 			params.extend(bytearray(message[offset : offset + dataLength]))
-			apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_SIGN_MESSAGE, 0x00, p2 ]
-			apdu.append(len(params))
-			apdu.extend(params)
-			response = self.dongle.exchange(bytearray(apdu))
-			encryptedOutputData = encryptedOutputData + response[1 : 1 + response[0]]
+			yield self.commandApdu(self.BTCHIP_INS_SIGN_MESSAGE, 0x00, p2, params)
 			offset += blockLength
+
+	def parseSignMessagePrepareV2(self, responses):
+		result = {}
+		encryptedOutputData = b""
+		for response in responses:
+			encryptedOutputData = encryptedOutputData + response[1 : 1 + response[0]]
+		response = responses[-1]
 		result['confirmationNeeded'] = response[1 + response[0]] != 0x00
 		result['confirmationType'] = response[1 + response[0]]
 		if result['confirmationType'] == 0x03:
@@ -448,17 +438,7 @@ class btchip:
 
 		return result
 
-	def signMessagePrepare(self, path, message):
-		try:
-			result = self.signMessagePrepareV2(path, message)
-		except BTChipException as e:
-			if (e.sw == 0x6b00): # Old firmware version, try older method
-				result = self.signMessagePrepareV1(path, message)
-			else:
-				raise
-		return result
-
-	def signMessageSign(self, pin=""):
+	def signMessageSignApdu(self, pin=""):
 		if isinstance(pin, str):
 			pin = pin.encode('utf-8')
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_SIGN_MESSAGE, 0x80, 0x00 ]
@@ -470,7 +450,300 @@ class btchip:
 			params.append(0x00)
 		apdu.append(len(params))
 		apdu.extend(params)
-		response = self.dongle.exchange(bytearray(apdu))
+		return bytearray(apdu)
+
+	def getFirmwareVersionApdu(self):
+		return bytearray([ self.BTCHIP_CLA, self.BTCHIP_INS_GET_FIRMWARE_VERSION, 0x00, 0x00, 0x00 ])
+
+	def parseFirmwareVersion(self, response):
+		result = {}
+		result['compressedKeys'] = (response[0] == 0x01)
+		result['version'] = "%d.%d.%d" % (response[2], response[3], response[4])
+		result['specialVersion'] = response[1]
+		return result
+
+	# Java Card interface when no proprietary API is available
+
+	def parse_bip32_path_internal(self, path):
+		if len(path) == 0:
+			return []
+		result = []
+		elements = path.split('/')
+		for pathElement in elements:
+			element = pathElement.split('\'')
+			if len(element) == 1:
+				result.append(int(element[0]))
+			else:
+				result.append(0x80000000 | int(element[0]))
+		return result
+
+	def serialize_bip32_path_internal(self, path):
+		result = []
+		for pathElement in path:
+			writeUint32BE(pathElement, result)
+		return bytearray([ len(path) ] + result)
+
+	def getPublicKeysInPath(self, path):
+		splitPath = self.parse_bip32_path_internal(path)
+		result = []
+		# Locate the first public key in path
+		offset = 0
+		startOffset = 0
+		while(offset < len(splitPath)):
+			if (splitPath[offset] < 0x80000000):
+				startOffset = offset
+				break
+			offset = offset + 1
+		if startOffset != 0:
+			searchPath = splitPath[0:startOffset - 1]
+			offset = startOffset - 1
+			while(offset < len(splitPath)):
+				searchPath = searchPath + [ splitPath[offset] ]
+				result.append(searchPath)
+				offset = offset + 1
+		result.append(splitPath)
+		return result
+
+	def cacheHasPublicKeyApdu(self, path):
+		expandedPath = self.serialize_bip32_path_internal(path)
+		apdu = [ self.BTCHIP_JC_EXT_CLA, self.BTCHIP_INS_EXT_CACHE_HAS_PUBLIC_KEY, 0x00, 0x00 ]
+		apdu.append(len(expandedPath))
+		apdu.extend(expandedPath)
+		return bytearray(apdu)
+
+	def getHalfPublicKeyApdu(self, path):
+		expandedPath = self.serialize_bip32_path_internal(path)
+		apdu = [ self.BTCHIP_JC_EXT_CLA, self.BTCHIP_INS_EXT_GET_HALF_PUBLIC_KEY, 0x00, 0x00 ]
+		apdu.append(len(expandedPath))
+		apdu.extend(expandedPath)
+		return bytearray(apdu)
+
+	def cachePutPublicKeyApdu(self, path, halfPublicKey):
+		expandedPath = self.serialize_bip32_path_internal(path)
+		hashData = halfPublicKey[0:32]
+		keyX = halfPublicKey[32:64]
+		signature = halfPublicKey[64:]
+		keyXY = recoverKey(signature, hashData, keyX)
+		apdu = [ self.BTCHIP_JC_EXT_CLA, self.BTCHIP_INS_EXT_CACHE_PUT_PUBLIC_KEY, 0x00, 0x00 ]
+		apdu.append(len(expandedPath) + 65)
+		apdu.extend(expandedPath)
+		apdu.extend(keyXY)
+		return bytearray(apdu)
+
+	def getJCExtendedFeaturesApdu(self):
+		return bytearray([ self.BTCHIP_JC_EXT_CLA, self.BTCHIP_INS_EXT_CACHE_GET_FEATURES, 0x00, 0x00, 0x00 ])
+
+	def parseJCExtendedFeatures(self, response):
+		result = {}
+		result['proprietaryApi'] = ((response[0] & 0x01) != 0)
+		return result
+
+class btchip(btchipCodec):
+
+	def __init__(self, dongle):
+		self.dongle = dongle
+		self.scheduler = SessionScheduler()
+		self.interrupted = False
+		self.needKeyCache = False
+		self.setMaxDataLength(getattr(dongle, 'getMaxDataLength', lambda: 255)())
+		try:
+			self.setFirmwareVersion(self.getFirmwareVersion()['version'])
+		except:
+			pass				
+		try:			
+			result = self.getJCExtendedFeatures()
+			self.needKeyCache = (result['proprietaryApi'] == False)
+		except:
+			pass
+
+	@contextmanager
+	def session(self, priority=None, timeout=None, deadline=None):
+		"""Hold the device for a sequence of calls, for example from startUntrustedTransaction to
+		untrustedHashSign, when the instance is shared between threads. Callers are queued by
+		priority, the yielded Lease gives the wait time and then the hold time.
+		With a Deadline, waiting for the device and every exchange of the block share its budget :
+		it is checked before each APDU, and each exchange times out with it. A dongle shared
+		between processes is waited for within the same budget. An interrupted operation is
+		restarted from its first call (startUntrustedTransaction with a new transaction for a
+		signature)"""
+		with self.leaseDevice(priority, timeout, deadline, True) as lease:
+			yield lease
+
+	@contextmanager
+	def leaseDevice(self, priority, timeout, deadline, dongleShared):
+		"""Lease of the instance, with the session of a dongle shared between processes when
+		dongleShared is set. A single APDU is atomic on its own and does not need one"""
+		if deadline is not None and timeout is None:
+			timeout = deadline.getRemaining()
+		with self.scheduler.lease(priority, timeout) as lease:
+			previous = lease.deadline
+			if previous is None:
+				lease.deadline = deadline
+			try:
+				self.resyncInterrupted()
+				if not dongleShared:
+					yield lease
+					return
+				if lease.deadline is not None:
+					remaining = lease.deadline.getRemaining()
+				else:
+					remaining = max(timeout - lease.waitTime, 0.0) if timeout is not None else None
+				body = False
+				try:
+					with dongleSession(self.dongle, priority, remaining):
+						body = True
+						yield lease
+						body = False
+				except Exception as e:
+					# Failing to get or give back a shared dongle interrupts like a failed exchange
+					if not body and (not isinstance(e, BTChipException) or e.sw is None):
+						self.interrupted = True
+					raise
+			finally:
+				lease.deadline = previous
+
+	def exchange(self, apdu):
+		with self.leaseDevice(None, None, None, False) as lease:
+			return self.exchangeWithin(apdu, lease.deadline)
+
+	def exchangeSequence(self, apdus, responses=None):
+		response = None
+		with self.leaseDevice(None, None, None, True) as lease:
+			if hasattr(self.dongle, 'exchangePipelined'):
+				# The APDUs of a stream do not depend on the previous responses
+				pipelined = self.exchangePipelinedWithin(apdus, lease.deadline)
+				if responses is not None:
+					responses.extend(pipelined)
+				return pipelined[-1] if len(pipelined) != 0 else None
+			for apdu in apdus:
+				response = self.exchangeWithin(apdu, lease.deadline)
+				if responses is not None:
+					responses.append(response)
+		return response
+
+	def resyncInterrupted(self):
+		if self.interrupted:
+			# A transport failure may have left a late response in flight
+			self.interrupted = False
+			if hasattr(self.dongle, 'resync'):
+				self.dongle.resync()
+
+	def exchangeWithin(self, apdu, deadline):
+		timeout = 20000
+		if deadline is not None:
+			deadline.check()
+			timeout = deadline.getExchangeTimeout(timeout)
+		self.resyncInterrupted()
+		try:
+			return self.dongle.exchange(apdu, timeout)
+		except Exception as e:
+			# Status words leave the device in step, transport failures carry none
+			if not isinstance(e, BTChipException) or e.sw is None:
+				self.interrupted = True
+			raise
+
+	def exchangePipelinedWithin(self, apdus, deadline):
+		timeout = 20000
+		if deadline is not None:
+			deadline.check()
+			timeout = deadline.getExchangeTimeout(timeout)
+		self.resyncInterrupted()
+		try:
+			return self.dongle.exchangePipelined(list(apdus), timeout)
+		except Exception as e:
+			if not isinstance(e, BTChipException) or e.sw is None:
+				self.interrupted = True
+			raise
+
+	def setAlternateCoinVersion(self, versionRegular, versionP2SH):
+		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_SET_ALTERNATE_COIN_VERSION, 0x00, 0x00, 0x02, versionRegular, versionP2SH]
+		self.exchange(bytearray(apdu))
+
+	def verifyPin(self, pin):
+		self.exchange(self.verifyPinApdu(pin))
+
+	def getVerifyPinRemainingAttempts(self):
+		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_VERIFY_PIN, 0x80, 0x00, 0x01 ]
+		apdu.extend(bytearray(b'0'))
+		try:
+			self.exchange(bytearray(apdu))
+		except BTChipException as e:
+			if e.sw is not None and ((e.sw & 0xfff0) == 0x63c0):
+				return e.sw - 0x63c0
+			raise e
+
+	def getWalletPublicKey(self, path, showOnScreen=False, segwit=False, segwitNative=False, cashAddr=False):
+		if self.needKeyCache:
+			self.resolvePublicKeysInPath(path)			
+		response = self.exchange(self.getWalletPublicKeyApdu(path, showOnScreen, segwit, segwitNative, cashAddr))
+		return self.parseWalletPublicKey(response)
+
+	def getTrustedInput(self, transaction, index):
+		response = self.exchangeSequence(self.getTrustedInputApdus(transaction, index))
+		return self.parseTrustedInput(response)
+
+	def startUntrustedTransaction(self, newTransaction, inputIndex, outputList, redeemScript, version=0x01, cashAddr=False, continueSegwit=False):
+		self.exchangeSequence(self.startUntrustedTransactionApdus(newTransaction, inputIndex, outputList, redeemScript, version, cashAddr, continueSegwit))
+
+	def finalizeInput(self, outputAddress, amount, fees, changePath, rawTx=None):
+		alternateEncoding = False
+		if self.needKeyCache:
+			self.resolvePublicKeysInPath(changePath)		
+		outputs = None
+		if rawTx is not None:
+			try:
+				fullTx = bitcoinTransaction(bytearray(rawTx))
+				outputs = fullTx.serializeOutputs()
+			except Exception:
+				pass
+		if outputs is not None:
+			try:
+				response = self.exchangeSequence(self.finalizeInputFullApdus(outputs, changePath))
+				alternateEncoding = True
+			except BTChipException as e:
+				# Only a firmware refusing the full encoding falls back to the legacy one
+				if e.sw is None:
+					raise
+		if not alternateEncoding:
+			response = self.exchange(self.finalizeInputApdu(outputAddress, amount, fees, changePath))
+		return self.parseFinalizeInput(response, outputs)
+
+	def finalizeInputFull(self, outputData):
+		responses = []
+		self.exchangeSequence(self.finalizeInputFullApdus(outputData), responses)
+		return self.parseFinalizeInputFull(responses)
+
+	def untrustedHashSign(self, path, pin="", lockTime=0, sighashType=0x01):
+		if self.needKeyCache:
+			self.resolvePublicKeysInPath(path)		
+		result = self.exchange(self.untrustedHashSignApdu(path, pin, lockTime, sighashType))
+		return self.parseUntrustedHashSign(result)
+
+	def signMessagePrepareV1(self, path, message):
+		if self.needKeyCache:
+			self.resolvePublicKeysInPath(path)		
+		response = self.exchange(self.signMessagePrepareV1Apdu(path, message))
+		return self.parseSignMessagePrepareV1(response)
+
+	def signMessagePrepareV2(self, path, message):
+		if self.needKeyCache:
+			self.resolvePublicKeysInPath(path)				
+		responses = []
+		self.exchangeSequence(self.signMessagePrepareV2Apdus(path, message), responses)
+		return self.parseSignMessagePrepareV2(responses)
+
+	def signMessagePrepare(self, path, message):
+		try:
+			result = self.signMessagePrepareV2(path, message)
+		except BTChipException as e:
+			if (e.sw == 0x6b00): # Old firmware version, try older method
+				result = self.signMessagePrepareV1(path, message)
+			else:
+				raise
+		return result
+
+	def signMessageSign(self, pin=""):
+		response = self.exchange(self.signMessageSignApdu(pin))
 		return response
 
 	def setup(self, operationModeFlags, featuresFlag, keyVersion, keyVersionP2SH, userPin, wipePin, keymapEncoding, seed=None, developerKey=None):
@@ -502,7 +775,7 @@ class btchip:
 			params.append(0x00)
 		apdu.append(len(params))
 		apdu.extend(params)
-		response = self.dongle.exchange(bytearray(apdu))
+		response = self.exchange(bytearray(apdu))
 		result['trustedInputKey'] = response[0:16]
 		result['developerKey'] = response[16:]
 		self.setKeymapEncoding(keymapEncoding)
@@ -519,7 +792,7 @@ class btchip:
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_SET_KEYMAP, 0x00, 0x00 ]
 		apdu.append(len(keymapEncoding))
 		apdu.extend(keymapEncoding)
-		self.dongle.exchange(bytearray(apdu))
+		self.exchange(bytearray(apdu))
 
 	def setTypingBehaviour(self, unitDelayStart, delayStart, unitDelayKey, delayKey):
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_SET_KEYMAP, 0x01, 0x00 ]
@@ -530,11 +803,11 @@ class btchip:
 		writeUint32BE(delayKey, params)
 		apdu.append(len(params))
 		apdu.extend(params)
-		self.dongle.exchange(bytearray(apdu))
+		self.exchange(bytearray(apdu))
 
 	def getOperationMode(self):
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_GET_OPERATION_MODE, 0x00, 0x00, 0x00]
-		response = self.dongle.exchange(bytearray(apdu))
+		response = self.exchange(bytearray(apdu))
 		return response[0]
 
 	def setOperationMode(self, operationMode):
@@ -544,7 +817,7 @@ class btchip:
 			and operationMode != btchip.OPERATION_MODE_DEVELOPER:
 			raise BTChipException("Invalid operation mode")
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_SET_OPERATION_MODE, 0x00, 0x00, 0x01, operationMode ]
-		self.dongle.exchange(bytearray(apdu))
+		self.exchange(bytearray(apdu))
 
 	def enableAlternate2fa(self, persistent):
 		if persistent:
@@ -552,45 +825,40 @@ class btchip:
 		else:
 			p1 = 0x01
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_SET_OPERATION_MODE, p1, 0x00, 0x01, btchip.OPERATION_MODE_WALLET ]
-		self.dongle.exchange(bytearray(apdu))
+		self.exchange(bytearray(apdu))
 
 	def getFirmwareVersion(self):
-		result = {}
-		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_GET_FIRMWARE_VERSION, 0x00, 0x00, 0x00 ]
 		try:
-			response = self.dongle.exchange(bytearray(apdu))
+			response = self.exchange(self.getFirmwareVersionApdu())
 		except BTChipException as e:
 			if (e.sw == 0x6985):
 				response = [0x00, 0x00, 0x01, 0x04, 0x03 ]
 				pass
 			else:
 				raise
-		result['compressedKeys'] = (response[0] == 0x01)
-		result['version'] = "%d.%d.%d" % (response[2], response[3], response[4])
-		result['specialVersion'] = response[1]
-		return result
+		return self.parseFirmwareVersion(response)
 
 	def getRandom(self, size):
 		if size > 255:
 			raise BTChipException("Invalid size")
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_GET_RANDOM, 0x00, 0x00, size ]
-		return self.dongle.exchange(bytearray(apdu))
+		return self.exchange(bytearray(apdu))
 
 	def getPOSSeedKey(self):
 		result = {}
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_GET_POS_SEED, 0x01, 0x00, 0x00 ]
-		return self.dongle.exchange(bytearray(apdu))
+		return self.exchange(bytearray(apdu))
 
 	def getPOSEncryptedSeed(self):
 		result = {}
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_GET_POS_SEED, 0x02, 0x00, 0x00 ]
-		return self.dongle.exchange(bytearray(apdu))
+		return self.exchange(bytearray(apdu))
 
 	def importPrivateKey(self, data, isSeed=False):
 		apdu = [ self.BTCHIP_CLA, self.BTCHIP_INS_IMPORT_PRIVATE_KEY, (0x02 if isSeed else 0x01), 0x00 ]
 		apdu.append(len(data))
 		apdu.extend(data)
-		return self.dongle.exchange(bytearray(apdu))
+		return self.exchange(bytearray(apdu))
 
 	def getPublicKey(self, encodedPrivateKey):
 		result = {}
@@ -598,7 +866,7 @@ class btchip:
 		apdu.append(len(encodedPrivateKey) + 1)
 		apdu.append(len(encodedPrivateKey))
 		apdu.extend(encodedPrivateKey)
-		response = self.dongle.exchange(bytearray(apdu))
+		response = self.exchange(bytearray(apdu))
 		offset = 1
 		result['publicKey'] = response[offset + 1 : offset + 1 + response[offset]]
 		offset = offset + 1 + response[offset]
@@ -624,7 +892,7 @@ class btchip:
 			apdu.append(len(currentEncodedPrivateKey))
 			apdu.extend(currentEncodedPrivateKey)
 			apdu.extend(donglePath[offset : offset + 4])
-			currentEncodedPrivateKey = self.dongle.exchange(bytearray(apdu))
+			currentEncodedPrivateKey = self.exchange(bytearray(apdu))
 			offset = offset + 4
 		return currentEncodedPrivateKey
 
@@ -635,73 +903,21 @@ class btchip:
 		apdu.extend(encodedPrivateKey)
 		apdu.append(len(data))
 		apdu.extend(data)
-		return self.dongle.exchange(bytearray(apdu))
+		return self.exchange(bytearray(apdu))
 
 # Functions dedicated to the Java Card interface when no proprietary API is available
 
-	def parse_bip32_path_internal(self, path):
-		if len(path) == 0:
-			return []
-		result = []
-		elements = path.split('/')
-		for pathElement in elements:
-			element = pathElement.split('\'')
-			if len(element) == 1:
-				result.append(int(element[0]))
-			else:
-				result.append(0x80000000 | int(element[0]))
-		return result
-
-	def serialize_bip32_path_internal(self, path):
-		result = []
-		for pathElement in path:
-			writeUint32BE(pathElement, result)
-		return bytearray([ len(path) ] + result)
-
 	def resolvePublicKey(self, path):
-		expandedPath = self.serialize_bip32_path_internal(path)
-		apdu = [ self.BTCHIP_JC_EXT_CLA, self.BTCHIP_INS_EXT_CACHE_HAS_PUBLIC_KEY, 0x00, 0x00 ]
-		apdu.append(len(expandedPath))
-		apdu.extend(expandedPath)
-		result = self.dongle.exchange(bytearray(apdu))
+		result = self.exchange(self.cacheHasPublicKeyApdu(path))
 		if (result[0] == 0):
 			# Not present, need to be inserted into the cache
-			apdu = [ self.BTCHIP_JC_EXT_CLA, self.BTCHIP_INS_EXT_GET_HALF_PUBLIC_KEY, 0x00, 0x00 ]
-			apdu.append(len(expandedPath))
-			apdu.extend(expandedPath)
-			result = self.dongle.exchange(bytearray(apdu))
-			hashData = result[0:32]
-			keyX = result[32:64]
-			signature = result[64:]
-			keyXY = recoverKey(signature, hashData, keyX)
-			apdu = [ self.BTCHIP_JC_EXT_CLA, self.BTCHIP_INS_EXT_CACHE_PUT_PUBLIC_KEY, 0x00, 0x00 ]
-			apdu.append(len(expandedPath) + 65)
-			apdu.extend(expandedPath)
-			apdu.extend(keyXY)
-			self.dongle.exchange(bytearray(apdu))
+			result = self.exchange(self.getHalfPublicKeyApdu(path))
+			self.exchange(self.cachePutPublicKeyApdu(path, result))
 
 	def resolvePublicKeysInPath(self, path):
-		splitPath = self.parse_bip32_path_internal(path)
-		# Locate the first public key in path
-		offset = 0
-		startOffset = 0
-		while(offset < len(splitPath)):
-			if (splitPath[offset] < 0x80000000):
-				startOffset = offset
-				break
-			offset = offset + 1
-		if startOffset != 0:
-			searchPath = splitPath[0:startOffset - 1]
-			offset = startOffset - 1
-			while(offset < len(splitPath)):
-				searchPath = searchPath + [ splitPath[offset] ]
-				self.resolvePublicKey(searchPath)
-				offset = offset + 1
-		self.resolvePublicKey(splitPath)
+		for searchPath in self.getPublicKeysInPath(path):
+			self.resolvePublicKey(searchPath)
 
 	def getJCExtendedFeatures(self):
-		result = {}
-		apdu = [ self.BTCHIP_JC_EXT_CLA, self.BTCHIP_INS_EXT_CACHE_GET_FEATURES, 0x00, 0x00, 0x00 ]
-		response = self.dongle.exchange(bytearray(apdu))
-		result['proprietaryApi'] = ((response[0] & 0x01) != 0)
-		return result
+		response = self.exchange(self.getJCExtendedFeaturesApdu())
+		return self.parseJCExtendedFeatures(response)
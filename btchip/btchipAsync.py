@@ -0,0 +1,210 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+# asyncio client - Python 3 only, to be used with the transports of btchipCommAsync
+
+from .btchip import *
+from .btchipCommAsync import *
+import asyncio
+import contextlib
+
+@contextlib.asynccontextmanager
+async def noSession():
+	yield
+
+class AsyncBtchip(btchipCodec):
+	"""Coroutine counterpart of btchip, APDUs are built and parsed by btchipCodec.
+	Operations on the same device are serialized, any waiting (including a dongle waiting for
+	the user to confirm) only suspends the calling coroutine"""
+
+	def __init__(self, dongle):
+		self.dongle = dongle
+		self.needKeyCache = False
+		self.setMaxDataLength(getattr(dongle, 'getMaxDataLength', lambda: 255)())
+		self.lock = asyncio.Lock()
+		self.sessionOwner = None
+
+	@classmethod
+	async def create(cls, dongle):
+		app = cls(dongle)
+		await app.open()
+		return app
+
+	async def open(self):
+		try:
+			self.setFirmwareVersion((await self.getFirmwareVersion())['version'])
+		except Exception:
+			pass
+		try:
+			result = await self.getJCExtendedFeatures()
+			self.needKeyCache = (result['proprietaryApi'] == False)
+		except Exception:
+			pass
+
+	@contextlib.asynccontextmanager
+	async def session(self):
+		"""Hold the device for a sequence of calls, for example from startUntrustedTransaction
+		to untrustedHashSign, with the session of a dongle shared between processes. Reentrant
+		for the task owning it"""
+		async with self.leaseDevice(True):
+			yield self
+
+	@contextlib.asynccontextmanager
+	async def leaseDevice(self, dongleShared):
+		"""Lock of the instance, with the session of a dongle shared between processes when
+		dongleShared is set. A single APDU is atomic on its own and does not need one"""
+		task = asyncio.current_task()
+		if self.sessionOwner is task:
+			async with self.dongleSession(dongleShared):
+				yield self
+			return
+		async with self.lock:
+			self.sessionOwner = task
+			try:
+				async with self.dongleSession(dongleShared):
+					yield self
+			finally:
+				self.sessionOwner = None
+
+	def dongleSession(self, dongleShared):
+		if dongleShared and hasattr(self.dongle, 'session'):
+			return self.dongle.session()
+		return noSession()
+
+	async def exchange(self, apdu, timeout=20000):
+		async with self.leaseDevice(False):
+			return await self.dongle.exchange(apdu, timeout)
+
+	async def exchangeSequence(self, apdus, responses=None):
+		response = None
+		async with self.leaseDevice(True):
+			for apdu in apdus:
+				response = await self.dongle.exchange(apdu)
+				if responses is not None:
+					responses.append(response)
+		return response
+
+	async def verifyPin(self, pin):
+		await self.exchange(self.verifyPinApdu(pin))
+
+	async def getWalletPublicKey(self, path, showOnScreen=False, segwit=False, segwitNative=False, cashAddr=False):
+		async with self.leaseDevice(False):
+			if self.needKeyCache:
+				await self.resolvePublicKeysInPath(path)
+			response = await self.exchange(self.getWalletPublicKeyApdu(path, showOnScreen, segwit, segwitNative, cashAddr))
+		return self.parseWalletPublicKey(response)
+
+	async def getTrustedInput(self, transaction, index):
+		response = await self.exchangeSequence(self.getTrustedInputApdus(transaction, index))
+		return self.parseTrustedInput(response)
+
+	async def startUntrustedTransaction(self, newTransaction, inputIndex, outputList, redeemScript, version=0x01, cashAddr=False, continueSegwit=False):
+		await self.exchangeSequence(self.startUntrustedTransactionApdus(newTransaction, inputIndex, outputList, redeemScript, version, cashAddr, continueSegwit))
+
+	async def finalizeInput(self, outputAddress, amount, fees, changePath, rawTx=None):
+		alternateEncoding = False
+		outputs = None
+		async with self.leaseDevice(False):
+			if self.needKeyCache:
+				await self.resolvePublicKeysInPath(changePath)
+			if rawTx is not None:
+				try:
+					fullTx = bitcoinTransaction(bytearray(rawTx))
+					outputs = fullTx.serializeOutputs()
+				except Exception:
+					pass
+			if outputs is not None:
+				try:
+					response = await self.exchangeSequence(self.finalizeInputFullApdus(outputs, changePath))
+					alternateEncoding = True
+				except BTChipException as e:
+					# Only a firmware refusing the full encoding falls back to the legacy one
+					if e.sw is None:
+						raise
+			if not alternateEncoding:
+				response = await self.exchange(self.finalizeInputApdu(outputAddress, amount, fees, changePath))
+		return self.parseFinalizeInput(response, outputs)
+
+	async def finalizeInputFull(self, outputData):
+		responses = []
+		await self.exchangeSequence(self.finalizeInputFullApdus(outputData), responses)
+		return self.parseFinalizeInputFull(responses)
+
+	async def untrustedHashSign(self, path, pin="", lockTime=0, sighashType=0x01):
+		async with self.leaseDevice(False):
+			if self.needKeyCache:
+				await self.resolvePublicKeysInPath(path)
+			response = await self.exchange(self.untrustedHashSignApdu(path, pin, lockTime, sighashType))
+		return self.parseUntrustedHashSign(response)
+
+	async def signMessagePrepareV1(self, path, message):
+		async with self.leaseDevice(False):
+			if self.needKeyCache:
+				await self.resolvePublicKeysInPath(path)
+			response = await self.exchange(self.signMessagePrepareV1Apdu(path, message))
+		return self.parseSignMessagePrepareV1(response)
+
+	async def signMessagePrepareV2(self, path, message):
+		responses = []
+		async with self.leaseDevice(False):
+			if self.needKeyCache:
+				await self.resolvePublicKeysInPath(path)
+			await self.exchangeSequence(self.signMessagePrepareV2Apdus(path, message), responses)
+		return self.parseSignMessagePrepareV2(responses)
+
+	async def signMessagePrepare(self, path, message):
+		async with self.leaseDevice(False):
+			try:
+				result = await self.signMessagePrepareV2(path, message)
+			except BTChipException as e:
+				if (e.sw == 0x6b00): # Old firmware version, try older method
+					result = await self.signMessagePrepareV1(path, message)
+				else:
+					raise
+		return result
+
+	async def signMessageSign(self, pin=""):
+		return await self.exchange(self.signMessageSignApdu(pin))
+
+	async def getFirmwareVersion(self):
+		try:
+			response = await self.exchange(self.getFirmwareVersionApdu())
+		except BTChipException as e:
+			if (e.sw == 0x6985):
+				response = [0x00, 0x00, 0x01, 0x04, 0x03 ]
+			else:
+				raise
+		return self.parseFirmwareVersion(response)
+
+	async def resolvePublicKey(self, path):
+		async with self.leaseDevice(True):
+			result = await self.exchange(self.cacheHasPublicKeyApdu(path))
+			if (result[0] == 0):
+				# Not present, need to be inserted into the cache
+				result = await self.exchange(self.getHalfPublicKeyApdu(path))
+				await self.exchange(self.cachePutPublicKeyApdu(path, result))
+
+	async def resolvePublicKeysInPath(self, path):
+		async with self.leaseDevice(True):
+			for searchPath in self.getPublicKeysInPath(path):
+				await self.resolvePublicKey(searchPath)
+
+	async def getJCExtendedFeatures(self):
+		response = await self.exchange(self.getJCExtendedFeaturesApdu())
+		return self.parseJCExtendedFeatures(response)
@@ -0,0 +1,252 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+# btchip-bench : throughput and latency of a mix of operations run by concurrent clients
+# against the emulator, a proxy or a device, reported as JSON
+#
+# Each client of a proxy holds one of its devices until it disconnects, a client beyond the
+# devices the proxy serves waits forever : use at most as many clients as devices.
+
+from .btchip import *
+from .btchipComm import *
+from .btchipException import *
+from .btchipObserver import DongleObserver, clock
+from .btchipUtils import *
+from binascii import unhexlify
+import argparse
+import json
+import platform
+import random
+import sys
+import threading
+import time
+
+# P2PKH spend of vout 1 of UTX, signed by TRANSACTION. Shared with the samples and tests
+UTX = bytearray(unhexlify("01000000014ea60aeac5252c14291d428915bd7ccd1bfc4af009f4d4dc57ae597ed0420b71010000008a47304402201f36a12c240dbf9e566bc04321050b1984cd6eaf6caee8f02bb0bfec08e3354b022012ee2aeadcbbfd1e92959f57c15c1c6debb757b798451b104665aa3010569b49014104090b15bde569386734abf2a2b99f9ca6a50656627e77de663ca7325702769986cf26cc9dd7fdea0af432c8e2becc867c932e1b9dd742f2a108997c2252e2bdebffffffff0281b72e00000000001976a91472a5d75c8d2d0565b656a5232703b167d50d5a2b88aca0860100000000001976a9144533f5fb9b4817f713c48f0bfe96b9f50c476c9b88ac00000000"))
+TRANSACTION = bytearray(unhexlify("0100000001c773da236484dae8f0fdba3d7e0ba1d05070d1a34fc44943e638441262a04f10010000006b483045022100ea6df031b47629590daf5598b6f0680ad0132d8953b401577f01e8cc46393fe602202201b7a19d706a0213dcfeb7033719b92c6fd58a2d1d53411de71c4d8353154b01210348bb1fade0adde1bf202726e6db5eacd2063fce7ecf8bbfd17377f09218d5814ffffffff01905f0100000000001976a91472a5d75c8d2d0565b656a5232703b167d50d5a2b88ac00000000"))
+
+class BenchContext(object):
+
+	def __init__(self, messageSize=64):
+		self.transaction = bitcoinTransaction(UTX)
+		self.message = (b"Benchmark message " * (messageSize // 18 + 1))[0:messageSize]
+
+def runPublicKey(app, context, index):
+	app.getWalletPublicKey("44'/0'/0'/0/%d" % (index % 1000))
+
+def runTrustedInput(app, context, index):
+	app.getTrustedInput(context.transaction, 1)
+
+def runSign(app, context, index):
+	trustedInput = app.getTrustedInput(context.transaction, 1)
+	app.startUntrustedTransaction(True, 0, [ trustedInput ], context.transaction.outputs[1].script)
+	app.finalizeInput(b"", 0, 0, "0'/1/0", TRANSACTION)
+	app.untrustedHashSign("0'/0/0", "")
+
+def runMessage(app, context, index):
+	app.signMessagePrepare("0'/0/0", context.message)
+	app.signMessageSign("")
+
+WORKLOADS = {
+	'pubkey': runPublicKey,
+	'trustedinput': runTrustedInput,
+	'sign': runSign,
+	'message': runMessage
+}
+
+def parseMix(mix):
+	"""name=weight,... into a list of (name, weight)"""
+	result = []
+	for item in mix.split(","):
+		name, separator, weight = item.partition("=")
+		name = name.strip()
+		if name not in WORKLOADS:
+			raise BTChipException("Unknown workload %s" % name)
+		result.append((name, float(weight) if separator else 1.0))
+	return result
+
+def getPercentile(values, percentile):
+	"""Nearest rank percentile of sorted values"""
+	if len(values) == 0:
+		return None
+	rank = int(len(values) * percentile / 100.0 + 0.999999)
+	return values[min(max(rank, 1), len(values)) - 1]
+
+class ExchangeCounter(DongleObserver):
+	"""Exchanges made by the current thread, dongles shared between clients exchange in the
+	thread of the caller"""
+
+	def __init__(self):
+		self.local = threading.local()
+
+	def onExchange(self, event):
+		self.local.count = getattr(self.local, 'count', 0) + 1
+
+	def getCount(self):
+		return getattr(self.local, 'count', 0)
+
+class BenchClient(object):
+
+	def __init__(self, app, context, mix, counter, seed):
+		self.app = app
+		self.context = context
+		self.names = [ name for name, weight in mix ]
+		self.weights = [ weight for name, weight in mix ]
+		self.counter = counter
+		self.random = random.Random(seed)
+		self.samples = dict((name, []) for name in self.names)
+		self.errors = dict((name, 0) for name in self.names)
+
+	def choose(self):
+		value = self.random.uniform(0, sum(self.weights))
+		for name, weight in zip(self.names, self.weights):
+			value -= weight
+			if value <= 0:
+				return name
+		return self.names[-1]
+
+	def run(self, operations, deadline):
+		index = 0
+		while (operations is None or index < operations) and (deadline is None or clock() < deadline):
+			name = self.choose()
+			exchanges = self.counter.getCount()
+			start = clock()
+			try:
+				# The whole operation holds the device when the instance is shared
+				with self.app.session():
+					WORKLOADS[name](self.app, self.context, index)
+			except Exception:
+				# Transport errors (OSError from a lost handle) count like status words
+				self.errors[name] += 1
+			else:
+				self.samples[name].append((clock() - start, self.counter.getCount() - exchanges))
+			index += 1
+
+def openApps(args, counter):
+	"""One btchip instance per client, shared when all clients drive a single device"""
+	if args.proxy is not None:
+		server, separator, port = args.proxy.rpartition(":")
+		if args.proxy.startswith("unix:"):
+			server, port = args.proxy, "0"
+		descriptor = { 'type': 'proxy', 'server': server, 'port': int(port), 'protocol': args.protocol }
+		dongles = [ openDongle(descriptor) for i in range(args.clients) ]
+	elif args.device:
+		dongles = [ getDongle() ] * args.clients
+	else:
+		from .btchipEmulator import EmulatedDongle
+		dongles = [ EmulatedDongle(latency=args.latency / 1000.0) for i in range(1 if args.shared else args.clients) ] * (args.clients if args.shared else 1)
+	apps = {}
+	for dongle in dongles:
+		if id(dongle) not in apps:
+			dongle.addObserver(counter)
+			app = btchip(dongle)
+			if args.pin:
+				app.verifyPin(args.pin)
+			apps[id(dongle)] = app
+	return [ apps[id(dongle)] for dongle in dongles ]
+
+def getWorkloadReport(samples, errors, elapsed):
+	latencies = sorted(latency for latency, exchanges in samples)
+	report = {
+		'operations': len(samples),
+		'errors': errors,
+		'throughput': len(samples) / elapsed if elapsed > 0 else 0.0,
+		'apdusPerOperation': float(sum(exchanges for latency, exchanges in samples)) / len(samples) if samples else None
+	}
+	if latencies:
+		report['latency'] = {
+			'mean': 1000 * sum(latencies) / len(latencies),
+			'min': 1000 * latencies[0],
+			'p50': 1000 * getPercentile(latencies, 50),
+			'p95': 1000 * getPercentile(latencies, 95),
+			'p99': 1000 * getPercentile(latencies, 99),
+			'max': 1000 * latencies[-1]
+		}
+	return report
+
+def runBenchmark(apps, mix, counter, operations=None, duration=None, messageSize=64, seed=0):
+	"""Run one client thread per app, each doing operations or running for duration seconds,
+	and return the report. Latencies are in ms"""
+	context = BenchContext(messageSize)
+	clients = [ BenchClient(app, context, mix, counter, seed + index) for index, app in enumerate(apps) ]
+	start = clock()
+	deadline = start + duration if duration is not None else None
+	threads = [ threading.Thread(target=client.run, args=(operations, deadline), name="btchip-bench") for client in clients ]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	elapsed = clock() - start
+	workloads = {}
+	allSamples = []
+	allErrors = 0
+	for name, weight in mix:
+		samples = [ sample for client in clients for sample in client.samples[name] ]
+		errors = sum(client.errors[name] for client in clients)
+		workloads[name] = getWorkloadReport(samples, errors, elapsed)
+		allSamples.extend(samples)
+		allErrors += errors
+	report = getWorkloadReport(allSamples, allErrors, elapsed)
+	report['clients'] = len(apps)
+	report['elapsed'] = elapsed
+	report['workloads'] = workloads
+	return report
+
+def main():
+	parser = argparse.ArgumentParser(description="Throughput and latency of btchip operations, reported as JSON")
+	parser.add_argument("--mix", default="pubkey=4,trustedinput=2,sign=1,message=1", help="workloads and weights among %s" % ",".join(sorted(WORKLOADS.keys())))
+	parser.add_argument("--clients", type=int, default=1, help="concurrent clients")
+	parser.add_argument("--operations", type=int, default=None, help="operations per client")
+	parser.add_argument("--duration", type=float, default=None, help="seconds to run, 10 without --operations")
+	parser.add_argument("--proxy", default=None, help="host:port or unix:<path> of a proxy to benchmark")
+	parser.add_argument("--protocol", type=int, default=1, choices=[ 1, 2, 3 ], help="proxy protocol")
+	parser.add_argument("--device", action="store_true", help="benchmark the first device found, shared by the clients")
+	parser.add_argument("--shared", action="store_true", help="clients share one emulated dongle")
+	parser.add_argument("--latency", type=float, default=0.0, help="emulated device time per APDU in ms")
+	parser.add_argument("--pin", default=None, help="PIN to verify first, 1234 on the emulator")
+	parser.add_argument("--message-size", type=int, default=64)
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--output", default=None, help="file to write the report to instead of stdout")
+	args = parser.parse_args()
+	if args.pin is None and args.proxy is None and not args.device:
+		args.pin = "1234"
+	if args.operations is None and args.duration is None:
+		args.duration = 10.0
+	mix = parseMix(args.mix)
+	counter = ExchangeCounter()
+	apps = openApps(args, counter)
+	report = runBenchmark(apps, mix, counter, args.operations, args.duration, args.message_size, args.seed)
+	report['mix'] = dict(mix)
+	report['target'] = args.proxy if args.proxy is not None else ("device" if args.device else "emulator")
+	report['python'] = platform.python_version()
+	report['timestamp'] = time.time()
+	closed = set()
+	for app in apps:
+		if id(app.dongle) not in closed:
+			closed.add(id(app.dongle))
+			app.dongle.close()
+	output = json.dumps(report, indent=2, sort_keys=True)
+	if args.output is not None:
+		with open(args.output, "w") as reportFile:
+			reportFile.write(output + "\n")
+	else:
+		sys.stdout.write(output + "\n")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,236 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+# Broker daemon owning the attached dongles and sharing them with local processes through
+# DongleBroker clients over a Unix domain socket
+
+from .btchipComm import *
+from .btchipException import *
+from .btchipSession import *
+import argparse
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+DEFAULT_BROKER_SOCKET = "/tmp/btchip-broker.sock"
+
+def describe(descriptor):
+	if descriptor is None:
+		return None
+	result = {}
+	for key, value in descriptor.items():
+		if isinstance(value, bytes):
+			value = value.decode('utf-8', 'replace')
+		result[key] = value
+	return result
+
+class BrokerDevice(object):
+
+	def __init__(self, dongle, descriptor=None):
+		self.dongle = dongle
+		self.descriptor = descriptor
+		self.lock = PriorityLock()
+		self.statsLock = threading.Lock()
+		self.exchanges = 0
+		self.sessions = 0
+		self.waitTime = 0.0
+		self.holdTime = 0.0
+		self.maxQueueDepth = 0
+
+	def acquire(self, owner, priority):
+		depth = sum(self.lock.getQueueDepth().values()) + 1
+		waitTime = self.lock.acquire(owner, priority)
+		with self.statsLock:
+			self.sessions += 1
+			self.waitTime += waitTime
+			self.maxQueueDepth = max(self.maxQueueDepth, depth)
+		return time.time()
+
+	def release(self, owner, acquired):
+		with self.statsLock:
+			self.holdTime += time.time() - acquired
+		self.lock.release(owner)
+
+	def exchange(self, apdu):
+		with self.statsLock:
+			self.exchanges += 1
+		try:
+			return self.dongle.exchange(apdu), 0x9000
+		except BTChipException as e:
+			return bytearray(), e.sw if e.sw is not None else 0x6f00
+		except Exception:
+			return bytearray(), 0x6f00
+
+	def getStatistics(self):
+		queueDepth = self.lock.getQueueDepth()
+		with self.statsLock:
+			return {
+				'descriptor': describe(self.descriptor),
+				'busy': self.lock.owner is not None,
+				'queueDepth': dict((str(priority), depth) for priority, depth in queueDepth.items()),
+				'maxQueueDepth': self.maxQueueDepth,
+				'sessions': self.sessions,
+				'exchanges': self.exchanges,
+				'waitTime': self.waitTime,
+				'holdTime': self.holdTime
+			}
+
+class BrokerClient(object):
+	"""State of one connected process, its connection is its session on the device"""
+
+	def __init__(self, broker, sock):
+		self.broker = broker
+		self.socket = sock
+		self.device = broker.devices[0]
+		self.depth = 0
+		self.acquired = None
+
+	def reply(self, sw, payload=b""):
+		self.socket.sendall(struct.pack(">IH", len(payload), sw) + bytes(payload))
+
+	def run(self):
+		header = bytearray(8)
+		try:
+			while True:
+				recvExactly(self.socket, memoryview(header))
+				size, opcode, priority, device = struct.unpack_from(">IBBH", header)
+				payload = bytearray(size)
+				recvExactly(self.socket, memoryview(payload))
+				self.dispatch(opcode, priority, device, payload)
+		except (socket.error, BTChipException):
+			pass
+		finally:
+			if self.depth != 0:
+				self.device.release(self, self.acquired)
+			self.socket.close()
+
+	def dispatch(self, opcode, priority, device, payload):
+		if opcode == BROKER_OPEN:
+			if self.depth != 0:
+				self.reply(0x6985)
+			elif device >= len(self.broker.devices):
+				self.reply(0x6a88)
+			else:
+				self.device = self.broker.devices[device]
+				self.reply(0x9000)
+		elif opcode == BROKER_BEGIN:
+			if self.depth == 0:
+				self.acquired = self.device.acquire(self, priority)
+			self.depth += 1
+			self.reply(0x9000)
+		elif opcode == BROKER_END:
+			if self.depth == 0:
+				self.reply(0x6985)
+				return
+			self.depth -= 1
+			if self.depth == 0:
+				self.device.release(self, self.acquired)
+			self.reply(0x9000)
+		elif opcode == BROKER_EXCHANGE:
+			if self.depth != 0:
+				response, sw = self.device.exchange(payload)
+			else:
+				acquired = self.device.acquire(self, priority)
+				try:
+					response, sw = self.device.exchange(payload)
+				finally:
+					self.device.release(self, acquired)
+			self.reply(sw, response)
+		elif opcode == BROKER_STATS:
+			self.reply(0x9000, json.dumps(self.broker.getStatistics()).encode('utf-8'))
+		else:
+			self.reply(0x6d00)
+
+class DongleBrokerServer(object):
+
+	def __init__(self, dongles, path=DEFAULT_BROKER_SOCKET, descriptors=None, mode=0o600):
+		if descriptors is None:
+			descriptors = [ None ] * len(dongles)
+		self.devices = [ BrokerDevice(dongle, descriptor) for dongle, descriptor in zip(dongles, descriptors) ]
+		self.path = path
+		if os.path.exists(path):
+			os.unlink(path)
+		self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.listener.bind(path)
+		os.chmod(path, mode)
+		self.listener.listen(64)
+		self.running = False
+		self.thread = None
+		self.started = time.time()
+
+	def start(self):
+		self.running = True
+		self.thread = threading.Thread(target=self.serve, name="btchip-broker")
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def serve(self):
+		while self.running:
+			try:
+				client, address = self.listener.accept()
+			except socket.error:
+				break
+			thread = threading.Thread(target=BrokerClient(self, client).run, name="btchip-broker-client")
+			thread.daemon = True
+			thread.start()
+
+	def getStatistics(self):
+		return {
+			'uptime': time.time() - self.started,
+			'devices': [ device.getStatistics() for device in self.devices ]
+		}
+
+	def stop(self):
+		self.running = False
+		try:
+			self.listener.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self.listener.close()
+		if self.thread is not None:
+			self.thread.join()
+		if os.path.exists(self.path):
+			os.unlink(self.path)
+		for device in self.devices:
+			device.dongle.close()
+
+def main():
+	parser = argparse.ArgumentParser(description="Share the attached dongles with local processes")
+	parser.add_argument("--socket", default=os.getenv("BTCHIP_BROKER_SOCKET", DEFAULT_BROKER_SOCKET))
+	parser.add_argument("--debug", action="store_true")
+	args = parser.parse_args()
+	descriptors = enumerateHIDDongles() + enumerateSmartcardDongles()
+	if len(descriptors) == 0:
+		raise BTChipException("No dongle found")
+	dongles = [ openDongle(descriptor, args.debug) for descriptor in descriptors ]
+	broker = DongleBrokerServer(dongles, args.socket, descriptors)
+	print("Brokering %d dongle(s) on %s" % (len(dongles), args.socket))
+	broker.running = True
+	try:
+		broker.serve()
+	except KeyboardInterrupt:
+		pass
+	broker.stop()
+
+if __name__ == "__main__":
+	main()
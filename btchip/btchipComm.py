@@ -18,13 +18,18 @@
 """
 
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 from .btchipException import *
-from .ledgerWrapper import wrapCommandAPDU, unwrapResponseAPDU
+from .btchipSession import PRIORITY_NORMAL
+from .btchipObserver import ExchangeEvent, clock
+from .ledgerWrapper import wrapCommandAPDU, wrapCommandReports, splitReports, unwrapResponseAPDU, getCommandReportCount, LedgerFrameDecoder, LedgerFrameDemultiplexer, ChannelAllocator, DEFAULT_CHANNEL, DEFAULT_PACKET_SIZE
 from binascii import hexlify
 import time
 import os
 import struct
+import json
 import socket
+import threading
 
 try:
 	import hid
@@ -33,9 +38,10 @@ except ImportError:
 	HID = False
 
 try:
+	from smartcard.CardConnection import CardConnection
 	from smartcard.Exceptions import NoCardException
 	from smartcard.System import readers
-	from smartcard.util import toHexString, toBytes
+	from smartcard.util import toBytes
 	SCARD = True
 except ImportError:
 	SCARD = False
@@ -50,6 +56,9 @@ class DongleWait(object):
 class Dongle(object):
 	__metaclass__ = ABCMeta
 
+	# Replaced by a new tuple on each change so that exchanges can iterate it without locking
+	observers = ()
+
 	@abstractmethod
 	def exchange(self, apdu, timeout=20000):
 		pass
@@ -61,84 +70,243 @@ class Dongle(object):
 	def setWaitImpl(self, waitImpl):
 		self.waitImpl = waitImpl
 
+	def resync(self, timeout=200):
+		"""Drop what an exchange interrupted by a transport failure left in flight, called before
+		the next exchange"""
+		pass
+
+	def getMaxDataLength(self):
+		"""Largest command data, more than 255 bytes means extended length APDUs are accepted"""
+		return 255
+
+	@contextmanager
+	def session(self, priority=None, timeout=None):
+		# Keeps the device for all exchanges of the block on dongles shared between clients,
+		# waiting at most timeout seconds for it
+		yield self
+
+	def addObserver(self, observer):
+		self.observers = self.observers + (observer,)
+
+	def removeObserver(self, observer):
+		self.observers = tuple(entry for entry in self.observers if entry is not observer)
+
+	def observe(self, transmit, apdu, timeout):
+		"""Run transmit(apdu, timeout, event) and report the event to the observers"""
+		event = ExchangeEvent(self, apdu)
+		try:
+			event.response = transmit(apdu, timeout, event)
+			return event.response
+		except Exception as e:
+			event.error = e
+			raise
+		finally:
+			self.report(event)
+
+	def report(self, event):
+		event.finish()
+		for observer in self.observers:
+			try:
+				observer.onExchange(event)
+			except Exception:
+				pass
+
+@contextmanager
+def dongleSession(dongle, priority=None, timeout=None):
+	if hasattr(dongle, 'session'):
+		with (dongle.session(priority) if timeout is None else dongle.session(priority, timeout)):
+			yield dongle
+	else:
+		yield dongle
+
+class HIDChannelRouter(object):
+	"""Ledger HID device shared by dongles exchanging on different channels. Commands are
+	written whole under a lock, the thread reading hands the responses of other channels to
+	their dongle"""
+
+	def __init__(self, device, packetSize=DEFAULT_PACKET_SIZE):
+		self.device = device
+		self.packetSize = packetSize
+		self.allocator = ChannelAllocator()
+		self.demultiplexer = LedgerFrameDemultiplexer(packetSize)
+		self.writeLock = threading.Lock()
+		self.condition = threading.Condition()
+		self.reading = False
+		self.responses = {}
+
+	def open(self, channel=None):
+		if channel is None:
+			channel = self.allocator.allocate()
+		else:
+			self.allocator.reserve(channel)
+		with self.condition:
+			self.demultiplexer.open(channel)
+		return channel
+
+	def close(self, channel):
+		with self.condition:
+			self.demultiplexer.close(channel)
+			self.responses.pop(channel, None)
+		self.allocator.release(channel)
+
+	def write(self, reports):
+		with self.writeLock:
+			for report in splitReports(reports, self.packetSize + 1):
+				self.device.write(report)
+
+	def receive(self, channel, deadline):
+		with self.condition:
+			while channel not in self.responses and self.reading:
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					raise BTChipTransportException("Timeout")
+				self.condition.wait(remaining)
+			if channel in self.responses:
+				return self.responses.pop(channel)
+			self.reading = True
+		try:
+			while True:
+				remaining = int((deadline - time.time()) * 1000)
+				data = self.device.read(self.packetSize + 1, max(remaining, 1))
+				if not len(data):
+					raise BTChipTransportException("Timeout")
+				with self.condition:
+					completed = self.demultiplexer.feed(bytearray(data))
+					if completed is not None:
+						if completed[0] == channel:
+							return completed[1]
+						self.responses[completed[0]] = completed[1]
+						self.condition.notify_all()
+		finally:
+			with self.condition:
+				self.reading = False
+				self.condition.notify_all()
+
 class HIDDongleHIDAPI(Dongle, DongleWait):
+	"""HID dongle exchanging packetSize bytes reports, on channel with the Ledger framing"""
 
-	def __init__(self, device, ledger=False, debug=False):
+	def __init__(self, device, ledger=False, debug=False, packetSize=DEFAULT_PACKET_SIZE, channel=DEFAULT_CHANNEL, router=None):
 		self.device = device
 		self.ledger = ledger		
 		self.debug = debug
+		self.packetSize = packetSize
+		self.channel = channel
+		self.router = router
+		self.ownsDevice = router is None
 		self.waitImpl = self
 		self.opened = True
 
+	def openChannel(self, debug=False):
+		"""Dongle exchanging on a new channel of the same device, for logical sessions tagged by
+		the transport. The device is closed with this dongle"""
+		if not self.ledger:
+			raise BTChipException("Channels require the Ledger framing")
+		if self.router is None:
+			self.router = HIDChannelRouter(self.device, self.packetSize)
+			self.router.open(self.channel)
+		return HIDDongleHIDAPI(self.device, True, debug, self.packetSize, self.router.open(), self.router)
+
 	def exchange(self, apdu, timeout=20000):
+		if self.observers:
+			return self.observe(self.transmit, apdu, timeout)
+		return self.transmit(apdu, timeout)
+
+	def transmit(self, apdu, timeout=20000, event=None):
 		if self.debug:
 			print("=> %s" % hexlify(apdu))
+		reportSize = self.packetSize + 1
 		if self.ledger:
-			apdu = wrapCommandAPDU(0x0101, apdu, 64)		
-		padSize = len(apdu) % 64
-		tmp = apdu
-		if padSize != 0:
-			tmp.extend([0] * (64 - padSize))
-		offset = 0
-		while(offset != len(tmp)):
-			data = tmp[offset:offset + 64]
-			data = bytearray([0]) + data
-			self.device.write(data)
-			offset += 64
+			reports = wrapCommandReports(self.channel, apdu, self.packetSize, 1)
+		else:
+			reports = bytearray(((len(apdu) + self.packetSize - 1) // self.packetSize) * reportSize)
+			view = memoryview(apdu)
+			for offset in range(0, len(apdu), self.packetSize):
+				data = view[offset : offset + self.packetSize]
+				reportOffset = (offset // self.packetSize) * reportSize + 1
+				reports[reportOffset : reportOffset + len(data)] = data
+		if self.router is not None:
+			self.router.write(reports)
+		else:
+			for report in splitReports(reports, reportSize):
+				self.device.write(report)
+		if event is not None:
+			event.written = clock()
 		dataLength = 0
-		dataStart = 2		
-		result = self.waitImpl.waitFirstResponse(timeout)
+		dataStart = 2
+		deadline = time.time() + timeout / 1000.0
+		if self.router is not None:
+			result = self.router.receive(self.channel, deadline)
+			reportsRead = getCommandReportCount(result, self.packetSize)
+		else:
+			result = self.waitImpl.waitFirstResponse(timeout)
+			reportsRead = 1
+		if event is not None:
+			event.firstResponse = clock()
 		if not self.ledger:
 			if result[0] == 0x61: # 61xx : data available
-				self.device.set_nonblocking(False)
 				dataLength = result[1]
 				dataLength += 2
-				if dataLength > 62:
-					remaining = dataLength - 62
+				if dataLength > self.packetSize - 2:
+					remaining = dataLength - (self.packetSize - 2)
 					while(remaining != 0):
-						if remaining > 64:
-							blockLength = 64
+						if remaining > self.packetSize:
+							blockLength = self.packetSize
 						else:
 							blockLength = remaining
-						result.extend(bytearray(self.device.read(65))[0:blockLength])
+						result.extend(self.readReport(deadline)[0:blockLength])
+						reportsRead += 1
 						remaining -= blockLength
 				swOffset = dataLength
 				dataLength -= 2
-				self.device.set_nonblocking(True)
 			else:
 				swOffset = 0
 		else:
-			self.device.set_nonblocking(False)
-			while True:
-				response = unwrapResponseAPDU(0x0101, result, 64)
-				if response is not None:
-					result = response
-					dataStart = 0
-					swOffset = len(response) - 2
-					dataLength = len(response) - 2
-					self.device.set_nonblocking(True)
-					break
-				result.extend(bytearray(self.device.read(65)))
+			if self.router is None:
+				decoder = LedgerFrameDecoder(self.channel, self.packetSize)
+				while not decoder.feed(result):
+					result = self.readReport(deadline)
+					reportsRead += 1
+				result = decoder.response
+			dataStart = 0
+			swOffset = len(result) - 2
+			dataLength = len(result) - 2
 		sw = (result[swOffset] << 8) + result[swOffset + 1]
 		response = result[dataStart : dataLength + dataStart]
+		if event is not None:
+			event.reportsWritten = len(reports) // reportSize
+			event.reportsRead = reportsRead
+			event.responseSize = len(response)
+			event.sw = sw
 		if self.debug:
 			print("<= %s%.2x" % (hexlify(response), sw))
 		if sw != 0x9000:
 			raise BTChipException("Invalid status %04x" % sw, sw)
 		return response
 
-	def waitFirstResponse(self, timeout):
-		start = time.time()
-		data = ""
-		while len(data) == 0:
-			data = self.device.read(65)
-			if not len(data):
-				if time.time() - start > timeout:
-					raise BTChipException("Timeout")
-				time.sleep(0.02)
+	def readReport(self, deadline):
+		# Blocking read bounded by the exchange deadline, the device wakes us up
+		remaining = int((deadline - time.time()) * 1000)
+		data = self.device.read(self.packetSize + 1, max(remaining, 1))
+		if not len(data):
+			raise BTChipTransportException("Timeout")
 		return bytearray(data)
 
+	def waitFirstResponse(self, timeout):
+		return self.readReport(time.time() + timeout / 1000.0)
+
+	def resync(self, timeout=200):
+		# Read the late response of an exchange that timed out, until the device is quiet
+		if self.router is not None:
+			return
+		while len(self.device.read(self.packetSize + 1, timeout)):
+			pass
+
 	def close(self):
+		if self.router is not None and not self.ownsDevice:
+			if self.opened:
+				self.router.close(self.channel)
+			self.opened = False
+			return
 		if self.opened:
 			try:
 				self.device.close()
@@ -146,24 +314,81 @@ class HIDDongleHIDAPI(Dongle, DongleWait):
 				pass
 		self.opened = False
 
+# Command data sent in a single extended length APDU, within what cards usually buffer
+EXTENDED_DATA_LENGTH = 2048
+
+def getATRHistoricalBytes(atr):
+	atr = bytearray(atr)
+	if len(atr) < 2:
+		return bytearray()
+	historicalLength = atr[1] & 0x0f
+	indicator = atr[1] >> 4
+	offset = 2
+	while True:
+		for mask in [ 0x01, 0x02, 0x04 ]:
+			if indicator & mask:
+				offset += 1
+		if not indicator & 0x08:
+			break
+		if offset >= len(atr):
+			return bytearray()
+		indicator = atr[offset] >> 4
+		offset += 1
+	return atr[offset : offset + historicalLength]
+
+def atrSupportsExtendedLength(atr):
+	"""Look for the extended Lc and Le bit in the card capabilities of the ATR historical bytes
+	(ISO 7816-4 compact TLV, tag 7)"""
+	historical = getATRHistoricalBytes(atr)
+	if len(historical) == 0 or historical[0] not in [ 0x00, 0x80 ]:
+		return False
+	end = len(historical) - 3 if historical[0] == 0x00 else len(historical)
+	offset = 1
+	while offset < end:
+		tag = historical[offset] >> 4
+		length = historical[offset] & 0x0f
+		if tag == 0x07 and length >= 3 and offset + 3 < len(historical):
+			return (historical[offset + 3] & 0x40) != 0
+		offset += 1 + length
+	return False
+
 class DongleSmartcard(Dongle):
+	"""PC/SC dongle. extendedLength is detected from the ATR when not given, it requires T=1"""
 
-	def __init__(self, device, debug=False):
+	def __init__(self, device, debug=False, extendedLength=None, maxDataLength=EXTENDED_DATA_LENGTH):
 		self.device = device
 		self.debug = debug
 		self.waitImpl = self
 		self.opened = True
+		if extendedLength is None:
+			try:
+				extendedLength = (device.getProtocol() == CardConnection.T1_protocol) and atrSupportsExtendedLength(device.getATR())
+			except Exception:
+				extendedLength = False
+		self.maxDataLength = maxDataLength if extendedLength else 255
+
+	def getMaxDataLength(self):
+		return self.maxDataLength
 
 	def exchange(self, apdu, timeout=20000):
+		if self.observers:
+			return self.observe(self.transmit, apdu, timeout)
+		return self.transmit(apdu, timeout)
+
+	def transmit(self, apdu, timeout=20000, event=None):
 		if self.debug:
 			print("=> %s" % hexlify(apdu))
-		response, sw1, sw2 = self.device.transmit(toBytes(hexlify(apdu)))
+		response, sw1, sw2 = self.device.transmit(list(bytearray(apdu)))
+		response = bytearray(response)
 		sw = (sw1 << 8) | sw2
+		if event is not None:
+			event.responseSize = len(response)
+			event.sw = sw
 		if self.debug:
-			print("<= %s%.2x" % (toHexString(response).replace(" ", ""), sw))
+			print("<= %s%.2x" % (hexlify(response), sw))
 		if sw != 0x9000:
 			raise BTChipException("Invalid status %04x" % sw, sw)
-		return bytearray(response)
+		return response
 
 	def close(self):
 		if self.opened:
@@ -173,82 +398,590 @@ class DongleSmartcard(Dongle):
 				pass
 		self.opened = False
 
+PROXY_V2_MAGIC = b"\xff\xff\xff\xffBTP\x02"
+PROXY_SHM_MAGIC = b"\xff\xff\xff\xffBTP\x03"
+
+def connectProxy(server, port):
+	"""Socket to a proxy, server is a host name or unix:<path> for a proxy on the same host"""
+	if server.startswith("unix:"):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		address = server[5:]
+	else:
+		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		address = (server, port)
+	try:
+		sock.connect(address)
+	except:
+		sock.close()
+		raise BTChipTransportException("Proxy connection failed")
+	if sock.family == socket.AF_INET:
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	return sock
+
+def recvExactly(sock, view):
+	offset = 0
+	while offset < len(view):
+		size = sock.recv_into(view[offset:])
+		if size == 0:
+			raise BTChipTransportException("Proxy connection closed")
+		offset += size
+
 class DongleServer(Dongle):
 
 	def __init__(self, server, port, debug=False):
 		self.server = server
 		self.port = port
 		self.debug = debug
-		self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.buffer = bytearray(4096)
+		self.socket = connectProxy(server, port)
+
+	def receive(self, size):
+		if len(self.buffer) < size:
+			self.buffer = bytearray(size)
+		recvExactly(self.socket, memoryview(self.buffer)[0:size])
+
+	def exchange(self, apdu, timeout=20000):
+		if self.observers:
+			return self.observe(self.transmit, apdu, timeout)
+		return self.transmit(apdu, timeout)
+
+	def transmit(self, apdu, timeout=20000, event=None):
+		if self.debug:
+			print("=> %s" % hexlify(apdu))
+		if self.socket is None:
+			# Dropped after a failure, reconnect lazily
+			self.socket = connectProxy(self.server, self.port)
+		self.socket.settimeout(timeout / 1000.0)
 		try:
-			self.socket.connect((self.server, self.port))
+			self.socket.sendall(struct.pack(">I", len(apdu)) + bytes(apdu))
+			if event is not None:
+				event.written = clock()
+			self.receive(4)
+			if event is not None:
+				event.firstResponse = clock()
+			size = struct.unpack_from(">I", self.buffer)[0]
+			self.receive(size + 2)
+		except socket.timeout:
+			# A late response would be read by the next exchange
+			self.close()
+			raise BTChipTransportException("Timeout")
+		except (socket.error, BTChipTransportException):
+			self.close()
+			raise BTChipTransportException("Proxy connection closed")
+		response = self.buffer[0:size]
+		sw = struct.unpack_from(">H", self.buffer, size)[0]
+		if event is not None:
+			event.responseSize = size
+			event.sw = sw
+		if self.debug:
+			print("<= %s%.2x" % (hexlify(response), sw))
+		if sw != 0x9000:
+			raise BTChipException("Invalid status %04x" % sw, sw)
+		return response
+
+	def resync(self, timeout=200):
+		# The connection is closed after a timeout and may have been lost, open a new one
+		self.close()
+		self.socket = connectProxy(self.server, self.port)
+
+	def close(self):
+		if self.socket is None:
+			return
+		try:
+			self.socket.close()
 		except:
-			raise BTChipException("Proxy connection failed")
+			pass
+		self.socket = None
+
+class DongleServerRequest(object):
+
+	def __init__(self, connection):
+		self.connection = connection
+		self.requestId = None
+		self.event = threading.Event()
+		self.response = None
+		self.sw = None
+		self.error = None
+
+	def complete(self, response, sw):
+		self.response = response
+		self.sw = sw
+		self.event.set()
+
+	def fail(self, error):
+		self.error = error
+		self.event.set()
+
+	def result(self, timeout=20000):
+		if not self.event.wait(timeout / 1000.0):
+			self.connection.cancel(self.requestId)
+			raise BTChipTransportException("Timeout")
+		if self.error is not None:
+			raise self.error
+		if self.sw != 0x9000:
+			raise BTChipException("Invalid status %04x" % self.sw, self.sw)
+		return self.response
+
+class DongleServerConnection(object):
+	"""Connection to a proxy speaking protocol v2, which tags each request with an ID and a
+	session. Requests of a session are run in order by the proxy, several sessions and
+	several requests in flight can share the connection"""
+
+	def __init__(self, server, port):
+		self.server = server
+		self.port = port
+		self.socket = connectProxy(server, port)
+		try:
+			self.socket.sendall(PROXY_V2_MAGIC)
+			magic = bytearray(len(PROXY_V2_MAGIC))
+			recvExactly(self.socket, memoryview(magic))
+		except (socket.error, BTChipException):
+			self.socket.close()
+			raise BTChipTransportException("Proxy connection failed")
+		if magic != PROXY_V2_MAGIC:
+			self.socket.close()
+			raise BTChipException("Proxy does not support protocol v2")
+		self.lock = threading.Lock()
+		self.sendLock = threading.Lock()
+		self.pending = {}
+		self.nextRequestId = 1
+		self.nextSession = 0
+		self.error = None
+		self.thread = threading.Thread(target=self.run, name="btchip-proxy-reader")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def openSession(self, debug=False, closeConnection=False):
+		with self.lock:
+			session = self.nextSession
+			self.nextSession = (self.nextSession + 1) & 0xffff
+		return DongleServerSession(self, session, debug, closeConnection)
+
+	def submit(self, session, apdu):
+		request = DongleServerRequest(self)
+		with self.lock:
+			if self.error is not None:
+				raise self.error
+			request.requestId = self.nextRequestId
+			self.nextRequestId = (self.nextRequestId + 1) & 0xffffffff
+			self.pending[request.requestId] = request
+		frame = struct.pack(">IIH", len(apdu), request.requestId, session) + bytes(apdu)
+		try:
+			with self.sendLock:
+				self.socket.sendall(frame)
+		except socket.error:
+			self.cancel(request.requestId)
+			raise BTChipTransportException("Proxy connection closed")
+		return request
+
+	def cancel(self, requestId):
+		with self.lock:
+			self.pending.pop(requestId, None)
+
+	def run(self):
+		header = bytearray(12)
+		buffer = bytearray(4096)
+		try:
+			while True:
+				recvExactly(self.socket, memoryview(header))
+				size, requestId, session, sw = struct.unpack_from(">IIHH", header)
+				if len(buffer) < size:
+					buffer = bytearray(size)
+				recvExactly(self.socket, memoryview(buffer)[0:size])
+				with self.lock:
+					request = self.pending.pop(requestId, None)
+				if request is not None:
+					request.complete(buffer[0:size], sw)
+		except Exception as e:
+			if not isinstance(e, BTChipException):
+				e = BTChipTransportException("Proxy connection closed")
+			with self.lock:
+				self.error = e
+				pending = list(self.pending.values())
+				self.pending = {}
+			for request in pending:
+				request.fail(e)
+
+	def close(self):
+		try:
+			self.socket.shutdown(socket.SHUT_RDWR)
+			self.socket.close()
+		except:
+			pass
+		self.thread.join()
+
+class DongleServerSession(Dongle):
+
+	def __init__(self, connection, session, debug=False, closeConnection=False):
+		self.connection = connection
+		self.sessionId = session
+		self.debug = debug
+		self.closeConnection = closeConnection
+
+	def submit(self, apdu):
+		"""Send an APDU without waiting, the returned request gives the response"""
+		if self.debug:
+			print("=> %s" % hexlify(apdu))
+		return self.connection.submit(self.sessionId, apdu)
 
 	def exchange(self, apdu, timeout=20000):
+		if self.observers:
+			return self.observe(self.transmit, apdu, timeout)
+		return self.transmit(apdu, timeout)
+
+	def transmit(self, apdu, timeout=20000, event=None):
+		request = self.submit(apdu)
+		if event is not None:
+			event.written = clock()
+		return self.getResult(request, timeout, event)
+
+	def getResult(self, request, timeout, event=None):
+		try:
+			return request.result(timeout)
+		finally:
+			if event is not None and request.sw is not None:
+				event.responseSize = len(request.response)
+				event.sw = request.sw
+			if self.debug and request.sw is not None:
+				print("<= %s%.2x" % (hexlify(request.response), request.sw))
+
+	def exchangePipelined(self, apdus, timeout=20000):
+		"""Send all apdus before waiting for their responses and return the responses. The
+		proxy runs the requests of a session in order on its device, so a stream of APDUs costs
+		one round trip instead of one per APDU. Every response is waited for before the first
+		failure is raised, the next exchange is not mixed with the end of the stream"""
+		requests = []
+		try:
+			for apdu in apdus:
+				event = ExchangeEvent(self, apdu) if self.observers else None
+				requests.append((self.submit(apdu), event))
+				if event is not None:
+					event.written = clock()
+		finally:
+			responses = []
+			error = None
+			for request, event in requests:
+				try:
+					if error is not None and (not isinstance(error, BTChipException) or error.sw is None):
+						# The link failed, the other responses will not come back either
+						self.connection.cancel(request.requestId)
+						raise error
+					responses.append(self.getResult(request, timeout, event))
+					if event is not None:
+						event.response = responses[-1]
+				except Exception as e:
+					if event is not None:
+						event.error = e
+					if error is None:
+						error = e
+				if event is not None:
+					self.report(event)
+		if error is not None:
+			raise error
+		return responses
+
+	def close(self):
+		if self.closeConnection:
+			self.connection.close()
+			return
+		# An empty request ends the session, the proxy gives its device back
+		try:
+			self.connection.submit(self.sessionId, b"").result()
+		except BTChipException:
+			pass
+
+BROKER_OPEN = 0x01
+BROKER_EXCHANGE = 0x02
+BROKER_BEGIN = 0x03
+BROKER_END = 0x04
+BROKER_STATS = 0x05
+
+class DongleBroker(Dongle):
+	"""Dongle owned by a btchipBroker daemon and shared with other processes. Each exchange is
+	atomic, session() keeps the device for a whole multi-APDU operation"""
+
+	def __init__(self, path, device=0, priority=PRIORITY_NORMAL, debug=False, timeout=None):
+		self.path = path
+		self.device = device
+		self.priority = priority
+		self.debug = debug
+		self.sessionDepth = 0
+		self.buffer = bytearray(4096)
+		self.socket = None
+		self.connect(timeout)
+
+	def connect(self, timeout=None):
+		"""Connect to the broker and open the device, within timeout seconds"""
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		sock.settimeout(timeout)
+		try:
+			sock.connect(self.path)
+		except:
+			sock.close()
+			raise BTChipTransportException("Broker connection failed")
+		self.socket = sock
+		self.request(BROKER_OPEN, timeout=timeout)
+
+	def request(self, opcode, payload=b"", priority=None, timeout=None):
+		if priority is None:
+			priority = self.priority
+		if self.socket is None:
+			raise BTChipTransportException("Broker connection closed")
+		self.socket.settimeout(max(timeout, 0.001) if timeout is not None else None)
+		try:
+			self.socket.sendall(struct.pack(">IBBH", len(payload), opcode, priority, self.device) + bytes(payload))
+			recvExactly(self.socket, memoryview(self.buffer)[0:6])
+			size, sw = struct.unpack_from(">IH", self.buffer)
+			if len(self.buffer) < size:
+				self.buffer = bytearray(size)
+			recvExactly(self.socket, memoryview(self.buffer)[0:size])
+		except socket.timeout:
+			# The broker gives the device back when the connection is closed
+			self.close()
+			raise BTChipTransportException("Timeout")
+		except (socket.error, BTChipException):
+			self.close()
+			raise BTChipTransportException("Broker connection closed")
+		response = self.buffer[0:size]
+		if opcode != BROKER_EXCHANGE and sw != 0x9000:
+			raise BTChipException("Broker request failed %04x" % sw, sw)
+		return response, sw
+
+	def exchange(self, apdu, timeout=20000):
+		if self.observers:
+			return self.observe(self.transmit, apdu, timeout)
+		return self.transmit(apdu, timeout)
+
+	def transmit(self, apdu, timeout=20000, event=None):
 		if self.debug:
-			print("=> %s" % hexlify(apdu))		
-		self.socket.send(struct.pack(">I", len(apdu)))
-		self.socket.send(apdu)
-		size = struct.unpack(">I", self.socket.recv(4))[0]
-		response = self.socket.recv(size)
-		sw = struct.unpack(">H", self.socket.recv(2))[0]
+			print("=> %s" % hexlify(apdu))
+		response, sw = self.request(BROKER_EXCHANGE, apdu, timeout=timeout / 1000.0)
+		if event is not None:
+			event.responseSize = len(response)
+			event.sw = sw
 		if self.debug:
 			print("<= %s%.2x" % (hexlify(response), sw))
 		if sw != 0x9000:
 			raise BTChipException("Invalid status %04x" % sw, sw)
-		return bytearray(response)
+		return response
+
+	@contextmanager
+	def session(self, priority=None, timeout=None):
+		if self.sessionDepth == 0:
+			self.request(BROKER_BEGIN, priority=priority, timeout=timeout)
+		self.sessionDepth += 1
+		try:
+			yield self
+		finally:
+			self.sessionDepth -= 1
+			# A lost connection gave the device back already
+			if self.sessionDepth == 0 and self.socket is not None:
+				self.request(BROKER_END)
+
+	def getStatistics(self):
+		response, sw = self.request(BROKER_STATS)
+		return json.loads(bytes(response).decode('utf-8'))
+
+	def resync(self, timeout=200):
+		# The connection is closed after a timeout and may have been lost, open a new one
+		self.close()
+		self.connect()
 
 	def close(self):
+		if self.socket is None:
+			return
 		try:
 			self.socket.close()
 		except:
 			pass
+		self.socket = None
 
-def getDongle(debug=False):
-	dev = None
-	hidDevicePath = None
-	ledger = False	
+def getHIDDongleType(hidDevice):
+	"""Return None if the HID device is not a dongle, else whether it uses Ledger framing"""
+	if hidDevice['vendor_id'] == 0x2581 and hidDevice['product_id'] == 0x2b7c:
+		return False
+	if hidDevice['vendor_id'] == 0x2581 and hidDevice['product_id'] == 0x3b7c:
+		return True
+	if hidDevice['vendor_id'] == 0x2581 and hidDevice['product_id'] == 0x4b7c:
+		return True
+	if hidDevice['vendor_id'] == 0x2c97:
+		if ('interface_number' in hidDevice and hidDevice['interface_number'] == 0) or ('usage_page' in hidDevice and hidDevice['usage_page'] == 0xffa0):
+			return True
+	if hidDevice['vendor_id'] == 0x2581 and hidDevice['product_id'] == 0x1807:
+		return False
+	return None
+
+def enumerateHIDDongles():
+	result = []
 	if HID:
 		for hidDevice in hid.enumerate(0, 0):
-			if hidDevice['vendor_id'] == 0x2581 and hidDevice['product_id'] == 0x2b7c:
-				hidDevicePath = hidDevice['path']
-			if hidDevice['vendor_id'] == 0x2581 and hidDevice['product_id'] == 0x3b7c:
-				hidDevicePath = hidDevice['path']			
-				ledger = True
-			if hidDevice['vendor_id'] == 0x2581 and hidDevice['product_id'] == 0x4b7c:
-				hidDevicePath = hidDevice['path']
-				ledger = True
-			if hidDevice['vendor_id'] == 0x2c97:
-				if ('interface_number' in hidDevice and hidDevice['interface_number'] == 0) or ('usage_page' in hidDevice and hidDevice['usage_page'] == 0xffa0):
-					hidDevicePath = hidDevice['path']
-					ledger = True
-			if hidDevice['vendor_id'] == 0x2581 and hidDevice['product_id'] == 0x1807:
-				hidDevicePath = hidDevice['path']
-	if hidDevicePath is not None:
-		dev = hid.device()
-		dev.open_path(hidDevicePath)
-		dev.set_nonblocking(True)
-		return HIDDongleHIDAPI(dev, ledger, debug)
+			ledger = getHIDDongleType(hidDevice)
+			if ledger is not None:
+				result.append({ 'type': 'hid', 'path': hidDevice['path'], 'ledger': ledger, 'serial': hidDevice.get('serial_number') })
+	return result
+
+def selectReader(reader):
+	"""Connect to a PC/SC reader and select the wallet application, return the connection or None"""
+	try:
+		connection = reader.createConnection()
+		connection.connect()
+		response, sw1, sw2 = connection.transmit(toBytes("00A4040010FF4C4547522E57414C5430312E493031"))
+		sw = (sw1 << 8) | sw2
+		if sw == 0x9000:
+			return connection
+		connection.disconnect()
+	except:
+		pass
+	return None
 
-	if SCARD:
-		connection = None
-		for reader in readers():
+# Time given to each reader to connect and answer the SELECT, readers are probed concurrently
+PROBE_TIMEOUT = 2.0
+
+# File remembering the reader holding the dongle so that it is tried alone first on the next
+# start. Nothing is written unless BTCHIP_READER_CACHE names the file
+READER_CACHE = os.getenv("BTCHIP_READER_CACHE")
+
+def loadReaderCache():
+	if READER_CACHE is None:
+		return None
+	try:
+		with open(READER_CACHE, "r") as cacheFile:
+			return cacheFile.read().strip() or None
+	except (IOError, OSError):
+		return None
+
+def saveReaderCache(name):
+	if READER_CACHE is None:
+		return
+	try:
+		temporaryPath = "%s.%d" % (READER_CACHE, os.getpid())
+		with open(temporaryPath, "w") as cacheFile:
+			cacheFile.write(name)
+		os.rename(temporaryPath, READER_CACHE)
+	except (IOError, OSError):
+		pass
+
+def probeReaders(readerList, timeout=PROBE_TIMEOUT):
+	"""SELECT the wallet on all readers concurrently, return the (reader, connection) pairs that
+	answered within timeout seconds in the order of readerList. Connections answering late are
+	closed by their probe thread"""
+	lock = threading.Lock()
+	results = [ None ] * len(readerList)
+	state = { 'expired': False }
+	def probe(index, reader):
+		connection = selectReader(reader)
+		with lock:
+			if not state['expired']:
+				results[index] = connection
+				return
+		if connection is not None:
 			try:
-				connection = reader.createConnection()
-				connection.connect()				
-				response, sw1, sw2 = connection.transmit(toBytes("00A4040010FF4C4547522E57414C5430312E493031"))																  
-				sw = (sw1 << 8) | sw2
-				if sw == 0x9000:
-					break
-				else:
-					connection.disconnect()
-					connection = None
+				connection.disconnect()
 			except:
-				connection = None
 				pass
-		if connection is not None:
-			return DongleSmartcard(connection, debug)
-	if (os.getenv("LEDGER_PROXY_ADDRESS") is not None) and (os.getenv("LEDGER_PROXY_PORT") is not None):
-		return DongleServer(os.getenv("LEDGER_PROXY_ADDRESS"), int(os.getenv("LEDGER_PROXY_PORT")), debug)
+	threads = []
+	for index, reader in enumerate(readerList):
+		thread = threading.Thread(target=probe, args=(index, reader), name="btchip-probe")
+		thread.daemon = True
+		thread.start()
+		threads.append(thread)
+	deadline = time.time() + timeout
+	for thread in threads:
+		thread.join(max(deadline - time.time(), 0))
+	with lock:
+		state['expired'] = True
+		return [ (reader, connection) for reader, connection in zip(readerList, results) if connection is not None ]
+
+def findSmartcardConnections(findAll=False, timeout=PROBE_TIMEOUT):
+	"""Connections to the readers holding a dongle, the cached reader first. Unless findAll is
+	set, the cached reader is probed alone and the other readers only if it does not answer"""
+	if not SCARD:
+		return []
+	readerList = readers()
+	cached = loadReaderCache()
+	ordered = [ reader for reader in readerList if str(reader) == cached ] + [ reader for reader in readerList if str(reader) != cached ]
+	if not findAll and (len(ordered) != 0) and (str(ordered[0]) == cached):
+		found = probeReaders(ordered[0:1], timeout)
+		if len(found) != 0:
+			return found
+		ordered = ordered[1:]
+	found = probeReaders(ordered, timeout)
+	if len(found) != 0 and str(found[0][0]) != cached:
+		saveReaderCache(str(found[0][0]))
+	if not findAll:
+		for reader, connection in found[1:]:
+			connection.disconnect()
+		found = found[0:1]
+	return found
+
+def enumerateSmartcardDongles():
+	result = []
+	for reader, connection in findSmartcardConnections(True):
+		connection.disconnect()
+		result.append({ 'type': 'smartcard', 'reader': str(reader) })
+	return result
+
+def getSmartcardDongles(debug=False, timeout=PROBE_TIMEOUT):
+	"""Open every PC/SC dongle"""
+	return [ DongleSmartcard(connection, debug) for reader, connection in findSmartcardConnections(True, timeout) ]
+
+def enumerateProxyDongles():
+	# LEDGER_PROXY_ADDRESS can be unix:<path>, LEDGER_PROXY_PORT is then not needed. Protocol 3
+	# (shared memory rings) is only available through a unix socket
+	address = os.getenv("LEDGER_PROXY_ADDRESS")
+	if (address is not None) and ((os.getenv("LEDGER_PROXY_PORT") is not None) or address.startswith("unix:")):
+		return [ { 'type': 'proxy', 'server': address, 'port': int(os.getenv("LEDGER_PROXY_PORT", "0")), 'protocol': int(os.getenv("LEDGER_PROXY_PROTOCOL", "1")) } ]
+	return []
+
+def enumerateBrokerDongles():
+	if os.getenv("BTCHIP_BROKER_SOCKET") is not None:
+		return [ { 'type': 'broker', 'path': os.getenv("BTCHIP_BROKER_SOCKET"), 'device': int(os.getenv("BTCHIP_BROKER_DEVICE", "0")) } ]
+	return []
+
+def enumerateDongles():
+	"""List every reachable dongle as a descriptor that can be passed to openDongle"""
+	# A broker owns the devices when it is configured, they can't be opened directly
+	brokerDongles = enumerateBrokerDongles()
+	if len(brokerDongles) != 0:
+		return brokerDongles
+	return enumerateHIDDongles() + enumerateSmartcardDongles() + enumerateProxyDongles()
+
+def openDongle(descriptor, debug=False):
+	if descriptor['type'] == 'hid':
+		if not HID:
+			raise BTChipException("HID support not available")
+		dev = hid.device()
+		dev.open_path(descriptor['path'])
+		dev.set_nonblocking(True)
+		return HIDDongleHIDAPI(dev, descriptor['ledger'], debug, descriptor.get('packetSize', DEFAULT_PACKET_SIZE))
+	if descriptor['type'] == 'smartcard':
+		if SCARD:
+			for reader in readers():
+				if str(reader) == descriptor['reader']:
+					connection = selectReader(reader)
+					if connection is not None:
+						return DongleSmartcard(connection, debug)
+		raise BTChipException("Reader not available")
+	if descriptor['type'] == 'broker':
+		return DongleBroker(descriptor['path'], descriptor['device'], debug=debug)
+	if descriptor['type'] == 'proxy':
+		if descriptor.get('protocol', 1) == 2:
+			return DongleServerConnection(descriptor['server'], descriptor['port']).openSession(debug, True)
+		if descriptor.get('protocol', 1) == 3:
+			from .btchipSharedMemory import DongleSharedMemory
+			return DongleSharedMemory(descriptor['server'], debug)
+		return DongleServer(descriptor['server'], descriptor['port'], debug)
+	raise BTChipException("Invalid dongle type")
+
+def getDongle(debug=False):
+	# A broker owns the devices when it is configured, they can't be opened directly
+	for descriptor in enumerateBrokerDongles():
+		return openDongle(descriptor, debug)
+	hidDongles = enumerateHIDDongles()
+	if len(hidDongles) != 0:
+		return openDongle(hidDongles[-1], debug)
+	for reader, connection in findSmartcardConnections():
+		return DongleSmartcard(connection, debug)
+	for descriptor in enumerateProxyDongles():
+		return openDongle(descriptor, debug)
 	raise BTChipException("No dongle found")
@@ -0,0 +1,206 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+# asyncio transports - Python 3 only, not imported by the rest of the package
+
+from abc import ABCMeta, abstractmethod
+from .btchipComm import *
+from .btchipException import *
+from binascii import hexlify
+import asyncio
+import contextlib
+import queue
+import struct
+import threading
+
+class AsyncDongle(object):
+	__metaclass__ = ABCMeta
+
+	@abstractmethod
+	async def exchange(self, apdu, timeout=20000):
+		pass
+
+	@abstractmethod
+	async def close(self):
+		pass
+
+	def getMaxDataLength(self):
+		return 255
+
+	@contextlib.asynccontextmanager
+	async def session(self, priority=None, timeout=None):
+		# Keeps the device for all exchanges of the block on dongles shared between clients
+		yield self
+
+def _setFutureResult(future, result):
+	if not future.done():
+		future.set_result(result)
+
+def _setFutureException(future, exception):
+	if not future.done():
+		future.set_exception(exception)
+
+class AsyncThreadedDongle(AsyncDongle):
+	"""Drive a blocking Dongle from a dedicated I/O thread, results are handed back to the
+	calling event loop through futures so the loop never blocks on the device"""
+
+	def __init__(self, dongle):
+		self.dongle = dongle
+		self.requests = queue.Queue()
+		self.closed = False
+		self.thread = threading.Thread(target=self.run, name="btchip-io-%s" % type(dongle).__name__)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def getMaxDataLength(self):
+		return getattr(self.dongle, 'getMaxDataLength', lambda: 255)()
+
+	def run(self):
+		while True:
+			request = self.requests.get()
+			if request is None:
+				break
+			loop, future, function, args = request
+			if future.cancelled():
+				continue
+			try:
+				result = function(*args)
+			except Exception as e:
+				loop.call_soon_threadsafe(_setFutureException, future, e)
+			else:
+				loop.call_soon_threadsafe(_setFutureResult, future, result)
+
+	def submit(self, function, *args):
+		# Requests queued after close would never be run
+		if self.closed:
+			raise BTChipTransportException("Dongle closed")
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		self.requests.put((loop, future, function, args))
+		return future
+
+	async def exchange(self, apdu, timeout=20000):
+		return await self.submit(self.dongle.exchange, apdu, timeout)
+
+	@contextlib.asynccontextmanager
+	async def session(self, priority=None, timeout=None):
+		# The session of the dongle is entered and left on the I/O thread, like its exchanges
+		manager = dongleSession(self.dongle, priority, timeout)
+		await self.submit(manager.__enter__)
+		try:
+			yield self
+		finally:
+			await self.submit(manager.__exit__, None, None, None)
+
+	async def close(self):
+		if not self.closed:
+			future = self.submit(self.dongle.close)
+			self.closed = True
+			self.requests.put(None)
+			await future
+
+class AsyncHIDDongleHIDAPI(AsyncThreadedDongle):
+
+	def __init__(self, dongle):
+		if not isinstance(dongle, HIDDongleHIDAPI):
+			raise BTChipException("Invalid dongle type")
+		AsyncThreadedDongle.__init__(self, dongle)
+
+class AsyncDongleSmartcard(AsyncThreadedDongle):
+
+	def __init__(self, dongle):
+		if not isinstance(dongle, DongleSmartcard):
+			raise BTChipException("Invalid dongle type")
+		AsyncThreadedDongle.__init__(self, dongle)
+
+class AsyncDongleServer(AsyncDongle):
+
+	def __init__(self, server, port, debug=False):
+		self.server = server
+		self.port = port
+		self.debug = debug
+		self.reader = None
+		self.writer = None
+		self.lock = asyncio.Lock()
+
+	async def open(self):
+		try:
+			if self.server.startswith("unix:"):
+				self.reader, self.writer = await asyncio.open_unix_connection(self.server[5:])
+			else:
+				self.reader, self.writer = await asyncio.open_connection(self.server, self.port)
+		except OSError:
+			raise BTChipTransportException("Proxy connection failed")
+
+	async def exchange(self, apdu, timeout=20000):
+		async with self.lock:
+			if self.writer is None:
+				await self.open()
+			if self.debug:
+				print("=> %s" % hexlify(apdu))
+			try:
+				self.writer.write(struct.pack(">I", len(apdu)) + bytes(apdu))
+				response, sw = await asyncio.wait_for(self.readResponse(), timeout / 1000.0)
+			except asyncio.TimeoutError:
+				# The pending response would be read by the next exchange, drop the connection
+				await self.close()
+				raise BTChipTransportException("Timeout")
+			except (asyncio.IncompleteReadError, OSError):
+				await self.close()
+				raise BTChipTransportException("Proxy connection closed")
+			except BaseException:
+				# Cancelled by the caller with the response in flight, the next exchange reconnects
+				self.writer.close()
+				self.writer = None
+				raise
+			if self.debug:
+				print("<= %s%.2x" % (hexlify(response), sw))
+			if sw != 0x9000:
+				raise BTChipException("Invalid status %04x" % sw, sw)
+			return response
+
+	async def readResponse(self):
+		await self.writer.drain()
+		size = struct.unpack(">I", await self.reader.readexactly(4))[0]
+		response = bytearray(await self.reader.readexactly(size))
+		sw = struct.unpack(">H", await self.reader.readexactly(2))[0]
+		return response, sw
+
+	async def close(self):
+		if self.writer is not None:
+			try:
+				self.writer.close()
+				await self.writer.wait_closed()
+			except Exception:
+				pass
+			self.writer = None
+
+async def getAsyncDongle(debug=False):
+	dongle = await asyncio.get_running_loop().run_in_executor(None, getDongle, debug)
+	if isinstance(dongle, DongleServer):
+		dongle.close()
+		result = AsyncDongleServer(dongle.server, dongle.port, debug)
+		await result.open()
+		return result
+	if isinstance(dongle, DongleSmartcard):
+		return AsyncDongleSmartcard(dongle)
+	if isinstance(dongle, HIDDongleHIDAPI):
+		return AsyncHIDDongleHIDAPI(dongle)
+	# Broker, v2 session and shared memory handles block like the devices, give them a thread
+	return AsyncThreadedDongle(dongle)
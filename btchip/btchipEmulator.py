@@ -0,0 +1,579 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+# In-process emulation of the btchip wallet application, for tests and benchmarks without hardware
+
+from .btchipComm import *
+from .btchipException import *
+from .bitcoinVarint import *
+from .btchipHelpers import *
+from binascii import hexlify, unhexlify
+import ecdsa
+from ecdsa.curves import SECP256k1
+from ecdsa.util import sigencode_der
+from ecdsa.rfc6979 import generate_k
+import hashlib
+import hmac
+import os
+import struct
+import time
+
+# Seed used by the tests of this repository
+DEFAULT_SEED = bytearray(unhexlify("1762F9A3007DBC825D0DD9958B04880284E88F10C57CF569BB3DADF7B1027F2D"))
+
+CURVE_ORDER = SECP256k1.order
+BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+
+SW_OK = 0x9000
+SW_WRONG_LENGTH = 0x6700
+SW_SECURITY_STATUS_NOT_SATISFIED = 0x6982
+SW_CONDITIONS_OF_USE_NOT_SATISFIED = 0x6985
+SW_INCORRECT_DATA = 0x6a80
+SW_INCORRECT_P1_P2 = 0x6b00
+SW_INS_NOT_SUPPORTED = 0x6d00
+SW_CLA_NOT_SUPPORTED = 0x6e00
+
+class EmulatorError(Exception):
+
+	def __init__(self, sw):
+		self.sw = sw
+
+def sha256(data):
+	return hashlib.sha256(bytes(data)).digest()
+
+def doubleSha256(data):
+	return sha256(sha256(data))
+
+def hash160(data):
+	return hashlib.new('ripemd160', sha256(data)).digest()
+
+def base58CheckEncode(version, payload):
+	data = bytearray([ version ]) + bytearray(payload)
+	data += bytearray(doubleSha256(data)[0:4])
+	value = int(hexlify(bytes(data)), 16)
+	result = ""
+	while value > 0:
+		value, remainder = divmod(value, 58)
+		result = BASE58_ALPHABET[remainder] + result
+	for byte in data:
+		if byte != 0:
+			break
+		result = BASE58_ALPHABET[0] + result
+	return result
+
+def base58CheckDecode(address):
+	value = 0
+	for character in address:
+		value = value * 58 + BASE58_ALPHABET.index(character)
+	data = bytearray(unhexlify("%x" % value if len("%x" % value) % 2 == 0 else "0%x" % value)) if value > 0 else bytearray()
+	for character in address:
+		if character != BASE58_ALPHABET[0]:
+			break
+		data = bytearray([ 0x00 ]) + data
+	if len(data) < 5 or bytearray(doubleSha256(data[:-4])[0:4]) != data[-4:]:
+		raise EmulatorError(SW_INCORRECT_DATA)
+	return data[0], data[1:-4]
+
+def getPublicPoint(privateKey):
+	return SigningKey(privateKey).getVerifyingKey().pubkey.point
+
+def serializePoint(point, compressed=True):
+	x = bytearray(unhexlify("%064x" % point.x()))
+	if compressed:
+		return bytearray([ 0x03 if (point.y() & 1) else 0x02 ]) + x
+	return bytearray([ 0x04 ]) + x + bytearray(unhexlify("%064x" % point.y()))
+
+class SigningKey(object):
+
+	def __init__(self, secret):
+		self.secret = secret
+		self.key = ecdsa.SigningKey.from_secret_exponent(secret, curve=SECP256k1)
+
+	def getVerifyingKey(self):
+		return self.key.get_verifying_key()
+
+	def sign(self, digest):
+		"""Deterministic (RFC 6979) low-S signature of a 32 bytes digest, DER encoded with the
+		parity of R in the low bit of the first byte like the dongle does"""
+		k = generate_k(CURVE_ORDER, self.secret, hashlib.sha256, bytes(digest))
+		r, s = self.key.sign_digest(bytes(digest), sigencode=lambda r, s, order: (r, s), k=k)
+		parity = (SECP256k1.generator * k).y() & 1
+		if s > CURVE_ORDER // 2:
+			s = CURVE_ORDER - s
+			parity ^= 1
+		signature = bytearray(sigencode_der(r, s, CURVE_ORDER))
+		signature[0] |= parity
+		return signature
+
+class BIP32Node(object):
+
+	def __init__(self, privateKey, chainCode):
+		self.privateKey = privateKey
+		self.chainCode = chainCode
+		self.publicPoint = getPublicPoint(privateKey)
+
+	@classmethod
+	def fromSeed(cls, seed):
+		digest = hmac.new(b"Bitcoin seed", bytes(seed), hashlib.sha512).digest()
+		return cls(int(hexlify(digest[0:32]), 16), digest[32:])
+
+	def derive(self, index):
+		if index & 0x80000000:
+			data = b"\x00" + unhexlify("%064x" % self.privateKey)
+		else:
+			data = bytes(serializePoint(self.publicPoint))
+		digest = hmac.new(self.chainCode, data + struct.pack(">I", index), hashlib.sha512).digest()
+		tweak = int(hexlify(digest[0:32]), 16)
+		if tweak >= CURVE_ORDER:
+			raise EmulatorError(SW_INCORRECT_DATA)
+		return BIP32Node((tweak + self.privateKey) % CURVE_ORDER, digest[32:])
+
+class StreamParser(object):
+	"""Run a generator parser over data received in chunks of any size. The generator yields
+	the number of bytes it needs next and receives them"""
+
+	def __init__(self, parser):
+		self.parser = parser
+		self.buffer = bytearray()
+		self.offset = 0
+		self.done = False
+		self.needed = next(parser)
+
+	def feed(self, data):
+		if self.done and len(data) != 0:
+			raise EmulatorError(SW_INCORRECT_DATA)
+		self.buffer.extend(data)
+		while (not self.done) and (len(self.buffer) - self.offset >= self.needed):
+			chunk = bytes(self.buffer[self.offset : self.offset + self.needed])
+			self.offset += self.needed
+			try:
+				self.needed = self.parser.send(chunk)
+			except StopIteration:
+				self.done = True
+		if self.done and self.offset != len(self.buffer):
+			raise EmulatorError(SW_INCORRECT_DATA)
+		return self.done
+
+def varintExtraSize(first):
+	if first < 0xfd:
+		return 0
+	return { 0xfd: 2, 0xfe: 4, 0xff: 8 }[first]
+
+def decodeVarint(first, extra):
+	if first < 0xfd:
+		return first
+	return struct.unpack({ 0xfd: "<H", 0xfe: "<I", 0xff: "<Q" }[first], bytes(extra))[0]
+
+def transactionParser(state):
+	# Previous transaction streamed by getTrustedInput, preceded by the output index
+	state['index'] = struct.unpack(">I", (yield 4))[0]
+	yield 4
+	first = bytearray((yield 1))[0]
+	inputCount = decodeVarint(first, (yield varintExtraSize(first)))
+	for i in range(inputCount):
+		yield 36
+		first = bytearray((yield 1))[0]
+		yield decodeVarint(first, (yield varintExtraSize(first)))
+		yield 4
+	first = bytearray((yield 1))[0]
+	outputCount = decodeVarint(first, (yield varintExtraSize(first)))
+	state['amounts'] = []
+	for i in range(outputCount):
+		state['amounts'].append((yield 8))
+		first = bytearray((yield 1))[0]
+		yield decodeVarint(first, (yield varintExtraSize(first)))
+	yield 4
+
+def inputsParser(emulator, state, inputCount):
+	# Inputs streamed by startUntrustedTransaction
+	for i in range(inputCount):
+		inputType = bytearray((yield 1))[0]
+		if inputType == 0x01:
+			value = bytearray((yield bytearray((yield 1))[0]))
+			if not emulator.checkTrustedInput(value):
+				raise EmulatorError(SW_INCORRECT_DATA)
+			prevOut = value[4:40]
+			amount = value[40:48]
+		elif inputType == 0x02:
+			value = bytearray((yield 44))
+			prevOut = value[0:36]
+			amount = value[36:44]
+		elif inputType == 0x00:
+			if state['segwit']:
+				raise EmulatorError(SW_INCORRECT_DATA)
+			prevOut = bytearray((yield 36))
+			amount = None
+		else:
+			raise EmulatorError(SW_INCORRECT_DATA)
+		first = bytearray((yield 1))[0]
+		script = bytearray((yield decodeVarint(first, (yield varintExtraSize(first)))))
+		sequence = bytearray((yield 4))
+		state['inputs'].append({ 'prevOut': prevOut, 'amount': amount, 'script': script, 'sequence': sequence })
+
+class EmulatedDongle(Dongle):
+	"""Software implementation of the btchip APDUs used by btchip.py, signing with keys derived
+	from a BIP 32 seed. Each exchange costs latency seconds plus the APDU and response sizes
+	divided by throughput bytes per second; that time is slept when sleep is set and always
+	accumulated in elapsed, so clients can be measured deterministically. With maxDataLength above
+	255, extended length APDUs are accepted"""
+
+	def __init__(self, seed=DEFAULT_SEED, pin="1234", firmwareVersion=(1, 4, 3), latency=0.0, throughput=None, sleep=True, maxDataLength=255, debug=False):
+		self.seed = bytearray(seed)
+		self.pin = bytearray(pin.encode('utf-8') if isinstance(pin, str) else pin)
+		self.firmwareVersion = firmwareVersion
+		self.latency = latency
+		self.throughput = throughput
+		self.sleep = sleep
+		self.maxDataLength = maxDataLength
+		self.debug = debug
+		self.keyVersion = 0x00
+		self.keyVersionP2SH = 0x05
+		self.trustedInputKey = bytearray(os.urandom(16))
+		self.pinAttempts = 3
+		self.nodes = {}
+		self.elapsed = 0.0
+		self.exchanges = 0
+		self.bytesIn = 0
+		self.bytesOut = 0
+		self.expectedLength = 0
+		self.trustedInputParser = None
+		self.trustedInputState = None
+		self.transaction = None
+		self.inputParser = None
+		self.outputData = None
+		self.message = None
+
+	def getMaxDataLength(self):
+		return self.maxDataLength
+
+	def close(self):
+		pass
+
+	def exchange(self, apdu, timeout=20000):
+		if self.observers:
+			return self.observe(self.transmit, apdu, timeout)
+		return self.transmit(apdu, timeout)
+
+	def transmit(self, apdu, timeout=20000, event=None):
+		apdu = bytearray(apdu)
+		if self.debug:
+			print("=> %s" % hexlify(apdu))
+		try:
+			# A 5 bytes APDU carries Le in P3 (GET_RANDOM), otherwise P3 is Lc
+			if len(apdu) < 5:
+				raise EmulatorError(SW_WRONG_LENGTH)
+			if self.maxDataLength > 255 and len(apdu) > 7 and apdu[4] == 0x00:
+				dataOffset = 7
+				dataLength = (apdu[5] << 8) | apdu[6]
+			else:
+				dataOffset = 5
+				dataLength = apdu[4] if len(apdu) > 5 else 0
+			if len(apdu) != dataOffset + dataLength or dataLength > self.maxDataLength:
+				raise EmulatorError(SW_WRONG_LENGTH)
+			self.expectedLength = apdu[4] if len(apdu) == 5 else 0
+			response = self.process(apdu[1], apdu[2], apdu[3], apdu[dataOffset:]) if apdu[0] == 0xe0 else None
+			if response is None:
+				raise EmulatorError(SW_CLA_NOT_SUPPORTED if apdu[0] != 0xe0 else SW_INS_NOT_SUPPORTED)
+			sw = SW_OK
+		except EmulatorError as e:
+			response = bytearray()
+			sw = e.sw
+		cost = self.latency
+		if self.throughput:
+			cost += float(len(apdu) + len(response) + 2) / self.throughput
+		self.elapsed += cost
+		self.exchanges += 1
+		self.bytesIn += len(apdu)
+		self.bytesOut += len(response) + 2
+		if self.sleep and cost > 0:
+			time.sleep(cost)
+		if event is not None:
+			event.responseSize = len(response)
+			event.sw = sw
+		if self.debug:
+			print("<= %s%.2x" % (hexlify(response), sw))
+		if sw != SW_OK:
+			raise BTChipException("Invalid status %04x" % sw, sw)
+		return response
+
+	def process(self, ins, p1, p2, data):
+		handler = {
+			0x20: self.setup,
+			0x22: self.verifyPin,
+			0x28: self.setKeymap,
+			0x40: self.getWalletPublicKey,
+			0x42: self.getTrustedInput,
+			0x44: self.hashInputStart,
+			0x46: self.hashInputFinalize,
+			0x48: self.hashSign,
+			0x4a: self.hashInputFinalizeFull,
+			0x4e: self.signMessage,
+			0xc0: self.getRandom,
+			0xc4: self.getFirmwareVersion
+		}.get(ins)
+		if handler is None:
+			return None
+		return handler(p1, p2, data)
+
+	def getNode(self, donglePath):
+		if len(donglePath) == 0 or len(donglePath) != 1 + 4 * donglePath[0]:
+			raise EmulatorError(SW_INCORRECT_DATA)
+		path = tuple(struct.unpack(">%dI" % donglePath[0], bytes(donglePath[1:])))
+		if path not in self.nodes:
+			node = BIP32Node.fromSeed(self.seed)
+			for index in path:
+				node = node.derive(index)
+			self.nodes[path] = node
+		return self.nodes[path]
+
+	def readPath(self, data):
+		if len(data) == 0 or len(data) < 1 + 4 * data[0]:
+			raise EmulatorError(SW_INCORRECT_DATA)
+		size = 1 + 4 * data[0]
+		return self.getNode(data[0:size]), data[size:]
+
+	def setup(self, p1, p2, data):
+		self.keyVersion = data[2]
+		self.keyVersionP2SH = data[3]
+		offset = 4
+		self.pin = data[offset + 1 : offset + 1 + data[offset]]
+		offset += 1 + data[offset]
+		offset += 1 + data[offset]
+		if data[offset] != 0:
+			self.seed = data[offset + 1 : offset + 1 + data[offset]]
+			self.nodes = {}
+		self.trustedInputKey = bytearray(os.urandom(16))
+		return self.trustedInputKey + bytearray(16)
+
+	def verifyPin(self, p1, p2, data):
+		if p1 == 0x80:
+			raise EmulatorError(0x63c0 + self.pinAttempts)
+		if data != self.pin:
+			self.pinAttempts = max(self.pinAttempts - 1, 0)
+			raise EmulatorError(0x63c0 + self.pinAttempts)
+		self.pinAttempts = 3
+		return bytearray()
+
+	def setKeymap(self, p1, p2, data):
+		return bytearray()
+
+	def getRandom(self, p1, p2, data):
+		return bytearray(os.urandom(self.expectedLength))
+
+	def getFirmwareVersion(self, p1, p2, data):
+		return bytearray([ 0x01, 0x00 ]) + bytearray(self.firmwareVersion)
+
+	def getWalletPublicKey(self, p1, p2, data):
+		node, data = self.readPath(data)
+		publicKey = serializePoint(node.publicPoint, False)
+		compressedKey = serializePoint(node.publicPoint)
+		if p2 == 0x00:
+			address = base58CheckEncode(self.keyVersion, hash160(compressedKey))
+		elif p2 == 0x01:
+			address = base58CheckEncode(self.keyVersionP2SH, hash160(bytearray([ 0x00, 0x14 ]) + bytearray(hash160(compressedKey))))
+		else:
+			raise EmulatorError(SW_INCORRECT_P1_P2)
+		address = bytearray(address.encode('ascii'))
+		return bytearray([ len(publicKey) ]) + publicKey + bytearray([ len(address) ]) + address + bytearray(node.chainCode)
+
+	def signTrustedInput(self, value):
+		return bytearray(hmac.new(bytes(self.trustedInputKey), bytes(value), hashlib.sha256).digest()[0:8])
+
+	def checkTrustedInput(self, value):
+		return len(value) == 56 and value[0] == 0x32 and hmac.compare_digest(bytes(self.signTrustedInput(value[0:48])), bytes(value[48:56]))
+
+	def getTrustedInput(self, p1, p2, data):
+		if p1 == 0x00:
+			self.trustedInputState = {}
+			self.trustedInputParser = StreamParser(transactionParser(self.trustedInputState))
+		elif p1 != 0x80 or self.trustedInputParser is None:
+			raise EmulatorError(SW_CONDITIONS_OF_USE_NOT_SATISFIED)
+		try:
+			done = self.trustedInputParser.feed(data)
+		except EmulatorError:
+			self.trustedInputParser = None
+			raise
+		if not done:
+			return bytearray()
+		transaction = self.trustedInputParser.buffer[4:]
+		self.trustedInputParser = None
+		index = self.trustedInputState['index']
+		if index >= len(self.trustedInputState['amounts']):
+			raise EmulatorError(SW_INCORRECT_DATA)
+		value = bytearray([ 0x32, 0x00 ]) + bytearray(os.urandom(2)) + bytearray(doubleSha256(transaction))
+		value += bytearray(struct.pack("<I", index)) + bytearray(self.trustedInputState['amounts'][index])
+		return value + self.signTrustedInput(value)
+
+	def hashInputStart(self, p1, p2, data):
+		if p1 == 0x00:
+			if p2 not in [ 0x00, 0x02, 0x03, 0x80, 0x10 ]:
+				raise EmulatorError(SW_INCORRECT_P1_P2)
+			if len(data) < 5:
+				raise EmulatorError(SW_INCORRECT_DATA)
+			if p2 == 0x10:
+				if self.transaction is None or not self.transaction['segwit']:
+					raise EmulatorError(SW_CONDITIONS_OF_USE_NOT_SATISFIED)
+				self.transaction['inputs'] = []
+			else:
+				self.transaction = { 'segwit': p2 in [ 0x02, 0x03 ], 'inputs': [] }
+				self.outputData = None
+			self.transaction['version'] = data[0:4]
+			self.transaction['continued'] = (p2 == 0x10)
+			inputCount = decodeVarint(data[4], bytes(data[5 : 5 + varintExtraSize(data[4])]))
+			self.inputParser = StreamParser(inputsParser(self, self.transaction, inputCount))
+			self.inputParser.feed(bytearray())
+			return bytearray()
+		if p1 != 0x80 or self.inputParser is None:
+			raise EmulatorError(SW_CONDITIONS_OF_USE_NOT_SATISFIED)
+		try:
+			done = self.inputParser.feed(data)
+		except EmulatorError:
+			self.transaction = None
+			self.inputParser = None
+			raise
+		if done and self.transaction['segwit'] and not self.transaction['continued']:
+			self.transaction['hashPrevouts'] = doubleSha256(bytearray().join([ entry['prevOut'] for entry in self.transaction['inputs'] ]))
+			self.transaction['hashSequence'] = doubleSha256(bytearray().join([ entry['sequence'] for entry in self.transaction['inputs'] ]))
+		return bytearray()
+
+	def getOutputScript(self, address):
+		version, keyHash = base58CheckDecode(address)
+		if len(keyHash) != 20:
+			raise EmulatorError(SW_INCORRECT_DATA)
+		if version == self.keyVersion:
+			return bytearray([ 0x76, 0xa9, 0x14 ]) + keyHash + bytearray([ 0x88, 0xac ])
+		if version == self.keyVersionP2SH:
+			return bytearray([ 0xa9, 0x14 ]) + keyHash + bytearray([ 0x87 ])
+		raise EmulatorError(SW_INCORRECT_DATA)
+
+	def hashInputFinalize(self, p1, p2, data):
+		# Legacy finalization, the dongle builds the outputs from the destination, fees and change path
+		if self.transaction is None or self.inputParser is None or not self.inputParser.done:
+			raise EmulatorError(SW_CONDITIONS_OF_USE_NOT_SATISFIED)
+		if p1 != 0x02:
+			raise EmulatorError(SW_INCORRECT_P1_P2)
+		if len(data) < 1 + data[0] + 16:
+			raise EmulatorError(SW_INCORRECT_DATA)
+		address = bytes(data[1 : 1 + data[0]]).decode('ascii')
+		offset = 1 + data[0]
+		amount, fees = struct.unpack(">QQ", bytes(data[offset : offset + 16]))
+		changeNode, remaining = self.readPath(data[offset + 16:])
+		if len(remaining) != 0:
+			raise EmulatorError(SW_INCORRECT_DATA)
+		total = 0
+		for entry in self.transaction['inputs']:
+			if entry['amount'] is None:
+				raise EmulatorError(SW_CONDITIONS_OF_USE_NOT_SATISFIED)
+			total += struct.unpack("<Q", bytes(entry['amount']))[0]
+		if total < amount + fees:
+			raise EmulatorError(SW_INCORRECT_DATA)
+		outputs = [ (amount, self.getOutputScript(address)) ]
+		if total > amount + fees:
+			changeHash = bytearray(hash160(serializePoint(changeNode.publicPoint)))
+			outputs.append((total - amount - fees, bytearray([ 0x76, 0xa9, 0x14 ]) + changeHash + bytearray([ 0x88, 0xac ])))
+		outputData = bytearray()
+		writeVarint(len(outputs), outputData)
+		for value, script in outputs:
+			outputData += bytearray(struct.pack("<Q", value))
+			writeVarint(len(script), outputData)
+			outputData += script
+		self.transaction['outputs'] = outputData
+		self.transaction['hashOutputs'] = doubleSha256(outputData[1:])
+		return bytearray([ len(outputData) ]) + outputData + bytearray([ 0x00 ])
+
+	def hashInputFinalizeFull(self, p1, p2, data):
+		if self.transaction is None or self.inputParser is None or not self.inputParser.done:
+			raise EmulatorError(SW_CONDITIONS_OF_USE_NOT_SATISFIED)
+		if p1 == 0xff:
+			self.readPath(data)
+			return bytearray()
+		if p1 not in [ 0x00, 0x80 ]:
+			raise EmulatorError(SW_INCORRECT_P1_P2)
+		if self.outputData is None or self.outputData['complete']:
+			self.outputData = { 'data': bytearray(), 'complete': False }
+		self.outputData['data'].extend(data)
+		if p1 == 0x80:
+			outputs = self.outputData['data']
+			self.outputData['complete'] = True
+			self.transaction['outputs'] = outputs
+			self.transaction['hashOutputs'] = doubleSha256(outputs[1 + varintExtraSize(outputs[0]):])
+		return bytearray([ 0x00, 0x00 ])
+
+	def hashSign(self, p1, p2, data):
+		transaction = self.transaction
+		if transaction is None or 'outputs' not in transaction:
+			raise EmulatorError(SW_CONDITIONS_OF_USE_NOT_SATISFIED)
+		node, data = self.readPath(data)
+		if len(data) != 1 + data[0] + 5:
+			raise EmulatorError(SW_INCORRECT_DATA)
+		lockTime = bytearray(struct.pack("<I", struct.unpack(">I", bytes(data[1 + data[0] : 5 + data[0]]))[0]))
+		sighashType = data[5 + data[0]]
+		if transaction['segwit']:
+			if len(transaction['inputs']) != 1:
+				raise EmulatorError(SW_CONDITIONS_OF_USE_NOT_SATISFIED)
+			signedInput = transaction['inputs'][0]
+			preimage = bytearray(transaction['version'])
+			preimage += bytearray(transaction['hashPrevouts']) + bytearray(transaction['hashSequence'])
+			preimage += signedInput['prevOut']
+			writeVarint(len(signedInput['script']), preimage)
+			preimage += signedInput['script'] + signedInput['amount'] + signedInput['sequence']
+			preimage += bytearray(transaction['hashOutputs'])
+		else:
+			preimage = bytearray(transaction['version'])
+			writeVarint(len(transaction['inputs']), preimage)
+			for entry in transaction['inputs']:
+				preimage += entry['prevOut']
+				writeVarint(len(entry['script']), preimage)
+				preimage += entry['script'] + entry['sequence']
+			preimage += transaction['outputs']
+		preimage += lockTime + bytearray(struct.pack("<I", sighashType))
+		signature = SigningKey(node.privateKey).sign(doubleSha256(preimage))
+		return signature + bytearray([ sighashType ])
+
+	def signMessage(self, p1, p2, data):
+		if p1 == 0x00:
+			if p2 == 0x00:
+				node, data = self.readPath(data)
+				if len(data) == 0 or len(data) != 1 + data[0]:
+					raise EmulatorError(SW_INCORRECT_DATA)
+				self.message = { 'node': node, 'data': data[1:] }
+				return bytearray([ 0x00 ])
+			if p2 == 0x01:
+				node, data = self.readPath(data)
+				if len(data) < 2:
+					raise EmulatorError(SW_INCORRECT_DATA)
+				self.message = { 'node': node, 'length': (data[0] << 8) | data[1], 'data': bytearray() }
+				data = data[2:]
+			elif p2 != 0x80 or self.message is None or 'length' not in self.message:
+				raise EmulatorError(SW_CONDITIONS_OF_USE_NOT_SATISFIED)
+			self.message['data'].extend(data)
+			if len(self.message['data']) > self.message['length']:
+				self.message = None
+				raise EmulatorError(SW_INCORRECT_DATA)
+			return bytearray([ 0x00, 0x00 ])
+		if p1 == 0x80:
+			message = self.message
+			self.message = None
+			if message is None or len(message['data']) != message.get('length', len(message['data'])):
+				raise EmulatorError(SW_CONDITIONS_OF_USE_NOT_SATISFIED)
+			payload = bytearray(b"\x18Bitcoin Signed Message:\n")
+			writeVarint(len(message['data']), payload)
+			payload += message['data']
+			return SigningKey(message['node'].privateKey).sign(doubleSha256(payload))
+		raise EmulatorError(SW_INCORRECT_P1_P2)
@@ -19,6 +19,9 @@
 
 class BTChipException(Exception):
 
+	# Recent exchanges (btchipTrace.TraceEntry) when a TraceBuffer observed the transport failure
+	trace = None
+
 	def __init__(self, message, sw=0x6f00):
 		self.message = message
 		self.sw = sw
@@ -26,3 +29,23 @@ class BTChipException(Exception):
 	def __str__(self):
 		buf = "Exception : " + self.message
 		return buf
+
+class BTChipTransportException(BTChipException):
+	"""Failure of the link to the device (timeout, lost connection), the device returned no
+	status word so sw is None"""
+
+	def __init__(self, message):
+		BTChipException.__init__(self, message, None)
+
+class BTChipTimeoutException(BTChipException):
+	"""Time budget of an operation spent before the device could be used (deadline exceeded,
+	device held by others), nothing was sent to the device so sw is None"""
+
+	def __init__(self, message):
+		BTChipException.__init__(self, message, None)
+
+class BTChipCancelledException(BTChipException):
+	"""Operation stopped by its CancellationToken before its next APDU, sw is None"""
+
+	def __init__(self, message):
+		BTChipException.__init__(self, message, None)
@@ -0,0 +1,189 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+# TCP relay adding WAN conditions in front of a dongle proxy, to measure DongleServer clients
+# as if the proxy was in another data center
+
+from .btchipException import *
+import argparse
+import random
+import socket
+import threading
+import time
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+class LinkDirection(object):
+	"""One direction of the emulated link. Data read at time t is delivered at the time its
+	last byte leaves the link (bandwidth, shared by successive chunks) plus half the RTT, the
+	jitter and the per packet delay. Delivery times never decrease, the stream stays ordered"""
+
+	def __init__(self, source, destination, rtt, jitter, bandwidth, packetSize, packetDelay, generator):
+		self.source = source
+		self.destination = destination
+		self.rtt = rtt
+		self.jitter = jitter
+		self.bandwidth = bandwidth
+		self.packetSize = packetSize
+		self.packetDelay = packetDelay
+		self.random = generator
+		self.linkFree = 0.0
+		self.lastDelivery = 0.0
+		self.chunks = queue.Queue()
+
+	def getDeliveryTime(self, size, now):
+		transmitted = now
+		if self.bandwidth:
+			transmitted = max(now, self.linkFree) + float(size) / self.bandwidth
+			self.linkFree = transmitted
+		packets = (size + self.packetSize - 1) // self.packetSize
+		delivery = transmitted + self.rtt / 2.0 + packets * self.packetDelay
+		if self.jitter:
+			delivery += self.random.uniform(0, self.jitter)
+		self.lastDelivery = max(delivery, self.lastDelivery)
+		return self.lastDelivery
+
+	def receive(self):
+		try:
+			while True:
+				data = self.source.recv(65536)
+				if len(data) == 0:
+					break
+				self.chunks.put((self.getDeliveryTime(len(data), time.time()), data))
+		except socket.error:
+			pass
+		self.chunks.put(None)
+
+	def send(self):
+		try:
+			while True:
+				chunk = self.chunks.get()
+				if chunk is None:
+					break
+				delivery, data = chunk
+				delay = delivery - time.time()
+				if delay > 0:
+					time.sleep(delay)
+				self.destination.sendall(data)
+		except socket.error:
+			pass
+		for sock in [ self.source, self.destination ]:
+			try:
+				sock.shutdown(socket.SHUT_RDWR)
+			except socket.error:
+				pass
+
+	def start(self):
+		threads = [ threading.Thread(target=self.receive, name="btchip-link-receive"), threading.Thread(target=self.send, name="btchip-link-send") ]
+		for thread in threads:
+			thread.daemon = True
+			thread.start()
+		return threads
+
+class LatencyProxy(object):
+	"""Relay connections to upstream (host, port) through an emulated link. rtt, jitter and
+	packetDelay are in seconds, bandwidth in bytes per second (None for unlimited), each chunk
+	is split in packets of packetSize bytes for the per packet delay"""
+
+	def __init__(self, upstream, host="127.0.0.1", port=0, rtt=0.0, jitter=0.0, bandwidth=None, packetSize=1460, packetDelay=0.0, seed=None):
+		self.upstream = upstream
+		self.rtt = rtt
+		self.jitter = jitter
+		self.bandwidth = bandwidth
+		self.packetSize = packetSize
+		self.packetDelay = packetDelay
+		self.random = random.Random(seed)
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.listener.bind((host, port))
+		self.listener.listen(16)
+		self.address = self.listener.getsockname()
+		self.running = False
+		self.thread = None
+
+	def start(self):
+		self.running = True
+		self.thread = threading.Thread(target=self.serve, name="btchip-latency-proxy")
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def serve(self):
+		while self.running:
+			try:
+				client, address = self.listener.accept()
+			except socket.error:
+				break
+			try:
+				server = socket.create_connection(self.upstream)
+			except socket.error:
+				client.close()
+				continue
+			for sock in [ client, server ]:
+				sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			for source, destination in [ (client, server), (server, client) ]:
+				LinkDirection(source, destination, self.rtt, self.jitter, self.bandwidth, self.packetSize, self.packetDelay, self.random).start()
+
+	def stop(self):
+		self.running = False
+		try:
+			self.listener.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self.listener.close()
+		if self.thread is not None:
+			self.thread.join()
+
+def main():
+	parser = argparse.ArgumentParser(description="Relay a dongle proxy through an emulated WAN link")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=9998)
+	parser.add_argument("--upstream", default="127.0.0.1:9999", help="proxy to relay, host:port")
+	parser.add_argument("--emulator", action="store_true", help="relay an emulated dongle instead of --upstream")
+	parser.add_argument("--rtt", type=float, default=50.0, help="round trip time in ms")
+	parser.add_argument("--jitter", type=float, default=0.0, help="maximum added delay per chunk in ms")
+	parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second in each direction")
+	parser.add_argument("--packet-size", type=int, default=1460)
+	parser.add_argument("--packet-delay", type=float, default=0.0, help="delay per packet in ms")
+	args = parser.parse_args()
+	server = None
+	if args.emulator:
+		from .btchipEmulator import EmulatedDongle
+		from .btchipProxy import DongleProxyServer
+		server = DongleProxyServer([ EmulatedDongle() ]).start()
+		upstream = server.address
+	else:
+		host, port = args.upstream.rsplit(":", 1)
+		upstream = (host, int(port))
+	proxy = LatencyProxy(upstream, args.host, args.port, args.rtt / 1000.0, args.jitter / 1000.0, args.bandwidth, args.packet_size, args.packet_delay / 1000.0)
+	print("Relaying %s:%d on %s:%d" % (upstream[0], upstream[1], proxy.address[0], proxy.address[1]))
+	proxy.running = True
+	try:
+		proxy.serve()
+	except KeyboardInterrupt:
+		pass
+	proxy.stop()
+	if server is not None:
+		server.stop()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,186 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+# Exchange events reported by the transports to the observers added with Dongle.addObserver
+
+from abc import ABCMeta, abstractmethod
+import bisect
+import threading
+import time
+
+clock = getattr(time, "perf_counter", time.time)
+
+class ExchangeEvent(object):
+	"""One exchange as seen by the transport. written and firstResponse are the clock() values
+	set by the transport when the command was sent and when the first response bytes arrived,
+	the phase durations are computed from them when the exchange ends. command and response are
+	the buffers exchanged, not copies, error the exception raised by the exchange if any"""
+
+	__slots__ = [ 'dongle', 'command', 'response', 'ins', 'commandSize', 'responseSize', 'reportsWritten', 'reportsRead', 'timestamp',
+		'started', 'written', 'firstResponse', 'ended', 'sw', 'error' ]
+
+	def __init__(self, dongle, apdu):
+		self.dongle = dongle
+		self.command = apdu
+		self.response = None
+		self.ins = apdu[1] if len(apdu) > 1 else None
+		self.commandSize = len(apdu)
+		self.responseSize = 0
+		self.reportsWritten = 0
+		self.reportsRead = 0
+		self.timestamp = time.time()
+		self.written = None
+		self.firstResponse = None
+		self.ended = None
+		self.sw = None
+		self.error = None
+		self.started = clock()
+
+	def finish(self):
+		self.ended = clock()
+		if self.written is None:
+			self.written = self.started
+		if self.firstResponse is None:
+			self.firstResponse = self.ended
+
+	@property
+	def writeTime(self):
+		return self.written - self.started
+
+	@property
+	def firstResponseTime(self):
+		return self.firstResponse - self.written
+
+	@property
+	def readTime(self):
+		return self.ended - self.firstResponse
+
+	@property
+	def totalTime(self):
+		return self.ended - self.started
+
+class DongleObserver(object):
+	__metaclass__ = ABCMeta
+
+	@abstractmethod
+	def onExchange(self, event):
+		pass
+
+# Upper bounds of the histogram buckets in seconds, from 100us to about 100s
+LATENCY_BUCKETS = [ 0.0001 * (2 ** i) for i in range(21) ]
+
+class LatencyHistogram(DongleObserver):
+	"""Exchange latencies by instruction, in exponential buckets"""
+
+	def __init__(self, bounds=LATENCY_BUCKETS):
+		self.bounds = bounds
+		self.lock = threading.Lock()
+		self.entries = {}
+
+	def onExchange(self, event):
+		latency = event.totalTime
+		bucket = bisect.bisect_left(self.bounds, latency)
+		with self.lock:
+			entry = self.entries.get(event.ins)
+			if entry is None:
+				entry = { 'counts': [ 0 ] * (len(self.bounds) + 1), 'count': 0, 'total': 0.0, 'min': latency, 'max': latency }
+				self.entries[event.ins] = entry
+			entry['counts'][bucket] += 1
+			entry['count'] += 1
+			entry['total'] += latency
+			entry['min'] = min(entry['min'], latency)
+			entry['max'] = max(entry['max'], latency)
+
+	def getPercentile(self, ins, percentile):
+		"""Upper bound of the bucket holding the percentile, capped by the largest latency seen"""
+		with self.lock:
+			entry = self.entries.get(ins)
+			if entry is None:
+				return None
+			rank = entry['count'] * percentile / 100.0
+			seen = 0
+			for bucket, count in enumerate(entry['counts']):
+				seen += count
+				if count != 0 and seen >= rank:
+					if bucket == len(self.bounds):
+						return entry['max']
+					return min(self.bounds[bucket], entry['max'])
+			return entry['max']
+
+	def getSummary(self):
+		result = {}
+		with self.lock:
+			instructions = list(self.entries.keys())
+		for ins in instructions:
+			entry = self.entries[ins]
+			name = "%.2x" % ins if ins is not None else "none"
+			result[name] = {
+				'count': entry['count'],
+				'mean': entry['total'] / entry['count'],
+				'min': entry['min'],
+				'max': entry['max'],
+				'p50': self.getPercentile(ins, 50),
+				'p95': self.getPercentile(ins, 95),
+				'p99': self.getPercentile(ins, 99)
+			}
+		return result
+
+	def reset(self):
+		with self.lock:
+			self.entries = {}
+
+class StatusWordCounter(DongleObserver):
+	"""Status words by instruction, exchanges failing without a status word are counted by
+	error message"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.statusWords = {}
+		self.transportErrors = {}
+
+	def onExchange(self, event):
+		with self.lock:
+			if event.sw is not None:
+				key = (event.ins, event.sw)
+				self.statusWords[key] = self.statusWords.get(key, 0) + 1
+			else:
+				key = str(event.error)
+				self.transportErrors[key] = self.transportErrors.get(key, 0) + 1
+
+	def getCount(self, sw, ins=None):
+		with self.lock:
+			return sum(count for (entryIns, entrySw), count in self.statusWords.items() if entrySw == sw and (ins is None or entryIns == ins))
+
+	def getErrorCount(self):
+		with self.lock:
+			return sum(count for (ins, sw), count in self.statusWords.items() if sw != 0x9000) + sum(self.transportErrors.values())
+
+	def getSummary(self):
+		result = { 'statusWords': {}, 'transportErrors': {} }
+		with self.lock:
+			for (ins, sw), count in self.statusWords.items():
+				name = "%.2x" % ins if ins is not None else "none"
+				result['statusWords'].setdefault(name, {})["%.4x" % sw] = count
+			result['transportErrors'] = dict(self.transportErrors)
+		return result
+
+	def reset(self):
+		with self.lock:
+			self.statusWords = {}
+			self.transportErrors = {}
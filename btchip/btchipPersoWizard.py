@@ -260,7 +260,7 @@ class FinalizeDialog(QtGui.QDialog):
 				QMessageBox.warning(self, "Error", "Invalid PIN - dongle has been reset. Please personalize again", "OK")
 				self.reject()
 				self.persoData['main'].reject()
-			if ((e.sw & 0xfff0) == 0x63c0):
+			if e.sw is not None and ((e.sw & 0xfff0) == 0x63c0):
 				attempts = e.sw - 0x63c0
 				self.ui.remainingAttemptsLabel.setText("Remaining attempts " + str(attempts))
 			QMessageBox.warning(self, "Error", "Invalid PIN - please unplug the dongle and plug it again before retrying", "OK")
@@ -0,0 +1,168 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from abc import ABCMeta, abstractmethod
+from .btchip import *
+from .btchipComm import *
+from .btchipException import *
+from concurrent.futures import Future
+import threading
+import time
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+class DongleSlot(object):
+	"""One device of a pool, jobs queued on it are run in order by its own worker thread"""
+
+	def __init__(self, dongle, descriptor=None):
+		self.dongle = dongle
+		self.descriptor = descriptor
+		self.app = None
+		self.jobs = queue.Queue()
+		self.pending = 0
+		self.completed = 0
+		self.failed = 0
+		self.busyTime = 0.0
+		self.started = time.time()
+		self.lock = threading.Lock()
+		self.thread = threading.Thread(target=self.run, name="btchip-pool-%d" % id(self))
+		self.thread.daemon = True
+		self.thread.start()
+
+	def getApp(self):
+		if self.app is None:
+			self.app = btchip(self.dongle)
+		return self.app
+
+	def submit(self, job, args, kwargs):
+		future = Future()
+		with self.lock:
+			self.pending += 1
+		self.jobs.put((future, job, args, kwargs))
+		return future
+
+	def run(self):
+		while True:
+			item = self.jobs.get()
+			if item is None:
+				break
+			future, job, args, kwargs = item
+			if future.set_running_or_notify_cancel():
+				start = time.time()
+				try:
+					result = job(self.getApp(), *args, **kwargs)
+				except BaseException as e:
+					with self.lock:
+						self.failed += 1
+					future.set_exception(e)
+				else:
+					with self.lock:
+						self.completed += 1
+					future.set_result(result)
+				with self.lock:
+					self.busyTime += time.time() - start
+			with self.lock:
+				self.pending -= 1
+
+	def getStatistics(self):
+		with self.lock:
+			elapsed = time.time() - self.started
+			return {
+				'descriptor': self.descriptor,
+				'pending': self.pending,
+				'completed': self.completed,
+				'failed': self.failed,
+				'busyTime': self.busyTime,
+				'utilization': (self.busyTime / elapsed) if elapsed > 0 else 0.0
+			}
+
+	def close(self):
+		self.jobs.put(None)
+		self.thread.join()
+		self.dongle.close()
+
+class DonglePolicy(object):
+	__metaclass__ = ABCMeta
+
+	@abstractmethod
+	def select(self, slots):
+		pass
+
+class LeastLoadedPolicy(DonglePolicy):
+	"""Pick the device with the fewest queued and running jobs, then the least busy one"""
+
+	def select(self, slots):
+		return min(slots, key=lambda slot: (slot.pending, slot.busyTime))
+
+class RoundRobinPolicy(DonglePolicy):
+
+	def __init__(self):
+		self.index = 0
+		self.lock = threading.Lock()
+
+	def select(self, slots):
+		with self.lock:
+			slot = slots[self.index % len(slots)]
+			self.index += 1
+		return slot
+
+class DonglePool(object):
+	"""Dispatch independent jobs over every attached dongle. A job is called as
+	job(app, *args, **kwargs) with the btchip instance of the device it runs on,
+	and must not rely on state left by a previous job"""
+
+	def __init__(self, dongles=None, policy=None, debug=False):
+		self.slots = []
+		if dongles is None:
+			try:
+				for descriptor in enumerateDongles():
+					self.slots.append(DongleSlot(openDongle(descriptor, debug), descriptor))
+			except:
+				# Give back the devices opened before the failure
+				self.close()
+				raise
+		else:
+			for dongle in dongles:
+				self.slots.append(DongleSlot(dongle))
+		if len(self.slots) == 0:
+			raise BTChipException("No dongle found")
+		self.policy = policy if policy is not None else LeastLoadedPolicy()
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.slots)
+
+	def submit(self, job, *args, **kwargs):
+		with self.lock:
+			slot = self.policy.select(self.slots)
+			return slot.submit(job, args, kwargs)
+
+	def map(self, job, items):
+		futures = [ self.submit(job, item) for item in items ]
+		return [ future.result() for future in futures ]
+
+	def getStatistics(self):
+		return [ slot.getStatistics() for slot in self.slots ]
+
+	def close(self):
+		for slot in self.slots:
+			slot.close()
@@ -0,0 +1,291 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+# Proxy serving local dongles to DongleServer (protocol v1) and DongleServerSession (protocol v2) clients
+
+from .btchipComm import *
+from .btchipException import *
+import argparse
+import os
+import socket
+import struct
+import threading
+
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+class ProxyDevice(object):
+	"""Runs the APDUs queued for one dongle in order on its own thread"""
+
+	def __init__(self, dongle):
+		self.dongle = dongle
+		self.requests = queue.Queue()
+		self.thread = threading.Thread(target=self.run, name="btchip-proxy-device")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def submit(self, apdu, callback):
+		self.requests.put((apdu, callback))
+
+	def run(self):
+		while True:
+			request = self.requests.get()
+			if request is None:
+				break
+			apdu, callback = request
+			try:
+				response = self.dongle.exchange(apdu)
+				sw = 0x9000
+			except BTChipException as e:
+				response = bytearray()
+				sw = e.sw if e.sw is not None else 0x6f00
+			except Exception:
+				response = bytearray()
+				sw = 0x6f00
+			try:
+				callback(response, sw)
+			except Exception:
+				pass
+
+	def close(self):
+		self.requests.put(None)
+		self.thread.join()
+		self.dongle.close()
+
+class DongleProxyServer(object):
+	"""Serve a list of dongles, each to one client at a time. A protocol v1 or shared memory
+	connection, or a protocol v2 session, gets a free dongle on its first request and keeps it
+	until it ends, so that the APDUs of its multi-APDU operations are not interleaved with
+	others. Clients finding no free dongle wait for one in arrival order. With host set to
+	unix:<path> the proxy listens on a unix socket, which also offers the shared memory
+	transport"""
+
+	def __init__(self, dongles, host="127.0.0.1", port=0):
+		self.devices = [ ProxyDevice(dongle) for dongle in dongles ]
+		self.owners = [ None ] * len(self.devices)
+		self.waiters = []
+		self.ownersLock = threading.Lock()
+		self.path = None
+		if host.startswith("unix:"):
+			self.path = host[5:]
+			if os.path.exists(self.path):
+				os.unlink(self.path)
+			self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.listener.bind(self.path)
+			self.address = (host, 0)
+		else:
+			self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			self.listener.bind((host, port))
+			self.address = self.listener.getsockname()
+		self.listener.listen(16)
+		self.running = False
+		self.thread = None
+
+	def start(self):
+		self.running = True
+		self.thread = threading.Thread(target=self.serve, name="btchip-proxy")
+		self.thread.daemon = True
+		self.thread.start()
+		return self
+
+	def serve(self):
+		while self.running:
+			try:
+				client, address = self.listener.accept()
+			except socket.error:
+				break
+			thread = threading.Thread(target=self.handle, args=(client,), name="btchip-proxy-client")
+			thread.daemon = True
+			thread.start()
+
+	def acquireDevice(self, owner, granted):
+		"""A free device now for owner, or None and granted(device) called once one is given back"""
+		with self.ownersLock:
+			for index, current in enumerate(self.owners):
+				if current is None:
+					self.owners[index] = owner
+					return self.devices[index]
+			self.waiters.append((owner, granted))
+		return None
+
+	def waitDevice(self, owner):
+		result = []
+		event = threading.Event()
+		def granted(device):
+			result.append(device)
+			event.set()
+		device = self.acquireDevice(owner, granted)
+		if device is not None:
+			return device
+		while not event.wait(0.5):
+			if not self.running:
+				raise BTChipTransportException("Proxy stopped")
+		return result[0]
+
+	def releaseDevices(self, isOwner):
+		"""Give back the devices of the owners matching isOwner, and drop their waits"""
+		grants = []
+		with self.ownersLock:
+			self.waiters = [ waiter for waiter in self.waiters if not isOwner(waiter[0]) ]
+			for index, owner in enumerate(self.owners):
+				if owner is not None and isOwner(owner):
+					self.owners[index] = None
+				if self.owners[index] is None and len(self.waiters) != 0:
+					owner, granted = self.waiters.pop(0)
+					self.owners[index] = owner
+					grants.append((granted, self.devices[index]))
+		for granted, device in grants:
+			granted(device)
+
+	def handle(self, client):
+		if client.family == socket.AF_INET:
+			client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		try:
+			header = bytearray(4)
+			recvExactly(client, memoryview(header))
+			if header == PROXY_V2_MAGIC[0:4]:
+				magic = bytearray(len(PROXY_V2_MAGIC) - 4)
+				recvExactly(client, memoryview(magic))
+				if header + magic == PROXY_V2_MAGIC:
+					client.sendall(PROXY_V2_MAGIC)
+					self.handleV2(client)
+				elif header + magic == PROXY_SHM_MAGIC and self.path is not None:
+					from .btchipSharedMemory import serveSharedMemory
+					serveSharedMemory(client, self.waitDevice(client))
+			else:
+				self.handleV1(client, header)
+		except (socket.error, BTChipException):
+			pass
+		finally:
+			# v2 sessions are owned by (client, session)
+			self.releaseDevices(lambda owner: owner is client or (isinstance(owner, tuple) and owner[0] is client))
+			client.close()
+
+	def handleV1(self, client, header):
+		device = self.waitDevice(client)
+		done = threading.Event()
+		result = []
+		def callback(response, sw):
+			result.append(struct.pack(">I", len(response)) + bytes(response) + struct.pack(">H", sw))
+			done.set()
+		while True:
+			apdu = bytearray(struct.unpack(">I", bytes(header))[0])
+			recvExactly(client, memoryview(apdu))
+			done.clear()
+			del result[:]
+			device.submit(apdu, callback)
+			done.wait()
+			client.sendall(result[0])
+			recvExactly(client, memoryview(header))
+
+	def handleV2(self, client):
+		# A frame without APDU ends its session and gives its device back
+		sendLock = threading.Lock()
+		sessionLock = threading.Lock()
+		bound = {}
+		queued = {}
+		header = bytearray(10)
+		def reply(requestId, session):
+			def callback(response, sw):
+				frame = struct.pack(">IIHH", len(response), requestId, session, sw) + bytes(response)
+				with sendLock:
+					client.sendall(frame)
+			return callback
+		def granted(session):
+			def submitQueued(device):
+				# Under the session lock, requests arriving meanwhile are submitted after these
+				with sessionLock:
+					bound[session] = device
+					for apdu, callback in queued.pop(session, []):
+						device.submit(apdu, callback)
+			return submitQueued
+		def endSession(session, callback):
+			with sessionLock:
+				bound.pop(session, None)
+				pending = queued.pop(session, [])
+			for apdu, pendingCallback in pending:
+				pendingCallback(bytearray(), 0x6f00)
+			self.releaseDevices(lambda owner: owner == (client, session))
+			callback(bytearray(), 0x9000)
+		while True:
+			recvExactly(client, memoryview(header))
+			size, requestId, session = struct.unpack_from(">IIH", header)
+			apdu = bytearray(size)
+			recvExactly(client, memoryview(apdu))
+			if size == 0:
+				endSession(session, reply(requestId, session))
+				continue
+			with sessionLock:
+				device = bound.get(session)
+				if device is None and session not in queued:
+					device = self.acquireDevice((client, session), granted(session))
+					if device is not None:
+						bound[session] = device
+				if device is None:
+					queued.setdefault(session, []).append((apdu, reply(requestId, session)))
+				else:
+					device.submit(apdu, reply(requestId, session))
+
+	def stop(self):
+		self.running = False
+		try:
+			self.listener.shutdown(socket.SHUT_RDWR)
+		except socket.error:
+			pass
+		self.listener.close()
+		if self.thread is not None:
+			self.thread.join()
+		if self.path is not None and os.path.exists(self.path):
+			os.unlink(self.path)
+		for device in self.devices:
+			device.close()
+
+def main():
+	parser = argparse.ArgumentParser(description="Serve the attached dongles to DongleServer clients")
+	parser.add_argument("--host", default="127.0.0.1", help="address to listen on, or unix:<path>")
+	parser.add_argument("--port", type=int, default=9999)
+	parser.add_argument("--debug", action="store_true")
+	parser.add_argument("--emulator", type=int, default=0, metavar="COUNT", help="serve COUNT emulated dongles instead of the attached ones")
+	parser.add_argument("--latency", type=float, default=0.0, help="emulated time per APDU in seconds")
+	parser.add_argument("--throughput", type=float, default=None, help="emulated bytes per second")
+	args = parser.parse_args()
+	if args.emulator > 0:
+		from .btchipEmulator import EmulatedDongle
+		dongles = [ EmulatedDongle(latency=args.latency, throughput=args.throughput, debug=args.debug) for i in range(args.emulator) ]
+	else:
+		dongles = [ openDongle(descriptor, args.debug) for descriptor in enumerateHIDDongles() + enumerateSmartcardDongles() ]
+	if len(dongles) == 0:
+		raise BTChipException("No dongle found")
+	server = DongleProxyServer(dongles, args.host, args.port)
+	if server.path is not None:
+		print("Serving %d dongle(s) on %s" % (len(dongles), args.host))
+	else:
+		print("Serving %d dongle(s) on %s:%d" % (len(dongles), server.address[0], server.address[1]))
+	server.running = True
+	try:
+		server.serve()
+	except KeyboardInterrupt:
+		pass
+	server.stop()
+
+if __name__ == "__main__":
+	main()
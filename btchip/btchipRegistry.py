@@ -0,0 +1,228 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from .btchipComm import *
+from .btchipException import *
+import select
+import socket
+import threading
+import time
+
+try:
+	from smartcard.CardMonitoring import CardMonitor, CardObserver
+	CARD_MONITOR = True
+except ImportError:
+	CardObserver = object
+	CARD_MONITOR = False
+
+NETLINK_KOBJECT_UEVENT = 15
+HOTPLUG_SUBSYSTEMS = [ b"hidraw", b"usb", b"usbmisc" ]
+
+def openHotplugSocket():
+	"""Listen to kernel uevents (the udev netlink feed), None where not available"""
+	if not hasattr(socket, "AF_NETLINK"):
+		return None
+	try:
+		sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+		sock.bind((0, 1))
+		return sock
+	except (OSError, socket.error):
+		return None
+
+def isHotplugEvent(message):
+	for field in message.split(b"\x00"):
+		if field.startswith(b"SUBSYSTEM=") and field[10:] in HOTPLUG_SUBSYSTEMS:
+			return True
+	return False
+
+class ReaderCardObserver(CardObserver):
+	"""Report the readers whose card was inserted or removed to a registry"""
+
+	def __init__(self, registry):
+		self.registry = registry
+
+	def update(self, observable, actions):
+		addedCards, removedCards = actions
+		self.registry.cardsChanged([ card.reader for card in addedCards + removedCards ])
+
+class DeviceRegistry(object):
+	"""Cache of the reachable dongles, kept current by a background watcher. HID devices and the
+	PC/SC reader list are rescanned on hotplug events, or every rescanInterval seconds where the
+	kernel uevents can't be read. A reader known to hold a dongle is not probed again with the
+	wallet SELECT until PC/SC reports its card removed or replaced, and readers opened through
+	the registry are never probed while in use"""
+
+	def __init__(self, rescanInterval=5.0, hotplug=True):
+		self.rescanInterval = rescanInterval
+		self.hotplug = hotplug
+		self.hidDongles = []
+		self.readers = {}
+		self.readersInUse = set()
+		self.lock = threading.Lock()
+		self.refreshNeeded = threading.Event()
+		self.running = False
+		self.thread = None
+		self.cardObserver = None
+		self.lastRefresh = 0
+		self.refresh()
+
+	def refresh(self):
+		hidDongles = enumerateHIDDongles()
+		readerNames = {}
+		if SCARD:
+			for reader in readers():
+				readerNames[str(reader)] = reader
+		with self.lock:
+			knownReaders = dict(self.readers)
+			readersInUse = set(self.readersInUse)
+		cardReaders = {}
+		unknownReaders = []
+		for name, reader in readerNames.items():
+			if knownReaders.get(name) or (name in readersInUse):
+				cardReaders[name] = True
+			else:
+				cardReaders[name] = False
+				unknownReaders.append(reader)
+		for reader, connection in probeReaders(unknownReaders):
+			connection.disconnect()
+			cardReaders[str(reader)] = True
+		with self.lock:
+			self.hidDongles = hidDongles
+			self.readers = cardReaders
+			self.lastRefresh = time.time()
+
+	def getDescriptors(self):
+		with self.lock:
+			result = list(self.hidDongles)
+			for name in sorted(self.readers.keys()):
+				if self.readers[name]:
+					result.append({ 'type': 'smartcard', 'reader': name })
+		return enumerateBrokerDongles() + result + enumerateProxyDongles()
+
+	def invalidate(self, descriptor):
+		with self.lock:
+			if descriptor['type'] == 'hid':
+				self.hidDongles = [ entry for entry in self.hidDongles if entry['path'] != descriptor['path'] ]
+			elif descriptor['type'] == 'smartcard':
+				self.readers.pop(descriptor['reader'], None)
+		self.refreshNeeded.set()
+
+	def cardsChanged(self, readerNames):
+		"""Forget what the readers held, their card was inserted or removed. They are probed on
+		the next refresh"""
+		with self.lock:
+			for name in readerNames:
+				self.readers.pop(name, None)
+		self.refreshNeeded.set()
+
+	def openDongle(self, descriptor, debug=False):
+		try:
+			dongle = openDongle(descriptor, debug)
+		except Exception:
+			self.invalidate(descriptor)
+			raise
+		if descriptor['type'] == 'smartcard':
+			with self.lock:
+				self.readersInUse.add(descriptor['reader'])
+			dongle.close = self.releaseReader(dongle.close, descriptor['reader'])
+		return dongle
+
+	def releaseReader(self, close, name):
+		def release():
+			try:
+				close()
+			finally:
+				with self.lock:
+					self.readersInUse.discard(name)
+		return release
+
+	def getDongle(self, debug=False):
+		"""Same choice of device as btchipComm.getDongle, from the cache"""
+		descriptors = self.getDescriptors()
+		brokers = [ descriptor for descriptor in descriptors if descriptor['type'] == 'broker' ]
+		hidDongles = [ descriptor for descriptor in descriptors if descriptor['type'] == 'hid' ]
+		others = [ descriptor for descriptor in descriptors if descriptor['type'] not in [ 'broker', 'hid' ] ]
+		for descriptor in brokers + hidDongles[-1:] + others:
+			try:
+				return self.openDongle(descriptor, debug)
+			except Exception:
+				pass
+		raise BTChipException("No dongle found")
+
+	def start(self):
+		if self.thread is None:
+			self.running = True
+			self.thread = threading.Thread(target=self.run, name="btchip-registry")
+			self.thread.daemon = True
+			self.thread.start()
+		# Cards come and go in readers that stay plugged, without any uevent
+		if SCARD and CARD_MONITOR and self.cardObserver is None:
+			self.cardObserver = ReaderCardObserver(self)
+			CardMonitor().addObserver(self.cardObserver)
+
+	def stop(self):
+		self.running = False
+		self.refreshNeeded.set()
+		if self.cardObserver is not None:
+			CardMonitor().deleteObserver(self.cardObserver)
+			self.cardObserver = None
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+	def run(self):
+		sock = openHotplugSocket() if self.hotplug else None
+		try:
+			while self.running:
+				if sock is not None:
+					readable = select.select([ sock ], [], [], min(self.rescanInterval, 0.5))[0]
+					if readable and isHotplugEvent(sock.recv(8192)):
+						# Let the device settle and coalesce the burst of events it generates
+						time.sleep(0.1)
+						while select.select([ sock ], [], [], 0)[0]:
+							sock.recv(8192)
+						self.refreshNeeded.set()
+				else:
+					self.refreshNeeded.wait(min(self.rescanInterval, 0.5))
+				if not self.running:
+					break
+				# The uevents tell when to rescan, the timer is only for systems without them
+				if self.refreshNeeded.is_set() or (sock is None and time.time() - self.lastRefresh >= self.rescanInterval):
+					self.refreshNeeded.clear()
+					try:
+						self.refresh()
+					except Exception:
+						pass
+		finally:
+			if sock is not None:
+				sock.close()
+
+defaultRegistry = None
+defaultRegistryLock = threading.Lock()
+
+def getRegistry():
+	global defaultRegistry
+	with defaultRegistryLock:
+		if defaultRegistry is None:
+			defaultRegistry = DeviceRegistry()
+			defaultRegistry.start()
+		return defaultRegistry
+
+def getCachedDongle(debug=False):
+	return getRegistry().getDongle(debug)
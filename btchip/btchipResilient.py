@@ -0,0 +1,176 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from .btchipComm import *
+from .btchipException import *
+import socket
+import time
+
+# Single APDU commands that can be sent again after a transport failure
+IDEMPOTENT_INSTRUCTIONS = [
+	0x24, # GET_OPERATION_MODE
+	0x40, # GET_WALLET_PUBLIC_KEY
+	0x4c, # GET_INTERNAL_CHAIN_INDEX
+	0xa0, # GET_TRANSACTION_LIMIT
+	0xb2, # GET_PUBLIC_KEY
+	0xc0, # GET_RANDOM
+	0xc2, # GET_ATTESTATION
+	0xc4  # GET_FIRMWARE_VERSION
+]
+
+INS_VERIFY_PIN = 0x22
+INS_GET_TRUSTED_INPUT = 0x42
+
+def isTransportError(error):
+	"""Failures of the link to the device, as opposed to status words returned by the device"""
+	if isinstance(error, BTChipException):
+		return error.sw is None
+	return isinstance(error, (IOError, OSError, ValueError, socket.error))
+
+class ResilientDongle(Dongle):
+	"""Reopen the device described by descriptor after a transport failure and retry what can
+	be retried. Idempotent commands are sent again and a getTrustedInput stream is replayed
+	from its header. Other multi-APDU operations (hash input, finalization, signatures) fail
+	fast, the caller restarts them and the device is reopened on the next exchange. A HID
+	device whose path changed is found again by its serial number.
+	With replayPin, the last verified PIN is kept in memory and presented again to the
+	reopened device, a replay that is not accepted is dropped and fails the reopen"""
+
+	def __init__(self, descriptor, debug=False, retries=3, backoff=0.1, maxBackoff=2.0, replayPin=False):
+		self.descriptor = descriptor
+		self.debug = debug
+		self.replayPin = replayPin
+		self.retries = retries
+		self.backoff = backoff
+		self.maxBackoff = maxBackoff
+		self.dongle = None
+		self.broken = False
+		self.trustedInputStream = None
+		self.pinApdu = None
+		self.reopens = 0
+		self.retried = 0
+		self.dongle = openDongle(descriptor, debug)
+
+	def getMaxDataLength(self):
+		return self.dongle.getMaxDataLength()
+
+	def session(self, priority=None, timeout=None):
+		return dongleSession(self.dongle, priority, timeout)
+
+	def findDescriptor(self):
+		if self.descriptor['type'] == 'hid' and self.descriptor.get('serial'):
+			for descriptor in enumerateHIDDongles():
+				if descriptor.get('serial') == self.descriptor['serial']:
+					return descriptor
+		return self.descriptor
+
+	def discard(self):
+		# The handle may be half dead, drop it whatever close does
+		dongle = self.dongle
+		self.dongle = None
+		if dongle is not None:
+			try:
+				dongle.close()
+			except Exception:
+				pass
+
+	def reopen(self):
+		self.discard()
+		descriptor = self.findDescriptor()
+		self.dongle = openDongle(descriptor, self.debug)
+		self.descriptor = descriptor
+		self.reopens += 1
+		self.broken = False
+		if self.pinApdu is not None:
+			try:
+				self.dongle.exchange(self.pinApdu)
+			except Exception as e:
+				# A refused PIN is never sent again, each attempt would use a retry
+				if not isTransportError(e):
+					self.pinApdu = None
+				raise
+
+	def reconnect(self, attempt):
+		"""Wait for the device to come back and reopen it, return the attempts made or None when
+		they are exhausted"""
+		while attempt < self.retries:
+			time.sleep(min(self.backoff * (2 ** attempt), self.maxBackoff))
+			attempt += 1
+			try:
+				self.reopen()
+				return attempt
+			except Exception as e:
+				if not isTransportError(e):
+					raise
+		return None
+
+	def isRetryable(self, apdu):
+		if apdu[0] == 0xf0:
+			return True
+		if apdu[1] in IDEMPOTENT_INSTRUCTIONS:
+			return True
+		# VERIFY_PIN is not retried, a wrong PIN sent twice would use two attempts
+		return apdu[1] == INS_GET_TRUSTED_INPUT and self.trustedInputStream is not None
+
+	def exchange(self, apdu, timeout=20000):
+		apdu = bytearray(apdu)
+		if self.broken or self.dongle is None:
+			attempt = self.reconnect(0)
+			if attempt is None:
+				raise BTChipTransportException("Device not available")
+		if apdu[0] != 0xf0 and apdu[1] == INS_GET_TRUSTED_INPUT:
+			if apdu[2] == 0x00:
+				self.trustedInputStream = []
+		elif self.trustedInputStream is not None:
+			self.trustedInputStream = None
+		attempt = 0
+		while True:
+			try:
+				if attempt != 0 and self.trustedInputStream:
+					for previous in self.trustedInputStream:
+						self.dongle.exchange(previous, timeout)
+				response = self.dongle.exchange(apdu, timeout)
+				break
+			except Exception as e:
+				if not isTransportError(e):
+					if apdu[1] == INS_GET_TRUSTED_INPUT:
+						self.trustedInputStream = None
+					raise
+				if not self.isRetryable(apdu):
+					self.broken = True
+					self.trustedInputStream = None
+					raise BTChipTransportException("Transport failure in an operation that can't be resumed, restart it : %s" % str(e))
+				attempt = self.reconnect(attempt)
+				if attempt is None:
+					self.broken = True
+					self.trustedInputStream = None
+					raise
+				self.retried += 1
+		if apdu[0] != 0xf0:
+			if apdu[1] == INS_VERIFY_PIN and apdu[2] == 0x00 and self.replayPin:
+				self.pinApdu = apdu
+			elif apdu[1] == INS_GET_TRUSTED_INPUT and self.trustedInputStream is not None:
+				if len(response) != 0:
+					self.trustedInputStream = None
+				else:
+					self.trustedInputStream.append(apdu)
+		return response
+
+	def close(self):
+		self.discard()
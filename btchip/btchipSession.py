@@ -0,0 +1,188 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from .btchipException import *
+from contextlib import contextmanager
+import heapq
+import itertools
+import threading
+import time
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BATCH = 2
+
+class PriorityLock(object):
+	"""Exclusive lock on a device, waiters are granted it by priority class (lowest value
+	first) then in arrival order"""
+
+	def __init__(self):
+		self.condition = threading.Condition()
+		self.owner = None
+		self.waiters = []
+		self.sequence = itertools.count()
+
+	def acquire(self, owner, priority=PRIORITY_NORMAL, timeout=None):
+		"""Block until owner holds the lock, return the time spent waiting"""
+		start = time.time()
+		with self.condition:
+			entry = (priority, next(self.sequence), owner)
+			heapq.heappush(self.waiters, entry)
+			while (self.owner is not None) or (self.waiters[0] is not entry):
+				remaining = None
+				if timeout is not None:
+					remaining = start + timeout - time.time()
+					if remaining <= 0:
+						self.waiters.remove(entry)
+						heapq.heapify(self.waiters)
+						self.condition.notify_all()
+						raise BTChipTimeoutException("Timeout waiting for the device")
+				self.condition.wait(remaining)
+			heapq.heappop(self.waiters)
+			self.owner = owner
+		return time.time() - start
+
+	def release(self, owner):
+		with self.condition:
+			if self.owner is not owner:
+				raise BTChipException("Lock not held")
+			self.owner = None
+			self.condition.notify_all()
+
+	def getQueueDepth(self):
+		with self.condition:
+			result = {}
+			for priority, sequence, owner in self.waiters:
+				result[priority] = result.get(priority, 0) + 1
+			return result
+
+class CancellationToken(object):
+	"""Set from any thread to stop the operations using it before their next APDU"""
+
+	def __init__(self):
+		self.event = threading.Event()
+
+	def cancel(self):
+		self.event.set()
+
+	@property
+	def cancelled(self):
+		return self.event.is_set()
+
+class Deadline(object):
+	"""Time budget of an operation, timeout seconds from now (None for no limit), with an
+	optional CancellationToken"""
+
+	def __init__(self, timeout=None, token=None):
+		self.expires = time.time() + timeout if timeout is not None else None
+		self.token = token
+
+	def getRemaining(self):
+		if self.expires is None:
+			return None
+		return max(self.expires - time.time(), 0.0)
+
+	def check(self):
+		if self.token is not None and self.token.cancelled:
+			raise BTChipCancelledException("Operation cancelled")
+		if self.expires is not None and time.time() >= self.expires:
+			raise BTChipTimeoutException("Operation deadline exceeded")
+
+	def getExchangeTimeout(self, timeout):
+		"""Exchange timeout in ms bounded by the remaining budget"""
+		remaining = self.getRemaining()
+		if remaining is None:
+			return timeout
+		return max(min(timeout, int(remaining * 1000)), 1)
+
+class Lease(object):
+	"""Exclusive use of a device for one logical operation, bounded by deadline when set"""
+
+	def __init__(self, priority):
+		self.priority = priority
+		self.deadline = None
+		self.waitTime = 0.0
+		self.holdTime = None
+		self.acquired = None
+
+class SessionScheduler(object):
+	"""Grant leases on a shared device to threads, by priority class then arrival order. A
+	thread holding a lease can take it again (nested operations), the device changes hands
+	only between outermost leases. onRelease, when given, is called with each finished Lease"""
+
+	def __init__(self, onRelease=None):
+		self.lock = PriorityLock()
+		self.owner = None
+		self.depth = 0
+		self.current = None
+		self.onRelease = onRelease
+		self.statsLock = threading.Lock()
+		self.statistics = {}
+
+	@contextmanager
+	def lease(self, priority=None, timeout=None):
+		if priority is None:
+			priority = PRIORITY_NORMAL
+		thread = threading.current_thread()
+		if self.owner is thread:
+			self.depth += 1
+			try:
+				yield self.current
+			finally:
+				self.depth -= 1
+			return
+		lease = Lease(priority)
+		lease.waitTime = self.lock.acquire(thread, priority, timeout)
+		lease.acquired = time.time()
+		self.owner = thread
+		self.current = lease
+		self.depth = 1
+		try:
+			yield lease
+		finally:
+			self.depth = 0
+			self.current = None
+			self.owner = None
+			lease.holdTime = time.time() - lease.acquired
+			self.lock.release(thread)
+			self.record(lease)
+
+	def record(self, lease):
+		with self.statsLock:
+			entry = self.statistics.get(lease.priority)
+			if entry is None:
+				entry = { 'leases': 0, 'waitTime': 0.0, 'holdTime': 0.0, 'maxWaitTime': 0.0 }
+				self.statistics[lease.priority] = entry
+			entry['leases'] += 1
+			entry['waitTime'] += lease.waitTime
+			entry['holdTime'] += lease.holdTime
+			entry['maxWaitTime'] = max(entry['maxWaitTime'], lease.waitTime)
+		if self.onRelease is not None:
+			try:
+				self.onRelease(lease)
+			except Exception:
+				pass
+
+	def getStatistics(self):
+		"""Lease counts and times by priority, with the callers queued right now"""
+		with self.statsLock:
+			result = dict((priority, dict(entry)) for priority, entry in self.statistics.items())
+		for priority, depth in self.lock.getQueueDepth().items():
+			result.setdefault(priority, { 'leases': 0, 'waitTime': 0.0, 'holdTime': 0.0, 'maxWaitTime': 0.0 })['queued'] = depth
+		return result
@@ -0,0 +1,228 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+# Shared memory transport to a proxy on the same host (Python 3.10+, Linux)
+#
+# The client says PROXY_SHM_MAGIC on the proxy unix socket. The proxy creates an anonymous
+# memory file (memfd) holding two rings (commands, responses) and two eventfds signalling them,
+# then sends PROXY_SHM_MAGIC and the u32 ring capacity with the three descriptors attached
+# (SCM_RIGHTS). Nothing is named, the memory goes away when both sides unmap it. The unix
+# socket then only tells the proxy the client is gone.
+#
+# Ring layout : u64 head (advanced by the consumer), u64 tail (advanced by the producer), then
+# capacity bytes of messages, each u32 length + data, wrapping around. Command messages are the
+# APDU, response messages are u16 sw + data.
+
+from .btchipComm import *
+from .btchipException import *
+from .btchipObserver import clock
+import mmap
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+RING_CAPACITY = 65536
+RING_HEADER = struct.Struct("<QQ")
+RING_LENGTH = struct.Struct("<I")
+EVENT = struct.pack("=Q", 1)
+
+class SharedMemoryRing(object):
+	"""Single producer, single consumer message ring at offset in buffer"""
+
+	def __init__(self, buffer, offset, capacity):
+		self.buffer = buffer
+		self.offset = offset
+		self.base = offset + RING_HEADER.size
+		self.capacity = capacity
+
+	@staticmethod
+	def getSize(capacity):
+		return RING_HEADER.size + capacity
+
+	def write(self, position, data):
+		start = position % self.capacity
+		first = min(len(data), self.capacity - start)
+		self.buffer[self.base + start : self.base + start + first] = data[0:first]
+		if first < len(data):
+			self.buffer[self.base : self.base + len(data) - first] = data[first:]
+
+	def read(self, position, size):
+		start = position % self.capacity
+		first = min(size, self.capacity - start)
+		data = bytes(self.buffer[self.base + start : self.base + start + first])
+		if first < size:
+			data += bytes(self.buffer[self.base : self.base + size - first])
+		return data
+
+	def put(self, data):
+		"""Append a message, False when the ring does not have room for it now"""
+		head, tail = RING_HEADER.unpack_from(self.buffer, self.offset)
+		size = RING_LENGTH.size + len(data)
+		if size > self.capacity - (tail - head):
+			return False
+		self.write(tail, RING_LENGTH.pack(len(data)) + bytes(data))
+		struct.pack_into("<Q", self.buffer, self.offset + 8, tail + size)
+		return True
+
+	def get(self):
+		"""Remove the oldest message, None when the ring is empty"""
+		head, tail = RING_HEADER.unpack_from(self.buffer, self.offset)
+		if head == tail:
+			return None
+		length = RING_LENGTH.unpack(self.read(head, RING_LENGTH.size))[0]
+		data = self.read(head + RING_LENGTH.size, length)
+		struct.pack_into("<Q", self.buffer, self.offset, head + RING_LENGTH.size + length)
+		return data
+
+class DongleSharedMemory(Dongle):
+	"""Dongle served by a DongleProxyServer listening on unix:<path>, APDUs and responses go
+	through shared memory and only the eventfd notifications through the kernel"""
+
+	def __init__(self, server, debug=False):
+		self.server = server
+		self.debug = debug
+		self.memory = None
+		self.connect()
+
+	def connect(self):
+		self.socket = connectProxy(self.server, 0)
+		if self.socket.family != socket.AF_UNIX:
+			self.socket.close()
+			raise BTChipException("Shared memory transport requires a unix: proxy address")
+		fds = []
+		try:
+			self.socket.sendall(PROXY_SHM_MAGIC)
+			message, fds, flags, address = socket.recv_fds(self.socket, 64, 3)
+			if message[0:len(PROXY_SHM_MAGIC)] != PROXY_SHM_MAGIC or len(fds) != 3:
+				raise BTChipException("Proxy does not support the shared memory transport")
+			capacity = RING_LENGTH.unpack_from(message, len(PROXY_SHM_MAGIC))[0]
+			self.memory = mmap.mmap(fds[0], 2 * SharedMemoryRing.getSize(capacity))
+		except (socket.error, ValueError, struct.error):
+			for fd in fds:
+				os.close(fd)
+			self.socket.close()
+			raise BTChipTransportException("Proxy connection failed")
+		os.close(fds[0])
+		self.requestEvent, self.responseEvent = fds[1:]
+		self.requests = SharedMemoryRing(self.memory, 0, capacity)
+		self.responses = SharedMemoryRing(self.memory, SharedMemoryRing.getSize(capacity), capacity)
+
+	def exchange(self, apdu, timeout=20000):
+		if self.observers:
+			return self.observe(self.transmit, apdu, timeout)
+		return self.transmit(apdu, timeout)
+
+	def transmit(self, apdu, timeout=20000, event=None):
+		if self.memory is None:
+			raise BTChipTransportException("Proxy connection closed")
+		if self.debug:
+			print("=> %s" % hexlify(apdu))
+		if not self.requests.put(apdu):
+			raise BTChipException("APDU too large for the shared memory ring")
+		os.write(self.requestEvent, EVENT)
+		start = clock()
+		if event is not None:
+			event.written = start
+		deadline = start + timeout / 1000.0
+		while True:
+			message = self.responses.get()
+			if message is not None:
+				break
+			now = clock()
+			if now >= deadline or not select.select([ self.responseEvent ], [], [], deadline - now)[0]:
+				# A late response would be read by the next exchange
+				self.close()
+				raise BTChipTransportException("Timeout")
+			os.read(self.responseEvent, 8)
+		if event is not None:
+			event.firstResponse = clock()
+		sw = struct.unpack_from(">H", message)[0]
+		response = bytearray(message[2:])
+		if event is not None:
+			event.responseSize = len(response)
+			event.sw = sw
+		if self.debug:
+			print("<= %s%.2x" % (hexlify(response), sw))
+		if sw != 0x9000:
+			raise BTChipException("Invalid status %04x" % sw, sw)
+		return response
+
+	def resync(self, timeout=200):
+		# The rings are dropped after a timeout and may hold a late response, get new ones
+		self.close()
+		self.connect()
+
+	def close(self):
+		if self.memory is None:
+			return
+		self.requests = None
+		self.responses = None
+		self.memory.close()
+		self.memory = None
+		for fd in [ self.requestEvent, self.responseEvent ]:
+			os.close(fd)
+		self.socket.close()
+
+def serveSharedMemory(client, device, capacity=RING_CAPACITY):
+	"""Serve a DongleSharedMemory client connected to the proxy unix socket with device, a
+	btchipProxy.ProxyDevice"""
+	ringSize = SharedMemoryRing.getSize(capacity)
+	memoryFd = os.memfd_create("btchip-proxy")
+	os.ftruncate(memoryFd, 2 * ringSize)
+	memory = mmap.mmap(memoryFd, 2 * ringSize)
+	requestEvent = os.eventfd(0)
+	responseEvent = os.eventfd(0)
+	requests = SharedMemoryRing(memory, 0, capacity)
+	responses = SharedMemoryRing(memory, ringSize, capacity)
+	lock = threading.Lock()
+	state = { 'closed': False }
+	def reply(response, sw):
+		with lock:
+			while not state['closed'] and not responses.put(struct.pack(">H", sw) + bytes(response)):
+				time.sleep(0.0005)
+			if not state['closed']:
+				os.write(responseEvent, EVENT)
+	try:
+		socket.send_fds(client, [ PROXY_SHM_MAGIC + RING_LENGTH.pack(capacity) ], [ memoryFd, requestEvent, responseEvent ])
+		os.close(memoryFd)
+		memoryFd = None
+		while True:
+			readable = select.select([ client, requestEvent ], [], [])[0]
+			if client in readable and len(client.recv(1)) == 0:
+				break
+			if requestEvent in readable:
+				os.read(requestEvent, 8)
+				while True:
+					apdu = requests.get()
+					if apdu is None:
+						break
+					device.submit(bytearray(apdu), reply)
+	except socket.error:
+		pass
+	finally:
+		with lock:
+			state['closed'] = True
+			if memoryFd is not None:
+				os.close(memoryFd)
+			memory.close()
+			os.close(requestEvent)
+			os.close(responseEvent)
@@ -0,0 +1,282 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+# APDU traces : RecordingDongle appends every exchange of a dongle to a trace file,
+# ReplayDongle serves a trace back without the device, TraceBuffer keeps the last exchanges
+# of a dongle in memory for post-mortems
+#
+# Trace file layout, all integers big endian
+#   header : "BTCTRACE" u16 version u16 reserved u32 reserved
+#   record : u32 command length, u32 response length, u16 sw, u16 flags,
+#            f64 start time, f64 latency, command, response
+# Records are appended with a single write, a truncated last record is ignored by readers.
+# A record flagged TRACE_FLAG_ERROR is a transport failure (timeout, disconnection), its
+# response holds the exception message.
+
+from .btchipComm import *
+from .btchipException import *
+from .btchipObserver import DongleObserver, clock
+from binascii import hexlify
+from collections import namedtuple
+import mmap
+import os
+import signal
+import struct
+import sys
+import threading
+import time
+
+TRACE_MAGIC = b"BTCTRACE"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct(">8sHHI")
+TRACE_RECORD = struct.Struct(">IIHHdd")
+
+TRACE_FLAG_ERROR = 0x0001
+
+def packTraceRecord(apdu, response, sw, flags, timestamp, latency):
+	apdu = bytes(apdu)
+	response = bytes(response)
+	return TRACE_RECORD.pack(len(apdu), len(response), sw, flags, timestamp, latency) + apdu + response
+
+def getTraceRecordStatus(error):
+	"""Response, sw and flags of the record of an exchange that raised error"""
+	if isinstance(error, BTChipException) and error.sw is not None and error.message == "Invalid status %04x" % error.sw:
+		return b"", error.sw, 0
+	sw = error.sw if isinstance(error, BTChipException) and error.sw is not None else 0x6f00
+	message = error.message if isinstance(error, BTChipException) else str(error)
+	return str(message).encode('utf-8'), sw, TRACE_FLAG_ERROR
+
+class TraceRecord(object):
+	"""One exchange of a trace, the command and response are read from the file on access"""
+
+	def __init__(self, data, offset):
+		self.data = data
+		self.offset = offset
+		self.commandLength, self.responseLength, self.sw, self.flags, self.timestamp, self.latency = TRACE_RECORD.unpack_from(data, offset)
+
+	@property
+	def size(self):
+		return TRACE_RECORD.size + self.commandLength + self.responseLength
+
+	@property
+	def ins(self):
+		if self.commandLength < 2:
+			return None
+		return bytearray(self.data[self.offset + TRACE_RECORD.size + 1 : self.offset + TRACE_RECORD.size + 2])[0]
+
+	@property
+	def command(self):
+		start = self.offset + TRACE_RECORD.size
+		return bytearray(self.data[start : start + self.commandLength])
+
+	@property
+	def response(self):
+		start = self.offset + TRACE_RECORD.size + self.commandLength
+		return bytearray(self.data[start : start + self.responseLength])
+
+	@property
+	def error(self):
+		return (self.flags & TRACE_FLAG_ERROR) != 0
+
+class TraceReader(object):
+	"""Memory mapped view of a trace file, iterating only decodes the record headers"""
+
+	def __init__(self, path):
+		self.file = open(path, "rb")
+		size = os.fstat(self.file.fileno()).st_size
+		if size < TRACE_HEADER.size:
+			self.file.close()
+			raise BTChipException("Invalid trace file")
+		self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, reserved1, reserved2 = TRACE_HEADER.unpack_from(self.data, 0)
+		if magic != TRACE_MAGIC or version != TRACE_VERSION:
+			self.close()
+			raise BTChipException("Invalid trace file")
+
+	def __iter__(self):
+		offset = TRACE_HEADER.size
+		size = len(self.data)
+		while offset + TRACE_RECORD.size <= size:
+			record = TraceRecord(self.data, offset)
+			if offset + record.size > size:
+				break
+			yield record
+			offset += record.size
+
+	def close(self):
+		if self.data is not None:
+			self.data.close()
+			self.data = None
+		self.file.close()
+
+class RecordingDongle(Dongle):
+
+	def __init__(self, dongle, path):
+		self.dongle = dongle
+		self.path = path
+		self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+		if os.fstat(self.fd).st_size == 0:
+			os.write(self.fd, TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, 0, 0))
+
+	def record(self, apdu, response, sw, flags, timestamp, latency):
+		os.write(self.fd, packTraceRecord(apdu, response, sw, flags, timestamp, latency))
+
+	def exchange(self, apdu, timeout=20000):
+		timestamp = time.time()
+		start = clock()
+		try:
+			response = self.dongle.exchange(apdu, timeout)
+		except Exception as e:
+			response, sw, flags = getTraceRecordStatus(e)
+			self.record(apdu, response, sw, flags, timestamp, clock() - start)
+			raise
+		latency = clock() - start
+		self.record(apdu, response, 0x9000, 0, timestamp, latency)
+		return response
+
+	def getMaxDataLength(self):
+		return getattr(self.dongle, 'getMaxDataLength', lambda: 255)()
+
+	def session(self, priority=None, timeout=None):
+		return dongleSession(self.dongle, priority, timeout)
+
+	def resync(self, timeout=200):
+		self.dongle.resync(timeout)
+
+	def close(self):
+		if self.fd is not None:
+			os.close(self.fd)
+			self.fd = None
+		self.dongle.close()
+
+class ReplayDongle(Dongle):
+	"""Serve the responses of a trace in order. With timing set, each exchange takes the
+	recorded latency divided by speed. With strict set, commands must match the trace"""
+
+	def __init__(self, path, timing=False, speed=1.0, strict=True, debug=False):
+		self.reader = TraceReader(path)
+		self.records = iter(self.reader)
+		self.timing = timing
+		self.speed = speed
+		self.strict = strict
+		self.debug = debug
+
+	def exchange(self, apdu, timeout=20000):
+		if self.debug:
+			print("=> %s" % hexlify(apdu))
+		start = time.time()
+		try:
+			record = next(self.records)
+		except StopIteration:
+			raise BTChipException("End of trace")
+		if self.strict and record.command != bytearray(apdu):
+			raise BTChipException("Command does not match the trace")
+		response = record.response
+		if self.timing:
+			remaining = record.latency / self.speed - (time.time() - start)
+			if remaining > 0:
+				time.sleep(remaining)
+		if record.error:
+			raise BTChipTransportException(bytes(response).decode('utf-8'))
+		if self.debug:
+			print("<= %s%.2x" % (hexlify(response), record.sw))
+		if record.sw != 0x9000:
+			raise BTChipException("Invalid status %04x" % record.sw, record.sw)
+		return response
+
+	def close(self):
+		self.reader.close()
+
+# sw is None and error set for exchanges that failed without a status word
+TraceEntry = namedtuple('TraceEntry', [ 'timestamp', 'latency', 'command', 'response', 'sw', 'error' ])
+
+class TraceBuffer(DongleObserver):
+	"""Last size exchanges of the dongles it observes, kept as raw bytes. Nothing is formatted
+	until the entries are dumped, on demand, from a signal handler or through the trace
+	attribute of the BTChipTransportException raised by a transport failure"""
+
+	def __init__(self, size=64, attachToExceptions=True):
+		self.size = size
+		self.attachToExceptions = attachToExceptions
+		# Reentrant, the signal handler dumping the entries may interrupt an update
+		self.lock = threading.RLock()
+		self.entries = [ None ] * size
+		self.written = 0
+
+	def onExchange(self, event):
+		response = bytes(event.response) if event.response is not None else b""
+		entry = TraceEntry(event.timestamp, event.totalTime, bytes(event.command), response, event.sw, event.error)
+		with self.lock:
+			self.entries[self.written % self.size] = entry
+			self.written += 1
+		# Status words are routine, only transport failures get a copy of the entries
+		if self.attachToExceptions and isinstance(event.error, BTChipException) and event.error.sw is None:
+			event.error.trace = self.getEntries()
+
+	def getEntries(self):
+		"""Entries from the oldest to the most recent"""
+		with self.lock:
+			written = self.written
+			entries = self.entries[:]
+		if written <= self.size:
+			result = entries[0:written]
+		else:
+			start = written % self.size
+			result = entries[start:] + entries[0:start]
+		return [ entry for entry in result if entry is not None ]
+
+	def clear(self):
+		with self.lock:
+			self.entries = [ None ] * self.size
+			self.written = 0
+
+	def dump(self, output=None):
+		if output is None:
+			output = sys.stderr
+		output.write(formatTrace(self.getEntries()))
+		output.flush()
+
+	def save(self, path):
+		"""Write the entries to a trace file that ReplayDongle can serve"""
+		data = TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, 0, 0)
+		for entry in self.getEntries():
+			if entry.error is None:
+				response, sw, flags = entry.response, entry.sw, 0
+			else:
+				response, sw, flags = getTraceRecordStatus(entry.error)
+			data += packTraceRecord(entry.command, response, sw, flags, entry.timestamp, entry.latency)
+		with open(path, "wb") as output:
+			output.write(data)
+
+	def installSignalHandler(self, signum=None, output=None):
+		"""Dump the entries when the process receives signum (SIGUSR1 by default), to be called
+		from the main thread. Returns the previous handler"""
+		if signum is None:
+			signum = signal.SIGUSR1
+		return signal.signal(signum, lambda received, frame: self.dump(output))
+
+def formatTrace(entries):
+	lines = []
+	for entry in entries:
+		lines.append("%s %8.3fms => %s" % (time.strftime("%H:%M:%S", time.localtime(entry.timestamp)), entry.latency * 1000, hexlify(entry.command).decode('ascii')))
+		if entry.sw is not None:
+			lines.append("%s %8s <= %s%.4x" % (" " * 8, "", hexlify(entry.response).decode('ascii'), entry.sw))
+		else:
+			lines.append("%s %8s !! %s" % (" " * 8, "", str(entry.error)))
+	return "".join(line + "\n" for line in lines)
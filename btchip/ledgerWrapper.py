@@ -18,75 +18,153 @@
 """
 
 import struct
-from .btchipException import BTChipException
+import threading
+from .btchipException import BTChipException, BTChipTransportException
 
-def wrapCommandAPDU(channel, command, packetSize):
-	if packetSize < 3:
-		raise BTChipException("Can't handle Ledger framing with less than 3 bytes for the report")
-	sequenceIdx = 0		
+DEFAULT_CHANNEL = 0x0101
+DEFAULT_PACKET_SIZE = 64
+
+def getCommandReportCount(command, packetSize):
+	if len(command) <= packetSize - 7:
+		return 1
+	return 1 + (len(command) - (packetSize - 7) + packetSize - 6) // (packetSize - 5)
+
+def wrapCommandReports(channel, command, packetSize, reportIdSize=0):
+	"""Frame a command into a single preallocated buffer of reports, each one preceded by
+	reportIdSize zero bytes for the HID report ID. The command is left untouched"""
+	if packetSize < 8:
+		raise BTChipException("Can't handle Ledger framing with less than 8 bytes for the report")
+	if not isinstance(command, (bytes, bytearray)):
+		command = bytearray(command)
+	command = memoryview(command)
+	reportSize = reportIdSize + packetSize
+	result = bytearray(getCommandReportCount(command, packetSize) * reportSize)
 	offset = 0
-	result = struct.pack(">HBHH", channel, 0x05, sequenceIdx, len(command))
-	sequenceIdx = sequenceIdx + 1
-	if len(command) > packetSize - 7:
-		blockSize = packetSize - 7
-	else:
-		blockSize = len(command)
-	result += command[offset : offset + blockSize]
-	offset = offset + blockSize
-	while offset != len(command):
-		result += struct.pack(">HBH", channel, 0x05, sequenceIdx)
-		sequenceIdx = sequenceIdx + 1
-		if (len(command) - offset) > packetSize - 5:
-			blockSize = packetSize - 5
+	sequenceIdx = 0
+	for reportOffset in range(reportIdSize, len(result), reportSize):
+		if sequenceIdx == 0:
+			struct.pack_into(">HBHH", result, reportOffset, channel, 0x05, sequenceIdx, len(command))
+			dataOffset = reportOffset + 7
 		else:
-			blockSize = len(command) - offset
-		result += command[offset : offset + blockSize]
-		offset = offset + blockSize
-	while (len(result) % packetSize) != 0:
-		result += b"\x00"
-	return bytearray(result)
+			struct.pack_into(">HBH", result, reportOffset, channel, 0x05, sequenceIdx)
+			dataOffset = reportOffset + 5
+		blockSize = min(len(command) - offset, reportOffset + packetSize - dataOffset)
+		result[dataOffset : dataOffset + blockSize] = command[offset : offset + blockSize]
+		offset += blockSize
+		sequenceIdx += 1
+	return result
+
+def splitReports(data, reportSize):
+	view = memoryview(data)
+	for offset in range(0, len(data), reportSize):
+		yield view[offset : offset + reportSize]
+
+def wrapCommandAPDU(channel, command, packetSize):
+	return wrapCommandReports(channel, command, packetSize)
+
+class LedgerFrameDecoder(object):
+	"""Decode a framed response one report at a time, checking only the report received
+	and copying its payload into a buffer allocated once from the length header"""
+
+	def __init__(self, channel, packetSize):
+		if packetSize < 8:
+			raise BTChipException("Can't handle Ledger framing with less than 8 bytes for the report")
+		self.channel = channel
+		self.packetSize = packetSize
+		self.reset()
+
+	def reset(self):
+		self.sequenceIdx = 0
+		self.offset = 0
+		self.response = None
+
+	def isComplete(self):
+		return (self.response is not None) and (self.offset == len(self.response))
+
+	def feed(self, report):
+		if self.isComplete():
+			raise BTChipException("Response already complete")
+		if len(report) < 5:
+			raise BTChipTransportException("Invalid report size")
+		if ((report[0] << 8) | report[1]) != self.channel:
+			raise BTChipTransportException("Invalid channel")
+		if report[2] != 0x05:
+			raise BTChipTransportException("Invalid tag")
+		if ((report[3] << 8) | report[4]) != self.sequenceIdx:
+			raise BTChipTransportException("Invalid sequence")
+		offset = 5
+		if self.sequenceIdx == 0:
+			if len(report) < 7:
+				raise BTChipTransportException("Invalid report size")
+			self.response = bytearray((report[5] << 8) | report[6])
+			offset = 7
+		blockSize = min(len(self.response) - self.offset, self.packetSize - offset, len(report) - offset)
+		self.response[self.offset : self.offset + blockSize] = report[offset : offset + blockSize]
+		self.offset += blockSize
+		self.sequenceIdx += 1
+		return self.isComplete()
+
+class LedgerFrameDemultiplexer(object):
+	"""Decode responses framed on several channels whose reports are interleaved on one link,
+	with a decoder per open channel"""
+
+	def __init__(self, packetSize):
+		self.packetSize = packetSize
+		self.decoders = {}
+
+	def open(self, channel):
+		self.decoders[channel] = LedgerFrameDecoder(channel, self.packetSize)
+
+	def close(self, channel):
+		self.decoders.pop(channel, None)
+
+	def feed(self, report):
+		"""(channel, response) when report completes a response, None otherwise. Reports on
+		channels that are not open are dropped"""
+		if len(report) < 5:
+			raise BTChipTransportException("Invalid report size")
+		decoder = self.decoders.get((report[0] << 8) | report[1])
+		if decoder is None or not decoder.feed(report):
+			return None
+		response = decoder.response
+		decoder.reset()
+		return (decoder.channel, response)
+
+class ChannelAllocator(object):
+	"""Hand out the channels from first to last that are not in use"""
+
+	def __init__(self, first=DEFAULT_CHANNEL, last=0xfffe):
+		self.first = first
+		self.last = last
+		self.lock = threading.Lock()
+		self.used = set()
+		self.next = first
+
+	def reserve(self, channel):
+		with self.lock:
+			if channel in self.used:
+				raise BTChipException("Channel already in use")
+			self.used.add(channel)
+
+	def allocate(self):
+		with self.lock:
+			for i in range(self.last - self.first + 1):
+				channel = self.first + (self.next - self.first + i) % (self.last - self.first + 1)
+				if channel not in self.used:
+					self.used.add(channel)
+					self.next = channel + 1 if channel < self.last else self.first
+					return channel
+		raise BTChipException("No channel available")
+
+	def release(self, channel):
+		with self.lock:
+			self.used.discard(channel)
 
 def unwrapResponseAPDU(channel, data, packetSize):
-	sequenceIdx = 0		
-	offset = 0
 	if ((data is None) or (len(data) < 7 + 5)):
 		return None
-	if struct.unpack(">H", data[offset : offset + 2])[0] != channel:
-		raise BTChipException("Invalid channel")
-	offset += 2
-	if data[offset] != 0x05:
-		raise BTChipException("Invalid tag")
-	offset += 1
-	if struct.unpack(">H", data[offset : offset + 2])[0] != sequenceIdx:
-		raise BTChipException("Invalid sequence")
-	offset += 2
-	responseLength = struct.unpack(">H", data[offset : offset + 2])[0]
-	offset += 2
-	if len(data) < 7 + responseLength:
-		return None
-	if responseLength > packetSize - 7:
-		blockSize = packetSize - 7
-	else:
-		blockSize = responseLength
-	result = data[offset : offset + blockSize]
-	offset += blockSize
-	while (len(result) != responseLength):
-		sequenceIdx = sequenceIdx + 1
-		if (offset == len(data)):
-			return None
-		if struct.unpack(">H", data[offset : offset + 2])[0] != channel:
-			raise BTChipException("Invalid channel")
-		offset += 2
-		if data[offset] != 0x05:
-			raise BTChipException("Invalid tag")
-		offset += 1
-		if struct.unpack(">H", data[offset : offset + 2])[0] != sequenceIdx:
-			raise BTChipException("Invalid sequence")
-		offset += 2
-		if (responseLength - len(result)) > packetSize - 5:
-			blockSize = packetSize - 5
-		else:
-			blockSize = responseLength - len(result)
-		result += data[offset : offset + blockSize]
-		offset += blockSize
-	return bytearray(result)
+	decoder = LedgerFrameDecoder(channel, packetSize)
+	for offset in range(0, len(data), packetSize):
+		if decoder.feed(data[offset : offset + packetSize]):
+			return decoder.response
+	return None
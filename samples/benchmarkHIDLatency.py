@@ -0,0 +1,114 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+# Per-APDU latency of the HID transport, legacy 20 ms sleep-poll against blocking reads.
+# Uses a simulated HID device unless --device is given, in which case GET FIRMWARE VERSION
+# is exchanged with the first dongle found.
+
+from btchip.btchipComm import *
+from btchip.ledgerWrapper import wrapCommandAPDU
+import argparse
+import threading
+import time
+
+GET_FIRMWARE_VERSION = bytearray([0xe0, 0xc4, 0x00, 0x00, 0x00])
+
+class PollingWait(DongleWait):
+	# Reproduces the first response wait used before blocking reads
+
+	def __init__(self, dongle):
+		self.dongle = dongle
+
+	def waitFirstResponse(self, timeout):
+		start = time.time()
+		data = ""
+		while len(data) == 0:
+			data = self.dongle.device.read(65)
+			if not len(data):
+				if time.time() - start > timeout / 1000.0:
+					raise BTChipException("Timeout")
+				time.sleep(0.02)
+		return bytearray(data)
+
+class SimulatedHIDDevice(object):
+
+	def __init__(self, processingTime):
+		self.processingTime = processingTime
+		self.reports = []
+		self.readyAt = None
+		self.condition = threading.Condition()
+		self.response = wrapCommandAPDU(0x0101, bytearray([0x01, 0x00, 0x01, 0x04, 0x03, 0x90, 0x00]), 64)
+
+	def set_nonblocking(self, nonblocking):
+		pass
+
+	def write(self, data):
+		with self.condition:
+			self.readyAt = time.time() + self.processingTime
+			self.reports = [ self.response[offset : offset + 64] for offset in range(0, len(self.response), 64) ]
+			self.condition.notify()
+		return len(data)
+
+	def read(self, size, timeout_ms=0):
+		with self.condition:
+			deadline = time.time() + timeout_ms / 1000.0
+			while True:
+				now = time.time()
+				if self.reports and now >= self.readyAt:
+					return list(self.reports.pop(0))
+				if timeout_ms == 0 or now >= deadline:
+					return []
+				wakeup = deadline
+				if self.reports:
+					wakeup = min(deadline, self.readyAt)
+				self.condition.wait(wakeup - now)
+
+	def close(self):
+		pass
+
+def measure(dongle, count):
+	latencies = []
+	for i in range(count):
+		start = time.time()
+		dongle.exchange(bytearray(GET_FIRMWARE_VERSION))
+		latencies.append(time.time() - start)
+	latencies.sort()
+	return latencies
+
+def report(name, latencies):
+	print("%-10s mean %7.2f ms  p50 %7.2f ms  p99 %7.2f ms" % (name,
+		1000 * sum(latencies) / len(latencies),
+		1000 * latencies[len(latencies) // 2],
+		1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]))
+
+parser = argparse.ArgumentParser(description="Measure per-APDU latency of the HID transport")
+parser.add_argument("--count", type=int, default=200, help="APDUs exchanged per mode")
+parser.add_argument("--processing", type=float, default=3.0, help="simulated device processing time in ms")
+parser.add_argument("--device", action="store_true", help="use the first connected dongle")
+args = parser.parse_args()
+
+if args.device:
+	dongle = getDongle(False)
+else:
+	dongle = HIDDongleHIDAPI(SimulatedHIDDevice(args.processing / 1000.0), True)
+dongle.setWaitImpl(PollingWait(dongle))
+report("poll", measure(dongle, args.count))
+dongle.setWaitImpl(dongle)
+report("blocking", measure(dongle, args.count))
+dongle.close()
@@ -0,0 +1,75 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+# End-to-end signing time through DongleServer as a function of the RTT to the proxy. An
+# emulated dongle is served by a local proxy, reached through a latency injecting relay.
+# Protocol v2 pipelines the APDUs of each stream and waits for fewer round trips than v1.
+
+from btchip.btchip import *
+from btchip.btchipBench import TRANSACTION, UTX
+from btchip.btchipEmulator import EmulatedDongle
+from btchip.btchipLatencyProxy import LatencyProxy
+from btchip.btchipProxy import DongleProxyServer
+from btchip.btchipUtils import *
+import argparse
+import time
+
+def sign(app, transaction):
+	trustedInput = app.getTrustedInput(transaction, 1)
+	app.startUntrustedTransaction(True, 0, [ trustedInput ], transaction.outputs[1].script)
+	app.finalizeInput(b"", 0, 0, "0'/1/0", TRANSACTION)
+	app.untrustedHashSign("0'/0/0", "")
+
+def openClient(address, protocol):
+	if protocol == 2:
+		return DongleServerConnection(address[0], address[1]).openSession(False, True)
+	return DongleServer(address[0], address[1])
+
+parser = argparse.ArgumentParser(description="Measure signing time through a proxy against the RTT")
+parser.add_argument("--rtt", default="0,1,5,10,25,50,100", help="comma separated RTTs in ms")
+parser.add_argument("--jitter", type=float, default=0.0, help="maximum added delay per chunk in ms")
+parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second in each direction")
+parser.add_argument("--packet-delay", type=float, default=0.0, help="delay per packet in ms")
+parser.add_argument("--latency", type=float, default=0.0, help="emulated device time per APDU in ms")
+parser.add_argument("--count", type=int, default=5, help="signatures per RTT")
+parser.add_argument("--protocol", default="1,2", help="comma separated proxy protocols to compare")
+args = parser.parse_args()
+
+emulator = EmulatedDongle(latency=args.latency / 1000.0)
+server = DongleProxyServer([ emulator ]).start()
+transaction = bitcoinTransaction(UTX)
+protocols = [ int(value) for value in args.protocol.split(",") ]
+print("%8s %9s %12s %8s %14s %12s" % ("rtt ms", "protocol", "sign ms", "apdus", "ms per apdu", "round trips"))
+for rtt in [ float(value) for value in args.rtt.split(",") ]:
+	relay = LatencyProxy(server.address, rtt=rtt / 1000.0, jitter=args.jitter / 1000.0, bandwidth=args.bandwidth, packetDelay=args.packet_delay / 1000.0, seed=0).start()
+	for protocol in protocols:
+		dongle = openClient(relay.address, protocol)
+		app = btchip(dongle)
+		exchanges = emulator.exchanges
+		start = time.time()
+		for i in range(args.count):
+			sign(app, transaction)
+		elapsed = (time.time() - start) / args.count
+		apdus = float(emulator.exchanges - exchanges) / args.count
+		# Round trips waited for, estimated from the time spent beyond the device
+		roundTrips = (elapsed - apdus * args.latency / 1000.0) / (rtt / 1000.0) if rtt > 0 else float('nan')
+		print("%8.1f %9d %12.1f %8.1f %14.2f %12.1f" % (rtt, protocol, 1000 * elapsed, apdus, 1000 * elapsed / apdus, roundTrips))
+		dongle.close()
+	relay.stop()
+server.stop()
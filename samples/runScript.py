@@ -17,38 +17,107 @@
 ********************************************************************************
 """
 
+# Replay an APDU script on one or several devices in parallel and report the latency of each
+# instruction. Script lines are hex APDUs, optionally quoted and comma separated. Lines starting
+# with # or holding [ or ] are ignored, a line starting with ! is sent without waiting for the
+# response.
+
 from btchip.btchip import *
-import sys
+from btchip.btchipBench import getPercentile
+from btchip.btchipObserver import clock
+import argparse
 import binascii
+import sys
+import threading
+
+def parseScript(path):
+	"""List of (apdu, cancelResponse)"""
+	apdus = []
+	with open(path, "r") as scriptFile:
+		for line in scriptFile:
+			line = line.strip()
+			if len(line) == 0 or line[0] == '#' or '[' in line or ']' in line:
+				continue
+			cancelResponse = (line[0] == '!')
+			if cancelResponse:
+				line = line[1:]
+			line = line.replace('"', '').replace(',', '').replace(' ', '')
+			if len(line) != 0:
+				apdus.append((bytearray(binascii.unhexlify(line)), cancelResponse))
+	return apdus
+
+def runScript(dongle, apdus, iterations, latencies):
+	"""Run apdus iterations times, appending the latency of each APDU whose response is waited
+	for to latencies[ins]"""
+	for iteration in range(iterations):
+		for apdu, cancelResponse in apdus:
+			if cancelResponse:
+				# Only the time to give up on the response would be measured
+				try:
+					dongle.exchange(apdu, 1)
+				except Exception as e:
+					# The response given up on would be read by the next APDU
+					if not isinstance(e, BTChipException) or e.sw is None:
+						dongle.resync()
+				continue
+			start = clock()
+			dongle.exchange(apdu, 10000)
+			latencies.setdefault(apdu[1], []).append(clock() - start)
+
+def main():
+	parser = argparse.ArgumentParser(description="Replay an APDU script and report latencies")
+	parser.add_argument("script")
+	parser.add_argument("--iterations", type=int, default=1, help="times the script is run on each device")
+	parser.add_argument("--devices", type=int, default=1, help="devices to run the script on in parallel")
+	parser.add_argument("--emulator", action="store_true", help="run on emulated dongles")
+	parser.add_argument("--debug", action="store_true", help="print the APDUs, slows the replay down")
+	args = parser.parse_args()
+
+	apdus = parseScript(args.script)
+	if args.emulator:
+		from btchip.btchipEmulator import EmulatedDongle
+		dongles = [ EmulatedDongle(debug=args.debug) for i in range(args.devices) ]
+	elif args.devices == 1:
+		dongles = [ getDongle(args.debug) ]
+	else:
+		descriptors = enumerateDongles()
+		if len(descriptors) < args.devices:
+			raise BTChipException("%d devices found" % len(descriptors))
+		dongles = [ openDongle(descriptor, args.debug) for descriptor in descriptors[0:args.devices] ]
+
+	results = [ {} for dongle in dongles ]
+	errors = [ None ] * len(dongles)
+	def run(index):
+		try:
+			runScript(dongles[index], apdus, args.iterations, results[index])
+		except Exception as e:
+			errors[index] = e
+	threads = [ threading.Thread(target=run, args=(index,)) for index in range(len(dongles)) ]
+	start = clock()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	elapsed = clock() - start
+	for dongle in dongles:
+		dongle.close()
+
+	latencies = {}
+	for result in results:
+		for ins, values in result.items():
+			latencies.setdefault(ins, []).extend(values)
+	print("%4s %8s %10s %10s %10s %10s" % ("ins", "count", "mean ms", "p50 ms", "p95 ms", "max ms"))
+	total = 0
+	for ins in sorted(latencies.keys()):
+		values = sorted(latencies[ins])
+		total += len(values)
+		print("%4.2x %8d %10.3f %10.3f %10.3f %10.3f" % (ins, len(values), 1000 * sum(values) / len(values), 1000 * getPercentile(values, 50), 1000 * getPercentile(values, 95), 1000 * values[-1]))
+	print("%d timed APDUs in %.3f s on %d device(s), %.1f APDUs/s" % (total, elapsed, len(dongles), total / elapsed if elapsed > 0 else 0.0))
+	for index, error in enumerate(errors):
+		if error is not None:
+			print("Device %d failed : %s" % (index, error))
+	if any(error is not None for error in errors):
+		sys.exit(1)
 
-if len(sys.argv) < 2:
-	print("Usage : %s script to run" % sys.argv[0])
-	sys.exit(2)
-
-dongle = getDongle(True)
-
-scriptFile = open(sys.argv[1], "r")
-line = scriptFile.readline()
-while line:	
-	if (len(line) == 0) or (line[0] == '#') or (line.find('[') >= 0) or (line.find(']') >= 0):
-		line = scriptFile.readline()
-		continue
-	line = line.replace('\"', '')
-	line = line.replace(',', '')
-	cancelResponse = (line[0] == '!')
-	timeout = 10000
-	if cancelResponse:
-		line = line[1:]
-		timeout = 1
-	try:
-		line = line.strip()		
-		if len(line) == 0:
-			continue
-		dongle.exchange(bytearray(binascii.unhexlify(line)), timeout)
-	except:
-		if cancelResponse:
-			pass
-		else:
-			raise
-	line = scriptFile.readline()
-scriptFile.close()
+if __name__ == "__main__":
+	main()
@@ -20,6 +20,9 @@ setup(
     },
     include_package_data=True,
     zip_safe=False,
+    entry_points={
+	'console_scripts': [ 'btchip-bench=btchip.btchipBench:main' ]
+    },
     classifiers=[
 	'License :: OSI Approved :: Apache Software License',
         'Operating System :: POSIX :: Linux',
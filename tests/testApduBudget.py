@@ -0,0 +1,150 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchip import *
+from btchip.btchipBench import TRANSACTION, UTX
+from btchip.btchipComm import Dongle
+from btchip.btchipEmulator import *
+from btchip.btchipUtils import *
+from binascii import unhexlify
+import json
+import os
+import sys
+
+# Runs without a dongle - counts the APDUs and bytes exchanged by representative operations
+# on the emulator and fails when a count goes over its budget in apduBudget.json.
+# Run with --update to write the current counts as the new budgets.
+
+BUDGET = os.path.join(os.path.dirname(os.path.abspath(__file__)), "apduBudget.json")
+
+class CountingDongle(Dongle):
+
+	def __init__(self, dongle):
+		self.dongle = dongle
+		self.reset()
+
+	def reset(self):
+		self.apdus = 0
+		self.bytes = 0
+
+	def getMaxDataLength(self):
+		return self.dongle.getMaxDataLength()
+
+	def exchange(self, apdu, timeout=20000):
+		self.apdus += 1
+		self.bytes += len(apdu)
+		try:
+			response = self.dongle.exchange(apdu, timeout)
+		except BTChipException:
+			self.bytes += 2
+			raise
+		self.bytes += len(response) + 2
+		return response
+
+	def close(self):
+		self.dongle.close()
+
+# 2-of-3 P2SH spend, as in testMultisigArmory.py
+MULTISIG_UTX = bytearray(unhexlify("01000000013e9fe12917d854a0e093b982eaa46990289e2262f2db9fc1bd3f13718f3c806e010000006b483045022100af668e482e3ed363f51b36ddabad7cdf20d177104c92b8676a5b14f51107179602206c4ecd67544c74c6689ca453e2157d0c0b8a4608d85956429d2615275a51c66f01210374db359a004626daf2fcf10b8601f5f39438848a6733c768e88ce0ad398ae79dffffffff0280e7bd020000000017a914e2a227eb40dfce902f2c1d80ddafa798b16d22c3876c8fc846000000001976a914af58f09cf65b213bb9bd181a94e133b4ad4d6b2788ac00000000"))
+MULTISIG_OUTPUT = bytearray(unhexlify("02809698000000000017a914c0c3b6ada732c797881d00de6c350eec96e3d22287f02925020000000017a914e2a227eb40dfce902f2c1d80ddafa798b16d22c387"))
+REDEEMSCRIPT = bytearray(unhexlify("52210269694830114e4b1f6ef565ce4efb933681032d30333c80df713df6b60a4c62832102f43b905e9e35ccd22757faedf9eceb652dc9ba198a3904d43f4298def0213eb521037b9e3578dd3b5559d613bc2641931e6ce7d55a9d081b07347888d7d17a2b910253ae"))
+
+def signP2PKH(app):
+	transaction = bitcoinTransaction(UTX)
+	trustedInput = app.getTrustedInput(transaction, 1)
+	app.startUntrustedTransaction(True, 0, [ trustedInput ], transaction.outputs[1].script)
+	app.finalizeInput(b"", 0, 0, "0'/1/0", TRANSACTION)
+	app.untrustedHashSign("0'/0/0", "")
+
+def signMultisig(app):
+	trustedInput = app.getTrustedInput(bitcoinTransaction(MULTISIG_UTX), 0)
+	for path in [ "0'/0/1", "0'/0/2" ]:
+		app.startUntrustedTransaction(True, 0, [ trustedInput ], REDEEMSCRIPT)
+		app.finalizeInputFull(MULTISIG_OUTPUT)
+		app.untrustedHashSign(path, "")
+
+def signConsolidation(app, count=100):
+	# count previous transactions paying to the same key, differing by the outpoint they spend
+	transactions = []
+	for i in range(count):
+		data = bytearray(UTX)
+		data[5] = i
+		transactions.append(bitcoinTransaction(data))
+	trustedInputs = [ app.getTrustedInput(transaction, 1) for transaction in transactions ]
+	output = get_output_script([ [ "0.1", transactions[0].outputs[1].script ] ])
+	for i in range(count):
+		app.startUntrustedTransaction(i == 0, i, trustedInputs, transactions[i].outputs[1].script)
+		app.finalizeInputFull(output)
+		app.untrustedHashSign("0'/0/0", "")
+
+def getLargeTrustedInput(app):
+	# Previous transaction with 20 inputs and 20 P2PKH outputs
+	data = bytearray(UTX[0:4]) + bytearray([ 20 ])
+	for i in range(20):
+		data += bytearray([ i ]) * 36 + bytearray([ 0x6a ]) + bytearray(0x6a) + bytearray([ 0xff ] * 4)
+	data += bytearray([ 20 ])
+	for i in range(20):
+		data += bytearray(8) + bytearray([ 0x19, 0x76, 0xa9, 0x14 ]) + bytearray([ i ]) * 20 + bytearray([ 0x88, 0xac ])
+	data += bytearray(4)
+	app.getTrustedInput(bitcoinTransaction(data), 19)
+
+def getLargePackedTrustedInput(app):
+	app.setPackedTrustedInput(True)
+	getLargeTrustedInput(app)
+
+def signLongMessage(app):
+	app.signMessagePrepare("0'/0/0", (b"Long message to sign " * 500)[0:10240])
+	app.signMessageSign("")
+
+CASES = [
+	("p2pkh", signP2PKH),
+	("multisig2of3", signMultisig),
+	("consolidation100", signConsolidation),
+	("trustedInput20x20", getLargeTrustedInput),
+	("trustedInput20x20Packed", getLargePackedTrustedInput),
+	("signMessage10k", signLongMessage)
+]
+
+results = {}
+for name, case in CASES:
+	dongle = CountingDongle(EmulatedDongle(sleep=False))
+	app = btchip(dongle)
+	app.verifyPin("1234")
+	dongle.reset()
+	case(app)
+	results[name] = { 'apdus': dongle.apdus, 'bytes': dongle.bytes }
+
+if "--update" in sys.argv:
+	with open(BUDGET, "w") as budgetFile:
+		budgetFile.write(json.dumps(results, indent=2, sort_keys=True) + "\n")
+	sys.exit(0)
+
+with open(BUDGET, "r") as budgetFile:
+	budgets = json.load(budgetFile)
+print("%-24s %8s %8s %10s %10s" % ("case", "apdus", "budget", "bytes", "budget"))
+overruns = []
+for name, case in CASES:
+	result = results[name]
+	budget = budgets[name]
+	print("%-24s %8d %8d %10d %10d" % (name, result['apdus'], budget['apdus'], result['bytes'], budget['bytes']))
+	for key in [ 'apdus', 'bytes' ]:
+		if result[key] > budget[key]:
+			overruns.append("%s %s %d > %d" % (name, key, result[key], budget[key]))
+if overruns:
+	raise BTChipException("Over budget : " + ", ".join(overruns))
@@ -0,0 +1,139 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchip import *
+from btchip.btchipAsync import *
+from btchip.btchipBench import TRANSACTION, UTX
+from btchip.btchipBroker import DongleBrokerServer
+from btchip.btchipEmulator import *
+import asyncio
+import os
+import tempfile
+
+# Runs without a dongle - the coroutine client against the blocking one, both on emulated dongles
+
+def signSync(app, transaction):
+	trustedInput = app.getTrustedInput(transaction, 1)
+	app.startUntrustedTransaction(True, 0, [ trustedInput ], transaction.outputs[1].script)
+	app.finalizeInput(b"", 0, 0, "0'/1/0", TRANSACTION)
+	return app.untrustedHashSign("0'/0/0", "")
+
+async def signAsync(app, transaction):
+	async with app.session():
+		trustedInput = await app.getTrustedInput(transaction, 1)
+		await app.startUntrustedTransaction(True, 0, [ trustedInput ], transaction.outputs[1].script)
+		await app.finalizeInput(b"", 0, 0, "0'/1/0", TRANSACTION)
+		return await app.untrustedHashSign("0'/0/0", "")
+
+transaction = bitcoinTransaction(UTX)
+reference = EmulatedDongle()
+app = btchip(reference)
+opened = reference.exchanges
+app.verifyPin("1234")
+expected = {
+	'publicKey': app.getWalletPublicKey("0'/0/0"),
+	'signature': signSync(app, transaction),
+	'message': (app.signMessagePrepare("0'/0/0", b"Async message"), app.signMessageSign(""))
+}
+expectedExchanges = reference.exchanges - opened
+
+async def checkOperations():
+	emulator = EmulatedDongle()
+	app = await AsyncBtchip.create(AsyncThreadedDongle(emulator))
+	opened = emulator.exchanges
+	await app.verifyPin("1234")
+	if await app.getWalletPublicKey("0'/0/0") != expected['publicKey']:
+		raise BTChipException("Invalid public key")
+	if await signAsync(app, transaction) != expected['signature']:
+		raise BTChipException("Invalid transaction signature")
+	async with app.session():
+		message = (await app.signMessagePrepare("0'/0/0", b"Async message"), await app.signMessageSign(""))
+	if message != expected['message']:
+		raise BTChipException("Invalid message signature")
+	if emulator.exchanges - opened != expectedExchanges:
+		raise BTChipException("APDU count %d instead of %d" % (emulator.exchanges - opened, expectedExchanges))
+	try:
+		await app.verifyPin("0000")
+		raise BTChipException("Wrong PIN accepted")
+	except BTChipException as e:
+		if e.sw != 0x63c2:
+			raise
+	await app.dongle.close()
+asyncio.run(checkOperations())
+
+# Async dongles implementing only exchange and close get short APDUs
+class MinimalAsyncDongle(object):
+
+	def __init__(self, dongle):
+		self.dongle = dongle
+
+	async def exchange(self, apdu, timeout=20000):
+		return self.dongle.exchange(apdu, timeout)
+
+	async def close(self):
+		self.dongle.close()
+
+async def checkMinimalDongle():
+	app = await AsyncBtchip.create(MinimalAsyncDongle(EmulatedDongle(maxDataLength=1024)))
+	if app.maxDataLength != 255:
+		raise BTChipException("Invalid default data length")
+	if await signAsync(app, transaction) != expected['signature']:
+		raise BTChipException("Invalid signature through a minimal dongle")
+asyncio.run(checkMinimalDongle())
+
+# Concurrent signing flows on one device are serialized by their sessions
+async def checkConcurrentSessions():
+	app = await AsyncBtchip.create(AsyncThreadedDongle(EmulatedDongle(latency=0.001)))
+	await app.verifyPin("1234")
+	signatures = await asyncio.gather(*[ signAsync(app, transaction) for i in range(4) ])
+	if signatures != [ expected['signature'] ] * 4:
+		raise BTChipException("Interleaved signing flows")
+	await app.dongle.close()
+asyncio.run(checkConcurrentSessions())
+
+# On a broker a single APDU is one request, a session block holds the device until it ends
+class CountingBroker(DongleBroker):
+
+	def __init__(self, path):
+		self.opcodes = []
+		DongleBroker.__init__(self, path)
+
+	def request(self, opcode, payload=b"", priority=None, timeout=None):
+		self.opcodes.append(opcode)
+		return DongleBroker.request(self, opcode, payload, priority, timeout)
+
+async def checkBrokerSessions(path):
+	dongle = CountingBroker(path)
+	app = await AsyncBtchip.create(AsyncThreadedDongle(dongle))
+	del dongle.opcodes[:]
+	if await app.getWalletPublicKey("0'/0/0") != expected['publicKey'] or dongle.opcodes != [ BROKER_EXCHANGE ]:
+		raise BTChipException("Broker requests %s for one APDU" % dongle.opcodes)
+	del dongle.opcodes[:]
+	if await signAsync(app, transaction) != expected['signature']:
+		raise BTChipException("Invalid transaction signature through the broker")
+	if dongle.opcodes[0] != BROKER_BEGIN or dongle.opcodes[-1] != BROKER_END or dongle.opcodes.count(BROKER_BEGIN) != 1:
+		raise BTChipException("Broker requests %s for a session" % dongle.opcodes)
+	await app.dongle.close()
+
+directory = tempfile.mkdtemp()
+path = os.path.join(directory, "broker.sock")
+broker = DongleBrokerServer([ EmulatedDongle() ], path).start()
+asyncio.run(checkBrokerSessions(path))
+broker.stop()
+os.rmdir(directory)
@@ -0,0 +1,60 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchip import *
+from btchip.btchipBench import *
+from btchip.btchipEmulator import *
+
+# Runs without a dongle - benchmarks every workload on emulated dongles
+
+counter = ExchangeCounter()
+apps = []
+for i in range(2):
+	dongle = EmulatedDongle()
+	dongle.addObserver(counter)
+	app = btchip(dongle)
+	app.verifyPin("1234")
+	apps.append(app)
+mix = parseMix("pubkey,trustedinput,sign=2,message")
+report = runBenchmark(apps, mix, counter, operations=8)
+if report['operations'] != 16 or report['errors'] != 0 or report['clients'] != 2:
+	raise BTChipException("Invalid benchmark report")
+if report['workloads']['pubkey']['apdusPerOperation'] != 1.0 or report['workloads']['message']['apdusPerOperation'] != 2.0:
+	raise BTChipException("Invalid APDU count")
+latency = report['latency']
+if not (latency['min'] <= latency['p50'] <= latency['p95'] <= latency['p99'] <= latency['max']):
+	raise BTChipException("Invalid percentiles")
+if getPercentile([ 1, 2, 3, 4 ], 50) != 2 or getPercentile([ 1, 2, 3, 4 ], 99) != 4:
+	raise BTChipException("Invalid percentile")
+
+# Failures other than status words, such as a lost handle, are counted as errors
+class DisconnectedDongle(EmulatedDongle):
+
+	def exchange(self, apdu, timeout=20000):
+		if apdu[1] == 0x4e:
+			raise OSError("Device disconnected")
+		return EmulatedDongle.exchange(self, apdu, timeout)
+
+dongle = DisconnectedDongle()
+dongle.addObserver(counter)
+app = btchip(dongle)
+app.verifyPin("1234")
+report = runBenchmark([ app ], parseMix("pubkey,message"), counter, operations=20)
+if report['workloads']['message']['errors'] == 0 or report['workloads']['message']['errors'] + report['workloads']['pubkey']['operations'] != 20:
+	raise BTChipException("Failures not counted")
@@ -0,0 +1,146 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchip import *
+from btchip.btchipEmulator import *
+import btchip.btchipComm as btchipComm
+from btchip.btchipBench import UTX
+from btchip.btchipBroker import DongleBrokerServer
+import os
+import socket
+import tempfile
+import threading
+
+# Runs without a dongle - emulated dongles shared through a local broker
+
+FIRMWARE_VERSION = bytearray([ 0xe0, 0xc4, 0x00, 0x00, 0x00 ])
+
+class CountingBroker(DongleBroker):
+
+	def __init__(self, path):
+		self.opcodes = []
+		DongleBroker.__init__(self, path)
+
+	def request(self, opcode, payload=b"", priority=None, timeout=None):
+		self.opcodes.append(opcode)
+		return DongleBroker.request(self, opcode, payload, priority, timeout)
+
+def getOpcodes(app, operation):
+	del app.dongle.opcodes[:]
+	operation()
+	return app.dongle.opcodes
+
+directory = tempfile.mkdtemp()
+path = os.path.join(directory, "broker.sock")
+emulators = [ EmulatedDongle(), EmulatedDongle() ]
+broker = DongleBrokerServer(emulators, path).start()
+
+# A btchip instance on the broker behaves like one on the device
+expected = btchip(EmulatedDongle())
+expected.verifyPin("1234")
+app = btchip(DongleBroker(path))
+app.verifyPin("1234")
+if app.getWalletPublicKey("0'/0/0") != expected.getWalletPublicKey("0'/0/0"):
+	raise BTChipException("Invalid broker response")
+with app.session():
+	app.signMessagePrepare("0'/0/0", b"Broker message")
+	signature = app.signMessageSign("")
+if len(signature) == 0:
+	raise BTChipException("Message not signed through the broker")
+
+# Status words reach the caller unchanged
+try:
+	app.verifyPin("0000")
+	raise BTChipException("Wrong PIN accepted")
+except BTChipException as e:
+	if e.sw != 0x63c2:
+		raise
+emulators[0].pinAttempts = 3
+
+# A session keeps the device, the exchanges of other clients wait until it ends
+other = DongleBroker(path)
+done = threading.Event()
+with app.session():
+	thread = threading.Thread(target=lambda: (other.exchange(FIRMWARE_VERSION), done.set()))
+	thread.start()
+	if done.wait(0.3):
+		raise BTChipException("Device shared during a session")
+if not done.wait(2.0):
+	raise BTChipException("Device not given back")
+thread.join()
+
+# A client lost during a session gives the device back
+holder = DongleBroker(path)
+with holder.session():
+	holder.socket.shutdown(socket.SHUT_RDWR)
+	holder.close()
+other.exchange(FIRMWARE_VERSION)
+
+# Devices are chosen by index, an unknown one is refused
+second = DongleBroker(path, 1)
+exchanges = emulators[1].exchanges
+second.exchange(FIRMWARE_VERSION)
+if emulators[1].exchanges != exchanges + 1:
+	raise BTChipException("Exchange not sent to the second device")
+try:
+	DongleBroker(path, 2)
+	raise BTChipException("Unknown device opened")
+except BTChipException as e:
+	if e.sw != 0x6a88:
+		raise
+
+# A single APDU is one broker round trip, a stream or a session block opens a broker session
+counting = btchip(CountingBroker(path))
+opcodes = getOpcodes(counting, lambda: counting.getWalletPublicKey("0'/0/0"))
+if opcodes != [ BROKER_EXCHANGE ]:
+	raise BTChipException("Broker requests %s for one APDU" % opcodes)
+opcodes = getOpcodes(counting, lambda: counting.getTrustedInput(bitcoinTransaction(UTX), 1))
+if opcodes[0] != BROKER_BEGIN or opcodes[-1] != BROKER_END or opcodes[1:-1] != [ BROKER_EXCHANGE ] * (len(opcodes) - 2):
+	raise BTChipException("Broker requests %s for an APDU stream" % opcodes)
+def signMessage():
+	with counting.session():
+		counting.signMessagePrepare("0'/0/0", b"Broker message")
+		counting.signMessageSign("")
+opcodes = getOpcodes(counting, signMessage)
+if opcodes[0] != BROKER_BEGIN or opcodes[-1] != BROKER_END or opcodes.count(BROKER_BEGIN) != 1:
+	raise BTChipException("Broker requests %s for a session block" % opcodes)
+counting.dongle.close()
+
+# With a broker configured, the devices it holds are not listed for direct opening
+enumerateHIDDongles = btchipComm.enumerateHIDDongles
+btchipComm.enumerateHIDDongles = lambda: [ { 'type': 'hid', 'path': b"held", 'ledger': True } ]
+os.environ["BTCHIP_BROKER_SOCKET"] = path
+try:
+	descriptors = enumerateDongles()
+	if [ descriptor['type'] for descriptor in descriptors ] != [ 'broker' ]:
+		raise BTChipException("Invalid descriptors %s" % descriptors)
+finally:
+	del os.environ["BTCHIP_BROKER_SOCKET"]
+	btchipComm.enumerateHIDDongles = enumerateHIDDongles
+
+statistics = app.dongle.getStatistics()
+if statistics['devices'][0]['exchanges'] != emulators[0].exchanges or statistics['devices'][0]['sessions'] < 3:
+	raise BTChipException("Invalid broker statistics %s" % statistics['devices'][0])
+if statistics['devices'][0]['busy']:
+	raise BTChipException("Device still held")
+
+for dongle in [ app.dongle, other, second ]:
+	dongle.close()
+broker.stop()
+os.rmdir(directory)
@@ -0,0 +1,144 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchipCommAsync import *
+from btchip.btchipEmulator import *
+from btchip.btchipBroker import DongleBrokerServer
+from btchip.btchipProxy import DongleProxyServer
+import asyncio
+import os
+import tempfile
+import threading
+
+# Runs without a dongle - asyncio transports to emulated dongles served by a local proxy and
+# broker
+
+FIRMWARE_VERSION = bytearray([ 0xe0, 0xc4, 0x00, 0x00, 0x00 ])
+
+directory = tempfile.mkdtemp()
+proxy = DongleProxyServer([ EmulatedDongle() ], "unix:" + os.path.join(directory, "proxy.sock")).start()
+brokerPath = os.path.join(directory, "broker.sock")
+broker = DongleBrokerServer([ EmulatedDongle() ], brokerPath).start()
+expected = EmulatedDongle().exchange(FIRMWARE_VERSION)
+
+def setEnvironment(**variables):
+	for name in [ "BTCHIP_BROKER_SOCKET", "LEDGER_PROXY_ADDRESS", "LEDGER_PROXY_PORT", "LEDGER_PROXY_PROTOCOL" ]:
+		os.environ.pop(name, None)
+	os.environ.update(variables)
+
+async def checkAsyncDongle(dongleType):
+	dongle = await getAsyncDongle()
+	try:
+		if type(dongle) is not dongleType:
+			raise BTChipException("Invalid async dongle %s" % type(dongle).__name__)
+		if await dongle.exchange(FIRMWARE_VERSION) != expected:
+			raise BTChipException("Invalid response through %s" % type(dongle).__name__)
+	finally:
+		await dongle.close()
+
+# Proxy handles on a unix socket, the v1 protocol is spoken natively, the others from a thread
+setEnvironment(LEDGER_PROXY_ADDRESS=proxy.address[0])
+asyncio.run(checkAsyncDongle(AsyncDongleServer))
+setEnvironment(LEDGER_PROXY_ADDRESS=proxy.address[0], LEDGER_PROXY_PROTOCOL="2")
+asyncio.run(checkAsyncDongle(AsyncThreadedDongle))
+setEnvironment(LEDGER_PROXY_ADDRESS=proxy.address[0], LEDGER_PROXY_PROTOCOL="3")
+asyncio.run(checkAsyncDongle(AsyncThreadedDongle))
+# A configured broker comes first
+setEnvironment(BTCHIP_BROKER_SOCKET=brokerPath, LEDGER_PROXY_ADDRESS=proxy.address[0])
+asyncio.run(checkAsyncDongle(AsyncThreadedDongle))
+setEnvironment()
+
+# A threaded dongle keeps the loop running while the device works, statuses keep their sw
+async def checkThreaded():
+	dongle = AsyncThreadedDongle(EmulatedDongle(latency=0.2))
+	ticks = 0
+	exchange = asyncio.ensure_future(dongle.exchange(FIRMWARE_VERSION))
+	while not exchange.done():
+		await asyncio.sleep(0.01)
+		ticks += 1
+	if exchange.result() != expected or ticks < 10:
+		raise BTChipException("Event loop blocked by the device")
+	try:
+		await dongle.exchange(bytearray([ 0xe0, 0xff, 0x00, 0x00, 0x00 ]))
+		raise BTChipException("Unknown instruction accepted")
+	except BTChipException as e:
+		if e.sw is None:
+			raise
+	await dongle.close()
+	try:
+		await dongle.exchange(FIRMWARE_VERSION)
+		raise BTChipException("Closed dongle used")
+	except BTChipTransportException:
+		pass
+asyncio.run(checkThreaded())
+
+# A proxy exchange that times out drops the connection, the next one opens a new one
+async def checkServerTimeout(server):
+	dongle = AsyncDongleServer(server.address[0], server.address[1])
+	try:
+		await dongle.exchange(FIRMWARE_VERSION, 50)
+		raise BTChipException("Timeout not raised")
+	except BTChipTransportException as e:
+		if e.sw is not None:
+			raise
+	if dongle.writer is not None:
+		raise BTChipException("Connection kept after a timeout")
+	if await dongle.exchange(FIRMWARE_VERSION) != expected:
+		raise BTChipException("Invalid response after a timeout")
+	await dongle.close()
+# A cancelled exchange drops the connection too, its response is not read by the next one
+async def checkServerCancel(server):
+	dongle = AsyncDongleServer(server.address[0], server.address[1])
+	try:
+		await asyncio.wait_for(dongle.exchange(bytearray([ 0xe0, 0xc0, 0x00, 0x00, 0x08 ])), 0.05)
+		raise BTChipException("Exchange not cancelled")
+	except asyncio.TimeoutError:
+		pass
+	if dongle.writer is not None:
+		raise BTChipException("Connection kept after a cancellation")
+	if await dongle.exchange(FIRMWARE_VERSION) != expected:
+		raise BTChipException("Response of the cancelled exchange read")
+	await dongle.close()
+server = DongleProxyServer([ EmulatedDongle(latency=0.2) ]).start()
+asyncio.run(checkServerTimeout(server))
+asyncio.run(checkServerCancel(server))
+server.stop()
+
+# A session opened from asyncio keeps a broker device from other clients until it ends
+async def checkBrokerSession():
+	dongle = AsyncThreadedDongle(DongleBroker(brokerPath))
+	other = DongleBroker(brokerPath)
+	done = threading.Event()
+	thread = threading.Thread(target=lambda: (other.exchange(FIRMWARE_VERSION), done.set()))
+	async with dongle.session():
+		thread.start()
+		await dongle.exchange(FIRMWARE_VERSION)
+		await asyncio.sleep(0.3)
+		if done.is_set():
+			raise BTChipException("Device shared during an async session")
+	await asyncio.get_running_loop().run_in_executor(None, thread.join, 2.0)
+	if not done.is_set():
+		raise BTChipException("Device not given back")
+	other.close()
+	await dongle.close()
+asyncio.run(checkBrokerSession())
+
+broker.stop()
+proxy.stop()
+os.rmdir(directory)
@@ -0,0 +1,128 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchip import *
+from btchip.btchipUtils import *
+from btchip.btchipEmulator import *
+from binascii import unhexlify
+
+# Runs without a dongle - replays the vectors of testSimpleTransaction and testMessageSignature on the emulator
+
+SEED = bytearray(unhexlify("1762F9A3007DBC825D0DD9958B04880284E88F10C57CF569BB3DADF7B1027F2D"))
+
+UTX = bytearray(unhexlify("01000000014ea60aeac5252c14291d428915bd7ccd1bfc4af009f4d4dc57ae597ed0420b71010000008a47304402201f36a12c240dbf9e566bc04321050b1984cd6eaf6caee8f02bb0bfec08e3354b022012ee2aeadcbbfd1e92959f57c15c1c6debb757b798451b104665aa3010569b49014104090b15bde569386734abf2a2b99f9ca6a50656627e77de663ca7325702769986cf26cc9dd7fdea0af432c8e2becc867c932e1b9dd742f2a108997c2252e2bdebffffffff0281b72e00000000001976a91472a5d75c8d2d0565b656a5232703b167d50d5a2b88aca0860100000000001976a9144533f5fb9b4817f713c48f0bfe96b9f50c476c9b88ac00000000"))
+UTXO_INDEX = 1
+ADDRESS = b"1BTChipvU14XH6JdRiK9CaenpJ2kJR9RnC"
+AMOUNT = "0.0009"
+FEES = "0.0001"
+
+SIGNATURE = bytearray(unhexlify("3045022100ea6df031b47629590daf5598b6f0680ad0132d8953b401577f01e8cc46393fe602202201b7a19d706a0213dcfeb7033719b92c6fd58a2d1d53411de71c4d8353154b01"))
+TRANSACTION = bytearray(unhexlify("0100000001c773da236484dae8f0fdba3d7e0ba1d05070d1a34fc44943e638441262a04f10010000006b483045022100ea6df031b47629590daf5598b6f0680ad0132d8953b401577f01e8cc46393fe602202201b7a19d706a0213dcfeb7033719b92c6fd58a2d1d53411de71c4d8353154b01210348bb1fade0adde1bf202726e6db5eacd2063fce7ecf8bbfd17377f09218d5814ffffffff01905f0100000000001976a91472a5d75c8d2d0565b656a5232703b167d50d5a2b88ac00000000"))
+
+MESSAGE = b"Campagne de Sarkozy : une double comptabilite chez Bygmalion"
+MESSAGE_ADDRESS = "17JusYNVXLPm3hBPzzRQkARYDMUBgRUMVc"
+MESSAGE_SIGNATURE = bytearray(unhexlify("30450221009a0d28391c0535aec1077bbb86614c8f3c384a3e9aa1a124bfb9ce9649196b7e02200efa1adc010a7bdde4784ee98441e402f93b3c50a2760cb09dda07501e02c81f"))
+
+dongle = EmulatedDongle(latency=0.005, throughput=1000, sleep=False)
+app = btchip(dongle)
+app.setup(btchip.OPERATION_MODE_WALLET, btchip.FEATURE_RFC6979, 0x00, 0x05, "1234", None, btchip.QWERTY_KEYMAP, SEED)
+app.verifyPin("1234")
+publicKey = compress_public_key(app.getWalletPublicKey("0'/0/0")['publicKey'])
+if base58CheckEncode(0x00, hash160(publicKey)) != MESSAGE_ADDRESS:
+	raise BTChipException("Invalid public key")
+
+# Legacy finalization, the emulator builds the outputs
+transaction = bitcoinTransaction(UTX)
+outputScript = transaction.outputs[UTXO_INDEX].script
+trustedInput = app.getTrustedInput(transaction, UTXO_INDEX)
+app.startUntrustedTransaction(True, 0, [trustedInput], outputScript)
+outputData = app.finalizeInput(ADDRESS, AMOUNT, FEES, "0'/1/0")
+signature = app.untrustedHashSign("0'/0/0", "")
+if signature != SIGNATURE:
+	raise BTChipException("Invalid signature")
+inputScript = get_regular_input_script(signature, publicKey)
+if format_transaction(outputData['outputData'], [ [ trustedInput['value'], inputScript] ]) != TRANSACTION:
+	raise BTChipException("Invalid transaction")
+
+# Full finalization from the raw transaction
+app.startUntrustedTransaction(True, 0, [trustedInput], outputScript)
+app.finalizeInput(b"", 0, 0, "0'/1/0", TRANSACTION)
+if app.untrustedHashSign("0'/0/0", "") != SIGNATURE:
+	raise BTChipException("Invalid signature with full finalization")
+
+# Message signature
+app.signMessagePrepare("0'/0/0", MESSAGE)
+if app.signMessageSign("") != MESSAGE_SIGNATURE:
+	raise BTChipException("Invalid message signature")
+
+# Forged trusted inputs are rejected
+trustedInput['value'][10] ^= 0xff
+try:
+	app.startUntrustedTransaction(True, 0, [trustedInput], outputScript)
+	raise BTChipException("Forged trusted input accepted")
+except BTChipException as e:
+	if e.sw != 0x6a80:
+		raise
+
+# The cost model is accumulated without sleeping
+if abs(dongle.elapsed - (dongle.exchanges * 0.005 + (dongle.bytesIn + dongle.bytesOut) / 1000.0)) > 1e-6:
+	raise BTChipException("Invalid elapsed time")
+
+# Extended length APDUs carry the same message in fewer commands
+LONG_MESSAGE = MESSAGE * 64
+signatures = []
+for maxDataLength in [ 255, 2048 ]:
+	dongle = EmulatedDongle(SEED, maxDataLength=maxDataLength)
+	app = btchip(dongle)
+	exchanges = dongle.exchanges
+	app.signMessagePrepare("0'/0/0", LONG_MESSAGE)
+	signatures.append((app.signMessageSign(""), dongle.exchanges - exchanges))
+if signatures[0][0] != signatures[1][0] or signatures[1][1] * 4 > signatures[0][1]:
+	raise BTChipException("Invalid extended length message signature")
+
+# Trusted inputs streamed packed (opt-in) or field by field are the same
+trustedInputs = []
+for packedTrustedInput in [ True, False ]:
+	dongle = EmulatedDongle(SEED)
+	app = btchip(dongle)
+	app.setPackedTrustedInput(packedTrustedInput)
+	exchanges = dongle.exchanges
+	trustedInputs.append((app.getTrustedInput(transaction, UTXO_INDEX)['value'][4:48], dongle.exchanges - exchanges))
+if trustedInputs[0][0] != trustedInputs[1][0] or trustedInputs[0][1] >= trustedInputs[1][1]:
+	raise BTChipException("Invalid packed trusted input")
+
+# Dongles implementing only exchange and close get short APDUs
+class MinimalDongle(object):
+
+	def __init__(self, dongle):
+		self.dongle = dongle
+
+	def exchange(self, apdu, timeout=20000):
+		return self.dongle.exchange(apdu, timeout)
+
+	def close(self):
+		self.dongle.close()
+
+app = btchip(MinimalDongle(EmulatedDongle(SEED, maxDataLength=1024)))
+if app.maxDataLength != 255:
+	raise BTChipException("Invalid default data length")
+app.verifyPin("1234")
+app.signMessagePrepare("0'/0/0", MESSAGE)
+if app.signMessageSign("") != MESSAGE_SIGNATURE:
+	raise BTChipException("Invalid signature through a minimal dongle")
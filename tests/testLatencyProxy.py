@@ -0,0 +1,75 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchip import *
+from btchip.btchipEmulator import *
+from btchip.btchipLatencyProxy import *
+from btchip.btchipObserver import clock
+from btchip.btchipProxy import DongleProxyServer
+import random
+
+# Runs without a dongle - emulated link timings, and an emulated dongle reached through the relay
+
+FIRMWARE_VERSION = bytearray([ 0xe0, 0xc4, 0x00, 0x00, 0x00 ])
+
+def checkTime(value, expected, name):
+	if abs(value - expected) > 1e-9:
+		raise BTChipException("%s delivered at %f instead of %f" % (name, value, expected))
+
+# Half the RTT, the per packet delay, then the bandwidth shared by successive chunks
+link = LinkDirection(None, None, 0.1, 0.0, 1000.0, 100, 0.01, random.Random(0))
+checkTime(link.getDeliveryTime(250, 10.0), 10.0 + 0.25 + 0.05 + 3 * 0.01, "First chunk")
+checkTime(link.getDeliveryTime(100, 10.1), 10.25 + 0.1 + 0.05 + 0.01, "Queued chunk")
+checkTime(link.getDeliveryTime(100, 20.0), 20.0 + 0.1 + 0.05 + 0.01, "Chunk on a free link")
+# Jitter never reorders the stream
+link = LinkDirection(None, None, 0.0, 0.5, None, 1460, 0.0, random.Random(0))
+deliveries = [ link.getDeliveryTime(10, 0.001 * index) for index in range(100) ]
+if deliveries != sorted(deliveries) or max(deliveries) > 0.099 + 0.5:
+	raise BTChipException("Invalid jittered deliveries")
+
+# Every exchange through the relay takes at least one RTT
+RTT = 0.05
+server = DongleProxyServer([ EmulatedDongle() ]).start()
+proxy = LatencyProxy(server.address, rtt=RTT, seed=0).start()
+dongle = DongleServer(proxy.address[0], proxy.address[1])
+expected = EmulatedDongle().exchange(FIRMWARE_VERSION)
+for i in range(3):
+	start = clock()
+	if dongle.exchange(FIRMWARE_VERSION) != expected:
+		raise BTChipException("Invalid relayed response")
+	elapsed = clock() - start
+	if elapsed < RTT or elapsed > RTT + 0.5:
+		raise BTChipException("Relayed exchange took %.3fs for a %.3fs RTT" % (elapsed, RTT))
+app = btchip(dongle)
+app.verifyPin("1234")
+reference = btchip(EmulatedDongle())
+if app.getWalletPublicKey("0'/0/0") != reference.getWalletPublicKey("0'/0/0"):
+	raise BTChipException("Invalid relayed public key")
+dongle.close()
+
+# A client of an unreachable upstream is disconnected
+server.stop()
+dongle = DongleServer(proxy.address[0], proxy.address[1])
+try:
+	dongle.exchange(FIRMWARE_VERSION, 2000)
+	raise BTChipException("Exchange relayed to a stopped proxy")
+except BTChipTransportException:
+	pass
+dongle.close()
+proxy.stop()
@@ -0,0 +1,171 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.ledgerWrapper import *
+from btchip.btchipComm import *
+from btchip.btchipEmulator import *
+from btchip.btchipException import *
+import struct
+import threading
+
+# Runs without a dongle - checks the Ledger HID framing against itself
+
+for size in [ 0, 1, 57, 58, 59, 60, 200, 4000 ]:
+	payload = bytearray([ i & 0xff for i in range(size) ])
+	framed = wrapCommandAPDU(0x0101, payload, 64)
+	if len(framed) % 64 != 0:
+		raise BTChipException("Invalid framed size for %d bytes" % size)
+	if unwrapResponseAPDU(0x0101, framed, 64) != payload:
+		raise BTChipException("Invalid round trip for %d bytes" % size)
+	decoder = LedgerFrameDecoder(0x0101, 64)
+	offset = 0
+	while not decoder.feed(framed[offset : offset + 64]):
+		offset += 64
+	if decoder.response != payload or offset + 64 != len(framed):
+		raise BTChipException("Invalid incremental decoding for %d bytes" % size)
+
+# Truncated responses are not complete yet
+framed = wrapCommandAPDU(0x0101, bytearray(200), 64)
+if unwrapResponseAPDU(0x0101, framed[0:128], 64) is not None:
+	raise BTChipException("Truncated response decoded")
+
+# Out of order reports are rejected
+decoder = LedgerFrameDecoder(0x0101, 64)
+decoder.feed(framed[0:64])
+try:
+	decoder.feed(framed[128:192])
+	raise BTChipException("Out of order report accepted")
+except BTChipException as e:
+	if e.message != "Invalid sequence":
+		raise
+
+# Reports for another channel are rejected
+try:
+	LedgerFrameDecoder(0x0102, 64).feed(framed[0:64])
+	raise BTChipException("Report for another channel accepted")
+except BTChipException as e:
+	if e.message != "Invalid channel":
+		raise
+
+# Reports carry the HID report ID prefix and leave the command untouched
+command = bytearray(range(100))
+reports = wrapCommandReports(0x0101, command, 64, 1)
+if len(reports) != 2 * 65 or reports[0] != 0 or reports[65] != 0:
+	raise BTChipException("Invalid report ID prefix")
+if bytearray().join([ bytearray(report[1:]) for report in splitReports(reports, 65) ]) != wrapCommandAPDU(0x0101, command, 64):
+	raise BTChipException("Invalid report split")
+if command != bytearray(range(100)):
+	raise BTChipException("Command modified by framing")
+
+# Larger reports carry the same command in fewer reports
+command = bytearray(range(256)) * 4
+if len(wrapCommandAPDU(0x0101, command, 256)) // 256 != 5 or len(wrapCommandAPDU(0x0101, command, 64)) // 64 != 18:
+	raise BTChipException("Invalid report count")
+if unwrapResponseAPDU(0x0101, wrapCommandAPDU(0x0101, command, 256), 256) != command:
+	raise BTChipException("Invalid round trip with 256 bytes reports")
+
+# Interleaved responses on several channels are decoded separately
+first = wrapCommandAPDU(0x0101, bytearray(range(150)), 64)
+second = wrapCommandAPDU(0x0102, bytearray(range(100, 200)), 64)
+demultiplexer = LedgerFrameDemultiplexer(64)
+demultiplexer.open(0x0101)
+demultiplexer.open(0x0102)
+completed = []
+for report in [ first[0:64], second[0:64], first[64:128], second[64:128], first[128:192] ]:
+	result = demultiplexer.feed(report)
+	if result is not None:
+		completed.append(result)
+if completed != [ (0x0102, bytearray(range(100, 200))), (0x0101, bytearray(range(150))) ]:
+	raise BTChipException("Invalid demultiplexing")
+
+# Channels are not handed out twice
+allocator = ChannelAllocator(0x0101, 0x0103)
+allocator.reserve(0x0101)
+if [ allocator.allocate(), allocator.allocate() ] != [ 0x0102, 0x0103 ]:
+	raise BTChipException("Invalid channel allocation")
+try:
+	allocator.allocate()
+	raise BTChipException("Channel allocated twice")
+except BTChipException as e:
+	if e.message != "No channel available":
+		raise
+allocator.release(0x0102)
+if allocator.allocate() != 0x0102:
+	raise BTChipException("Released channel not reused")
+
+# Dongles on several channels of one HID device get their own responses
+class EmulatedLedgerHID(object):
+
+	def __init__(self, packetSize):
+		self.packetSize = packetSize
+		self.emulator = EmulatedDongle()
+		self.decoders = {}
+		self.reports = []
+		self.condition = threading.Condition()
+
+	def write(self, data):
+		report = bytearray(data[1:])
+		channel = (report[0] << 8) | report[1]
+		decoder = self.decoders.setdefault(channel, LedgerFrameDecoder(channel, self.packetSize))
+		if decoder.feed(report):
+			command = decoder.response
+			decoder.reset()
+			try:
+				response = self.emulator.exchange(command) + bytearray([ 0x90, 0x00 ])
+			except BTChipException as e:
+				response = bytearray(struct.pack(">H", e.sw))
+			framed = wrapCommandAPDU(channel, response, self.packetSize)
+			with self.condition:
+				self.reports.extend(framed[offset : offset + self.packetSize] for offset in range(0, len(framed), self.packetSize))
+				self.condition.notify_all()
+		return len(data)
+
+	def read(self, size, timeout_ms=0):
+		with self.condition:
+			if not self.reports:
+				self.condition.wait(timeout_ms / 1000.0)
+			if not self.reports:
+				return []
+			return list(self.reports.pop(0))
+
+	def close(self):
+		pass
+
+for packetSize in [ 64, 256 ]:
+	dongle = HIDDongleHIDAPI(EmulatedLedgerHID(packetSize), True, packetSize=packetSize)
+	dongles = [ dongle ] + [ dongle.openChannel() for i in range(3) ]
+	if [ entry.channel for entry in dongles ] != [ 0x0101, 0x0102, 0x0103, 0x0104 ]:
+		raise BTChipException("Invalid channels")
+	results = {}
+	def run(index):
+		path = bytearray([ 0x01, 0x00, 0x00, 0x00, index ])
+		results[index] = [ bytes(dongles[index].exchange(bytearray([ 0xe0, 0x40, 0x00, 0x00, len(path) ]) + path)) for i in range(20) ]
+	threads = [ threading.Thread(target=run, args=(index,)) for index in range(len(dongles)) ]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	for index in range(len(dongles)):
+		path = bytearray([ 0x01, 0x00, 0x00, 0x00, index ])
+		expected = bytes(EmulatedDongle().exchange(bytearray([ 0xe0, 0x40, 0x00, 0x00, len(path) ]) + path))
+		if results.get(index) != [ expected ] * 20:
+			raise BTChipException("Response routed to the wrong channel")
+	dongles[1].close()
+	if dongle.openChannel().channel != 0x0105:
+		raise BTChipException("Invalid channel reuse")
@@ -0,0 +1,63 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchip import *
+from btchip.btchipEmulator import *
+from btchip.btchipObserver import *
+
+# Runs without a dongle - checks the exchange events reported by the emulator
+
+class EventList(DongleObserver):
+
+	def __init__(self):
+		self.events = []
+
+	def onExchange(self, event):
+		self.events.append(event)
+
+dongle = EmulatedDongle(latency=0.002)
+events = EventList()
+histogram = LatencyHistogram()
+statusWords = StatusWordCounter()
+app = btchip(dongle)
+for observer in [ events, histogram, statusWords ]:
+	dongle.addObserver(observer)
+
+app.verifyPin("1234")
+try:
+	app.verifyPin("0000")
+except BTChipException:
+	pass
+app.getWalletPublicKey("0'/0/0")
+
+if [ event.ins for event in events.events ] != [ 0x22, 0x22, 0x40 ]:
+	raise BTChipException("Invalid events")
+event = events.events[2]
+if event.sw != 0x9000 or event.commandSize != 18 or event.responseSize == 0 or event.totalTime < 0.002:
+	raise BTChipException("Invalid event")
+if histogram.getSummary()['22']['count'] != 2 or histogram.getPercentile(0x40, 99) < 0.002:
+	raise BTChipException("Invalid histogram")
+if statusWords.getCount(0x63c2, 0x22) != 1 or statusWords.getErrorCount() != 1:
+	raise BTChipException("Invalid status word count")
+
+# Removed observers are not notified
+dongle.removeObserver(events)
+app.getWalletPublicKey("0'/0/1")
+if len(events.events) != 3:
+	raise BTChipException("Removed observer notified")
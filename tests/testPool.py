@@ -0,0 +1,115 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchip import *
+from btchip.btchipEmulator import *
+from btchip.btchipObserver import clock
+from btchip.btchipPool import *
+import btchip.btchipPool as btchipPool
+import threading
+
+# Runs without a dongle - jobs dispatched over a pool of emulated dongles
+
+LATENCY = 0.02
+
+def getPublicKey(app, index):
+	return app.getWalletPublicKey("0'/0/%d" % index)['publicKey']
+
+def failOnOdd(app, index):
+	if index % 2 == 1:
+		app.exchange(bytearray([ 0xe0, 0xff, 0x00, 0x00, 0x00 ]))
+	return index
+
+reference = btchip(EmulatedDongle())
+expected = [ getPublicKey(reference, index) for index in range(12) ]
+
+# The jobs run in parallel over the devices and come back in order
+emulators = [ EmulatedDongle(latency=LATENCY) for i in range(3) ]
+pool = DonglePool(emulators)
+start = clock()
+if pool.map(getPublicKey, range(12)) != expected:
+	raise BTChipException("Invalid pool results")
+elapsed = clock() - start
+exchanges = sum(emulator.exchanges for emulator in emulators)
+if min(emulator.exchanges for emulator in emulators) == 0:
+	raise BTChipException("Device left idle")
+if elapsed > 0.75 * exchanges * LATENCY:
+	raise BTChipException("Jobs not run in parallel (%.3fs for %d APDUs)" % (elapsed, exchanges))
+
+# Failures reach the caller through the future and are counted
+futures = [ pool.submit(failOnOdd, index) for index in range(6) ]
+for index, future in enumerate(futures):
+	if index % 2 == 0:
+		if future.result() != index:
+			raise BTChipException("Invalid job result")
+	else:
+		try:
+			future.result()
+			raise BTChipException("Job failure lost")
+		except BTChipException as e:
+			if e.sw is None:
+				raise
+statistics = pool.getStatistics()
+if sum(slot['failed'] for slot in statistics) != 3 or sum(slot['completed'] for slot in statistics) != 15:
+	raise BTChipException("Invalid pool statistics %s" % statistics)
+if any(slot['pending'] != 0 for slot in statistics):
+	raise BTChipException("Jobs left pending")
+pool.close()
+
+# Round robin spreads jobs evenly whatever their length
+emulators = [ EmulatedDongle() for i in range(2) ]
+pool = DonglePool(emulators, RoundRobinPolicy())
+pool.map(getPublicKey, range(6))
+if [ slot['completed'] for slot in pool.getStatistics() ] != [ 3, 3 ]:
+	raise BTChipException("Jobs not spread in turn")
+pool.close()
+
+try:
+	DonglePool([])
+	raise BTChipException("Empty pool created")
+except BTChipException as e:
+	if e.message != "No dongle found":
+		raise
+
+# A device failing to open gives back the ones opened before it
+class ClosingDongle(EmulatedDongle):
+
+	closed = False
+
+	def close(self):
+		self.closed = True
+
+opened = []
+def openDongle(descriptor, debug=False):
+	if descriptor['type'] == 'broken':
+		raise BTChipException("Reader not available")
+	opened.append(ClosingDongle())
+	return opened[-1]
+
+btchipPool.enumerateDongles = lambda: [ { 'type': 'emulated' }, { 'type': 'emulated' }, { 'type': 'broken' } ]
+btchipPool.openDongle = openDongle
+threads = threading.active_count()
+try:
+	DonglePool()
+	raise BTChipException("Pool opened with a broken device")
+except BTChipException as e:
+	if e.message != "Reader not available":
+		raise
+if len(opened) != 2 or not all(dongle.closed for dongle in opened) or threading.active_count() != threads:
+	raise BTChipException("Opened devices not given back")
@@ -0,0 +1,184 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchip import *
+from btchip.btchipEmulator import *
+from btchip.btchipBench import TRANSACTION, UTX
+from btchip.btchipLatencyProxy import LatencyProxy
+from btchip.btchipObserver import DongleObserver, clock
+from btchip.btchipProxy import DongleProxyServer
+import os
+import tempfile
+import threading
+import time
+
+# Runs without a dongle - emulated dongles served by a local proxy over protocol v1, v2 and
+# shared memory
+
+FIRMWARE_VERSION = bytearray([ 0xe0, 0xc4, 0x00, 0x00, 0x00 ])
+
+def getPublicKey(dongle):
+	app = btchip(dongle)
+	app.verifyPin("1234")
+	return app.getWalletPublicKey("0'/0/0")['publicKey']
+
+expected = getPublicKey(EmulatedDongle())
+directory = tempfile.mkdtemp()
+
+# Protocol v1 over TCP and over a unix socket
+emulators = [ EmulatedDongle() ]
+server = DongleProxyServer(emulators).start()
+dongle = DongleServer(server.address[0], server.address[1])
+if getPublicKey(dongle) != expected:
+	raise BTChipException("Invalid v1 response")
+try:
+	dongle.exchange(bytearray([ 0xe0, 0x22, 0x00, 0x00, 0x04 ]) + b"0000")
+	raise BTChipException("Wrong PIN accepted")
+except BTChipException as e:
+	if e.sw != 0x63c2:
+		raise
+
+# A second v1 client waits until the first one gives the device back
+waiting = DongleServer(server.address[0], server.address[1])
+done = threading.Event()
+thread = threading.Thread(target=lambda: (waiting.exchange(FIRMWARE_VERSION), done.set()))
+thread.start()
+if done.wait(0.3):
+	raise BTChipException("Device shared between v1 clients")
+dongle.close()
+if not done.wait(2.0):
+	raise BTChipException("Device not given back")
+thread.join()
+waiting.close()
+server.stop()
+
+# A v1 client dropping its connection after a timeout opens a new one on the next exchange
+server = DongleProxyServer([ EmulatedDongle(latency=0.2) ]).start()
+dongle = DongleServer(server.address[0], server.address[1])
+try:
+	dongle.exchange(FIRMWARE_VERSION, 50)
+	raise BTChipException("Timeout not raised")
+except BTChipTransportException:
+	pass
+if dongle.exchange(FIRMWARE_VERSION) != EmulatedDongle().exchange(FIRMWARE_VERSION):
+	raise BTChipException("Invalid response after a timeout")
+dongle.close()
+server.stop()
+
+server = DongleProxyServer([ EmulatedDongle() ], "unix:" + os.path.join(directory, "proxy.sock")).start()
+dongle = DongleServer(server.address[0], 0)
+if getPublicKey(dongle) != expected:
+	raise BTChipException("Invalid v1 response over a unix socket")
+dongle.close()
+
+# Shared memory rings
+from btchip.btchipSharedMemory import DongleSharedMemory
+dongle = DongleSharedMemory(server.address[0])
+if getPublicKey(dongle) != expected:
+	raise BTChipException("Invalid shared memory response")
+dongle.close()
+server.stop()
+
+# Protocol v2 : each session gets its own device, a session finding none waits for one to be
+# given back, and the requests of a session are pipelined in order
+emulators = [ EmulatedDongle(latency=0.001), EmulatedDongle(latency=0.001) ]
+server = DongleProxyServer(emulators).start()
+connection = DongleServerConnection(server.address[0], server.address[1])
+sessions = [ connection.openSession() for i in range(3) ]
+for session in sessions[0:2]:
+	session.exchange(FIRMWARE_VERSION)
+if emulators[0].exchanges != 1 or emulators[1].exchanges != 1:
+	raise BTChipException("Sessions not spread over the devices")
+queued = sessions[2].submit(FIRMWARE_VERSION)
+requests = [ sessions[0].submit(FIRMWARE_VERSION) for i in range(10) ]
+for request in requests:
+	request.result()
+if queued.event.wait(0.3):
+	raise BTChipException("Device shared between v2 sessions")
+sessions[0].close()
+queued.result(2000)
+if emulators[0].exchanges != 12:
+	raise BTChipException("Device not given back by the session")
+for session in sessions[1:]:
+	session.close()
+
+# A btchip instance on a v2 session keeps the device for its multi-APDU operations
+session = connection.openSession()
+app = btchip(session)
+app.verifyPin("1234")
+if app.getWalletPublicKey("0'/0/0")['publicKey'] != expected:
+	raise BTChipException("Invalid v2 response")
+with app.session():
+	app.signMessagePrepare("0'/0/0", b"Session message")
+	if len(app.signMessageSign("")) == 0:
+		raise BTChipException("Message not signed over a v2 session")
+session.close()
+connection.close()
+server.stop()
+os.rmdir(directory)
+
+# The APDUs of a stream are pipelined over a v2 session, a getTrustedInput costs about one round
+# trip to the proxy whatever its APDU count, and each APDU is still observed
+class Counter(DongleObserver):
+
+	def __init__(self):
+		self.events = []
+
+	def onExchange(self, event):
+		self.events.append(event)
+
+def sign(app, transaction):
+	trustedInput = app.getTrustedInput(transaction, 1)
+	app.startUntrustedTransaction(True, 0, [ trustedInput ], transaction.outputs[1].script)
+	app.finalizeInput(b"", 0, 0, "0'/1/0", TRANSACTION)
+	return app.untrustedHashSign("0'/0/0", "")
+
+RTT = 0.05
+transaction = bitcoinTransaction(UTX)
+signature = sign(btchip(EmulatedDongle()), transaction)
+server = DongleProxyServer([ EmulatedDongle() ]).start()
+relay = LatencyProxy(server.address, rtt=RTT, seed=0).start()
+connection = DongleServerConnection(relay.address[0], relay.address[1])
+session = connection.openSession()
+counter = Counter()
+session.addObserver(counter)
+app = btchip(session)
+del counter.events[:]
+start = clock()
+app.getTrustedInput(transaction, 1)
+elapsed = clock() - start
+if len(counter.events) < 5 or any(event.sw != 0x9000 for event in counter.events):
+	raise BTChipException("Pipelined APDUs not observed")
+if elapsed > 2.5 * RTT:
+	raise BTChipException("Stream of %d APDUs took %.3fs for a %.3fs RTT" % (len(counter.events), elapsed, RTT))
+if sign(app, transaction) != signature:
+	raise BTChipException("Invalid signature over a pipelined session")
+# A status in the middle of a stream is raised once every response came back
+try:
+	app.startUntrustedTransaction(True, 0, [ { 'trustedInput': True, 'value': bytearray(56) } ], transaction.outputs[1].script)
+	raise BTChipException("Forged trusted input accepted")
+except BTChipException as e:
+	if e.sw is None:
+		raise
+if sign(app, transaction) != signature:
+	raise BTChipException("Session out of step after a failed stream")
+session.close()
+connection.close()
+relay.stop()
+server.stop()
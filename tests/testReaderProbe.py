@@ -0,0 +1,110 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+import btchip.btchipComm as btchipComm
+from btchip.btchipException import *
+import os
+import tempfile
+import threading
+import time
+
+# Runs without a dongle or pyscard - probes fake PC/SC readers
+
+SELECT = bytearray.fromhex("00A4040010FF4C4547522E57414C5430312E493031")
+
+class FakeConnection(object):
+
+	def __init__(self, reader):
+		self.reader = reader
+		self.connected = False
+
+	def connect(self):
+		self.connected = True
+
+	def disconnect(self):
+		self.connected = False
+		self.reader.disconnected.set()
+
+	def transmit(self, apdu):
+		self.reader.probes += 1
+		time.sleep(self.reader.delay)
+		if bytearray(apdu) != SELECT:
+			return [], 0x6d, 0x00
+		return [], self.reader.sw >> 8, self.reader.sw & 0xff
+
+class FakeReader(object):
+
+	def __init__(self, name, sw=0x9000, delay=0.0):
+		self.name = name
+		self.sw = sw
+		self.delay = delay
+		self.probes = 0
+		self.disconnected = threading.Event()
+
+	def createConnection(self):
+		return FakeConnection(self)
+
+	def __str__(self):
+		return self.name
+
+if not btchipComm.SCARD:
+	btchipComm.toBytes = lambda data: list(bytearray.fromhex(data))
+
+# Readers are probed concurrently, late answers are dropped and their connection closed
+slow = FakeReader("Slow", delay=0.3)
+fast = FakeReader("Fast")
+other = FakeReader("Other", sw=0x6a82)
+start = time.time()
+found = btchipComm.probeReaders([ slow, other, fast ], 1.0)
+if [ str(reader) for reader, connection in found ] != [ "Slow", "Fast" ] or time.time() - start > 0.6:
+	raise BTChipException("Invalid concurrent probe")
+late = FakeReader("Late", delay=0.5)
+found = btchipComm.probeReaders([ late, fast ], 0.1)
+if [ str(reader) for reader, connection in found ] != [ "Fast" ]:
+	raise BTChipException("Late reader returned")
+if not late.disconnected.wait(2.0):
+	raise BTChipException("Late connection not closed")
+
+# Without BTCHIP_READER_CACHE nothing is remembered
+readerList = [ other, fast ]
+btchipComm.SCARD = True
+btchipComm.readers = lambda: readerList
+if os.getenv("BTCHIP_READER_CACHE") is None and btchipComm.READER_CACHE is not None:
+	raise BTChipException("Reader cache enabled by default")
+btchipComm.READER_CACHE = None
+btchipComm.saveReaderCache("Fast")
+if btchipComm.loadReaderCache() is not None:
+	raise BTChipException("Reader cached without BTCHIP_READER_CACHE")
+
+# With a cache file the reader found is remembered and probed alone first next time
+btchipComm.READER_CACHE = os.path.join(tempfile.mkdtemp(), "reader")
+found = btchipComm.findSmartcardConnections()
+if [ str(reader) for reader, connection in found ] != [ "Fast" ] or btchipComm.loadReaderCache() != "Fast":
+	raise BTChipException("Reader not cached")
+other.probes = 0
+found = btchipComm.findSmartcardConnections()
+if [ str(reader) for reader, connection in found ] != [ "Fast" ] or other.probes != 0:
+	raise BTChipException("Cached reader not probed alone")
+fast.sw = 0x6a82
+readerList.append(slow)
+found = btchipComm.findSmartcardConnections()
+if [ str(reader) for reader, connection in found ] != [ "Slow" ] or btchipComm.loadReaderCache() != "Slow":
+	raise BTChipException("Reader cache not updated")
+os.unlink(btchipComm.READER_CACHE)
+os.rmdir(os.path.dirname(btchipComm.READER_CACHE))
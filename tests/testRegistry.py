@@ -0,0 +1,111 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+import btchip.btchipRegistry as btchipRegistry
+from btchip.btchipException import *
+import socket
+import time
+
+# Runs without a dongle or pyscard - fake PC/SC readers and a fake uevent socket
+
+class FakeCard(object):
+
+	def __init__(self, reader):
+		self.reader = reader
+
+class CountingRegistry(btchipRegistry.DeviceRegistry):
+
+	def __init__(self, *args, **kwargs):
+		self.refreshes = 0
+		btchipRegistry.DeviceRegistry.__init__(self, *args, **kwargs)
+
+	def refresh(self):
+		self.refreshes += 1
+		btchipRegistry.DeviceRegistry.refresh(self)
+
+def waitFor(condition, timeout=3.0):
+	deadline = time.time() + timeout
+	while not condition() and time.time() < deadline:
+		time.sleep(0.01)
+	return condition()
+
+class FakeConnection(object):
+
+	def disconnect(self):
+		pass
+
+cards = { "Reader A": True, "Reader B": False }
+probes = []
+def probeReaders(readerList, timeout=None):
+	probes.extend(readerList)
+	return [ (reader, FakeConnection()) for reader in readerList if cards[reader] ]
+
+btchipRegistry.SCARD = True
+btchipRegistry.CARD_MONITOR = False
+btchipRegistry.readers = lambda: sorted(cards.keys())
+btchipRegistry.probeReaders = probeReaders
+
+def getReaders(registry):
+	return [ descriptor['reader'] for descriptor in registry.getDescriptors() if descriptor['type'] == 'smartcard' ]
+
+# A reader known to hold a dongle is not probed again, until its card is reported removed
+registry = CountingRegistry(hotplug=False)
+if getReaders(registry) != [ "Reader A" ] or sorted(probes) != [ "Reader A", "Reader B" ]:
+	raise BTChipException("Invalid initial scan")
+del probes[:]
+registry.refresh()
+if probes != [ "Reader B" ]:
+	raise BTChipException("Known reader probed again")
+cards["Reader A"] = False
+btchipRegistry.ReaderCardObserver(registry).update(None, ([], [ FakeCard("Reader A") ]))
+if getReaders(registry) != []:
+	raise BTChipException("Removed card still listed")
+registry.refresh()
+if getReaders(registry) != []:
+	raise BTChipException("Removed card found again")
+cards["Reader B"] = True
+registry.cardsChanged([ "Reader B" ])
+registry.refresh()
+if getReaders(registry) != [ "Reader B" ]:
+	raise BTChipException("Inserted card not found")
+
+# Without uevents the watcher rescans every rescanInterval
+registry = CountingRegistry(rescanInterval=0.05, hotplug=False)
+registry.start()
+if not waitFor(lambda: registry.refreshes >= 4):
+	raise BTChipException("No periodic rescan")
+registry.stop()
+
+# With uevents the watcher only rescans when one arrives
+watcher, kernel = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+btchipRegistry.openHotplugSocket = lambda: watcher
+registry = CountingRegistry(rescanInterval=0.05)
+registry.start()
+time.sleep(0.6)
+if registry.refreshes != 1:
+	raise BTChipException("Rescanned without a uevent")
+kernel.send(b"add@/devices/usb1\x00ACTION=add\x00SUBSYSTEM=block\x00")
+time.sleep(0.6)
+if registry.refreshes != 1:
+	raise BTChipException("Rescanned on an unrelated uevent")
+kernel.send(b"add@/devices/usb1/hidraw0\x00ACTION=add\x00SUBSYSTEM=hidraw\x00")
+if not waitFor(lambda: registry.refreshes == 2):
+	raise BTChipException("No rescan on a hotplug uevent")
+registry.stop()
+kernel.close()
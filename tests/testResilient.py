@@ -0,0 +1,105 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchip import *
+from btchip.btchipBench import UTX
+from btchip.btchipEmulator import *
+from btchip.btchipObserver import *
+from btchip.btchipProxy import DongleProxyServer
+from btchip.btchipResilient import *
+from btchip.btchipUtils import *
+import socket
+
+# Runs without a dongle - an emulated dongle served by a local proxy, whose connections are
+# cut under a ResilientDongle
+
+class PinCounter(DongleObserver):
+
+	def __init__(self):
+		self.count = 0
+
+	def onExchange(self, event):
+		if event.command[0] == 0xe0 and event.ins == INS_VERIFY_PIN:
+			self.count += 1
+
+def disconnect(dongle):
+	dongle.dongle.socket.shutdown(socket.SHUT_RDWR)
+
+emulator = EmulatedDongle()
+pins = PinCounter()
+emulator.addObserver(pins)
+proxy = DongleProxyServer([ emulator ]).start()
+descriptor = { 'type': 'proxy', 'server': proxy.address[0], 'port': proxy.address[1], 'protocol': 1 }
+
+# Idempotent commands are sent again to the reopened device, the PIN is not replayed by default
+dongle = ResilientDongle(descriptor, backoff=0.01)
+app = btchip(dongle)
+app.verifyPin("1234")
+expected = app.getWalletPublicKey("0'/0/0")
+disconnect(dongle)
+if app.getWalletPublicKey("0'/0/0") != expected or dongle.retried != 1 or dongle.reopens != 1:
+	raise BTChipException("Idempotent command not retried")
+if pins.count != 1:
+	raise BTChipException("PIN replayed without replayPin")
+
+# A getTrustedInput stream cut in the middle is replayed from its header
+transaction = bitcoinTransaction(UTX)
+apdus = list(app.getTrustedInputApdus(transaction, 1))
+dongle.exchange(apdus[0])
+disconnect(dongle)
+for apdu in apdus[1:]:
+	response = dongle.exchange(apdu)
+if response[4:48] != app.getTrustedInput(transaction, 1)['value'][4:48] or dongle.retried != 2:
+	raise BTChipException("Trusted input stream not replayed")
+
+# Other multi-APDU operations fail fast, the next exchange reopens the device
+disconnect(dongle)
+try:
+	app.signMessagePrepare("0'/0/0", b"Message")
+	raise BTChipException("Transport failure not reported")
+except BTChipException as e:
+	if e.sw is not None or not e.message.startswith("Transport failure"):
+		raise
+app.getFirmwareVersion()
+if dongle.reopens != 3:
+	raise BTChipException("Device not reopened")
+dongle.close()
+
+# With replayPin the verified PIN is presented again, a refused replay is dropped
+dongle = ResilientDongle(descriptor, backoff=0.01, replayPin=True)
+app = btchip(dongle)
+app.verifyPin("1234")
+disconnect(dongle)
+app.getFirmwareVersion()
+if pins.count != 3:
+	raise BTChipException("PIN not replayed")
+emulator.pin = bytearray(b"0000")
+disconnect(dongle)
+try:
+	app.getFirmwareVersion()
+	raise BTChipException("Refused PIN replay not reported")
+except BTChipException as e:
+	if e.sw != 0x63c2:
+		raise
+disconnect(dongle)
+app.getFirmwareVersion()
+if pins.count != 4 or emulator.pinAttempts != 2:
+	raise BTChipException("Refused PIN replayed again")
+dongle.close()
+proxy.stop()
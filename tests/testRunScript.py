@@ -0,0 +1,79 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchipEmulator import *
+from btchip.btchipException import *
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "samples"))
+from runScript import parseScript, runScript
+
+# Runs without a dongle - parses an APDU script and replays it on the emulator
+
+path = os.path.join(tempfile.mkdtemp(), "script.txt")
+with open(path, "w") as scriptFile:
+	scriptFile.write("# Script\n")
+	scriptFile.write("[\n")
+	scriptFile.write("\"e0c4000000\",\n")
+	scriptFile.write("  e0 22 00 00 04 31 32 33 34\n")
+	scriptFile.write("!e0c0000008\n")
+	scriptFile.write("\n")
+	scriptFile.write("]\n")
+apdus = parseScript(path)
+expected = [
+	(bytearray([ 0xe0, 0xc4, 0x00, 0x00, 0x00 ]), False),
+	(bytearray([ 0xe0, 0x22, 0x00, 0x00, 0x04, 0x31, 0x32, 0x33, 0x34 ]), False),
+	(bytearray([ 0xe0, 0xc0, 0x00, 0x00, 0x08 ]), True)
+]
+if apdus != expected:
+	raise BTChipException("Invalid script %s" % apdus)
+
+# APDUs sent without waiting for the response are not timed
+dongle = EmulatedDongle()
+latencies = {}
+runScript(dongle, apdus, 3, latencies)
+if sorted(latencies.keys()) != [ 0x22, 0xc4 ] or len(latencies[0xc4]) != 3 or dongle.exchanges != 9:
+	raise BTChipException("Invalid latencies")
+# A slow device gets the response of a cancelled APDU late, the next APDU must not read it
+class SlowDongle(EmulatedDongle):
+
+	def __init__(self):
+		EmulatedDongle.__init__(self, latency=0.005)
+		self.late = None
+
+	def exchange(self, apdu, timeout=20000):
+		if self.late is not None:
+			response, self.late = self.late, None
+			return response
+		response = EmulatedDongle.exchange(self, apdu, timeout)
+		if timeout / 1000.0 < self.latency:
+			self.late = response
+			raise BTChipTransportException("Timeout")
+		return response
+
+	def resync(self, timeout=200):
+		self.late = None
+
+dongle = SlowDongle()
+runScript(dongle, [ apdus[2], apdus[0] ], 2, {})
+if dongle.exchanges != 4:
+	raise BTChipException("Late response read as the response of the next APDU")
+os.unlink(path)
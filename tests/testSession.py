@@ -0,0 +1,218 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchip import *
+from btchip.btchipBench import TRANSACTION, UTX
+from btchip.btchipBroker import DongleBrokerServer
+from btchip.btchipEmulator import *
+from btchip.btchipProxy import DongleProxyServer
+from btchip.btchipSession import *
+import os
+import tempfile
+import threading
+import time
+
+# Runs without a dongle - shares one btchip instance between threads
+
+app = btchip(EmulatedDongle(latency=0.001))
+order = []
+
+def operation(name, priority):
+	with app.session(priority) as lease:
+		app.getWalletPublicKey("0'/0/0")
+		app.getWalletPublicKey("0'/0/1")
+		order.append(name)
+	if lease.holdTime < 0.002:
+		raise BTChipException("Invalid hold time")
+
+# While a lease is held, queued interactive callers pass before batch callers queued earlier
+with app.session(PRIORITY_BATCH):
+	threads = []
+	for name, priority in [ ("batch1", PRIORITY_BATCH), ("batch2", PRIORITY_BATCH), ("interactive", PRIORITY_INTERACTIVE) ]:
+		thread = threading.Thread(target=operation, args=(name, priority))
+		thread.start()
+		threads.append(thread)
+		time.sleep(0.05)
+	if app.scheduler.getStatistics()[PRIORITY_BATCH]['queued'] != 2:
+		raise BTChipException("Invalid queue depth")
+for thread in threads:
+	thread.join()
+if order != [ "interactive", "batch1", "batch2" ]:
+	raise BTChipException("Invalid lease order %s" % order)
+
+statistics = app.scheduler.getStatistics()
+if statistics[PRIORITY_BATCH]['leases'] != 3 or statistics[PRIORITY_INTERACTIVE]['maxWaitTime'] < 0.05:
+	raise BTChipException("Invalid statistics")
+
+# Leases are reentrant for their thread
+with app.session() as outer:
+	with app.session() as inner:
+		if inner is not outer:
+			raise BTChipException("Nested lease not reused")
+
+# Deadlines and cancellation stop a multi-APDU operation between two APDUs
+class BudgetDongle(EmulatedDongle):
+
+	def __init__(self):
+		EmulatedDongle.__init__(self, latency=0.01)
+		self.timeouts = []
+		self.failNext = False
+		self.resyncs = 0
+
+	def exchange(self, apdu, timeout=20000):
+		self.timeouts.append(timeout)
+		if self.failNext:
+			self.failNext = False
+			raise BTChipTransportException("Timeout")
+		return EmulatedDongle.exchange(self, apdu, timeout)
+
+	def resync(self, timeout=200):
+		self.resyncs += 1
+
+dongle = BudgetDongle()
+app = btchip(dongle)
+app.verifyPin("1234")
+message = b"Long message " * 200
+dongle.timeouts = []
+try:
+	with app.session(deadline=Deadline(0.035)):
+		app.signMessagePrepare("0'/0/0", message)
+	raise BTChipException("Deadline not enforced")
+except BTChipTimeoutException as e:
+	if e.message != "Operation deadline exceeded" or e.sw is not None:
+		raise
+if len(dongle.timeouts) > 5 or dongle.timeouts[-1] > 35 or dongle.timeouts[0] < dongle.timeouts[-1]:
+	raise BTChipException("Invalid exchange timeouts %s" % dongle.timeouts)
+
+token = CancellationToken()
+token.cancel()
+try:
+	with app.session(deadline=Deadline(token=token)):
+		app.getWalletPublicKey("0'/0/0")
+	raise BTChipException("Cancellation not enforced")
+except BTChipCancelledException as e:
+	if e.message != "Operation cancelled" or e.sw is not None:
+		raise
+
+# Waiting too long for a device held by another owner is told apart from a device status
+lock = PriorityLock()
+lock.acquire("holder")
+try:
+	lock.acquire("waiter", PRIORITY_NORMAL, 0.05)
+	raise BTChipException("Lock wait not bounded")
+except BTChipTimeoutException as e:
+	if e.sw is not None:
+		raise
+lock.release("holder")
+
+# The next operation restarts from its first APDU, after a resync following a transport failure
+dongle.failNext = True
+try:
+	app.getWalletPublicKey("0'/0/0")
+except BTChipException as e:
+	if e.message != "Timeout":
+		raise
+app.signMessagePrepare("0'/0/0", b"Short message")
+app.signMessageSign()
+if dongle.resyncs != 1:
+	raise BTChipException("Dongle not resynchronized")
+
+# Status words leave the device in step and do not resync it
+try:
+	app.getTrustedInput(bitcoinTransaction(bytearray(64)), 0)
+except BTChipException as e:
+	if e.sw is None:
+		raise
+app.getFirmwareVersion()
+if dongle.resyncs != 1:
+	raise BTChipException("Dongle resynchronized after a status word")
+
+# finalizeInput falls back to the legacy encoding only when the device refuses the full one
+class FinalizeDongle(EmulatedDongle):
+
+	def __init__(self, error):
+		EmulatedDongle.__init__(self)
+		self.error = error
+		self.instructions = []
+
+	def exchange(self, apdu, timeout=20000):
+		self.instructions.append(apdu[1])
+		if apdu[1] == 0x4a:
+			raise self.error
+		return EmulatedDongle.exchange(self, apdu, timeout)
+
+def finalize(error):
+	dongle = FinalizeDongle(error)
+	app = btchip(dongle)
+	transaction = bitcoinTransaction(UTX)
+	trustedInput = app.getTrustedInput(transaction, 1)
+	app.startUntrustedTransaction(True, 0, [ trustedInput ], transaction.outputs[1].script)
+	try:
+		app.finalizeInput(b"", 0, 0, "0'/1/0", TRANSACTION)
+	except BTChipException as e:
+		if e is error:
+			raise
+	return dongle.instructions
+
+if 0x46 not in finalize(BTChipException("Invalid status 6d00", 0x6d00)):
+	raise BTChipException("No fallback on a refused full encoding")
+for error in [ BTChipTransportException("Timeout"), BTChipCancelledException("Operation cancelled") ]:
+	try:
+		finalize(error)
+		raise BTChipException("Fallback after %s" % error.message)
+	except BTChipException as e:
+		if e is not error:
+			raise
+
+# The deadline bounds the wait for a dongle held by another broker client, the broker
+# connection given up is opened again by the next operation
+directory = tempfile.mkdtemp()
+path = os.path.join(directory, "broker.sock")
+broker = DongleBrokerServer([ EmulatedDongle() ], path).start()
+holder = DongleBroker(path)
+shared = btchip(DongleBroker(path, timeout=1.0))
+with holder.session():
+	start = time.time()
+	try:
+		with shared.session(deadline=Deadline(0.2)):
+			shared.getFirmwareVersion()
+		raise BTChipException("Broker wait not bounded")
+	except BTChipException as e:
+		if e.message != "Timeout" or time.time() - start > 1.0:
+			raise
+shared.getFirmwareVersion()
+shared.dongle.close()
+holder.close()
+broker.stop()
+
+# Shared memory rings dropped by a transport failure are replaced by a resync
+proxy = DongleProxyServer([ EmulatedDongle() ], "unix:" + os.path.join(directory, "proxy.sock")).start()
+from btchip.btchipSharedMemory import DongleSharedMemory
+shared = btchip(DongleSharedMemory(proxy.address[0]))
+shared.dongle.close()
+try:
+	shared.getFirmwareVersion()
+	raise BTChipException("Closed rings used")
+except BTChipException as e:
+	if e.sw is not None:
+		raise
+shared.getFirmwareVersion()
+shared.dongle.close()
+proxy.stop()
+os.rmdir(directory)
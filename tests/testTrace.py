@@ -0,0 +1,172 @@
+"""
+*******************************************************************************
+*   BTChip Bitcoin Hardware Wallet Python API
+*   (c) 2014 BTChip - 1BTChip7VfTnrPra5jqci7ejnMguuHogTn
+*
+*  Licensed under the Apache License, Version 2.0 (the "License");
+*  you may not use this file except in compliance with the License.
+*  You may obtain a copy of the License at
+*
+*      http://www.apache.org/licenses/LICENSE-2.0
+*
+*   Unless required by applicable law or agreed to in writing, software
+*   distributed under the License is distributed on an "AS IS" BASIS,
+*   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+*  See the License for the specific language governing permissions and
+*   limitations under the License.
+********************************************************************************
+"""
+
+from btchip.btchip import *
+from btchip.btchipEmulator import *
+from btchip.btchipTrace import *
+import os
+import tempfile
+import threading
+
+# Runs without a dongle - records a session on the emulator and replays it
+
+path = os.path.join(tempfile.mkdtemp(), "session.trace")
+
+def session(dongle):
+	app = btchip(dongle)
+	app.verifyPin("1234")
+	result = [ app.getWalletPublicKey("0'/0/0")['publicKey'] ]
+	app.signMessagePrepare("0'/0/0", b"Message to sign " * 32)
+	result.append(app.signMessageSign(""))
+	try:
+		app.verifyPin("0000")
+	except BTChipException as e:
+		result.append(e.sw)
+	return result
+
+dongle = RecordingDongle(EmulatedDongle(), path)
+recorded = session(dongle)
+dongle.close()
+
+reader = TraceReader(path)
+records = list(reader)
+if len([ record for record in records if record.ins == 0x4e ]) < 2:
+	raise BTChipException("Invalid trace")
+if records[-1].sw != 0x63c2:
+	raise BTChipException("Status word not recorded")
+reader.close()
+
+dongle = ReplayDongle(path)
+if session(dongle) != recorded:
+	raise BTChipException("Invalid replay")
+dongle.close()
+
+# A command that does not match the trace is rejected
+dongle = ReplayDongle(path)
+try:
+	dongle.exchange(bytearray([ 0xe0, 0xc4, 0x00, 0x01, 0x00 ]))
+	raise BTChipException("Mismatching command accepted")
+except BTChipException as e:
+	if e.message != "Command does not match the trace":
+		raise
+dongle.close()
+
+# A truncated last record is ignored
+with open(path, "r+b") as traceFile:
+	traceFile.truncate(os.path.getsize(path) - 1)
+reader = TraceReader(path)
+if len(list(reader)) != len(records) - 1:
+	raise BTChipException("Truncated record returned")
+reader.close()
+
+# Any failure of the recorded dongle is recorded, and replayed as a transport failure. The
+# recorded dongle limits are kept
+class DisconnectingDongle(EmulatedDongle):
+
+	def exchange(self, apdu, timeout=20000):
+		if apdu[1] == 0xc0:
+			raise OSError("Device disconnected")
+		return EmulatedDongle.exchange(self, apdu, timeout)
+
+os.unlink(path)
+dongle = RecordingDongle(DisconnectingDongle(maxDataLength=2048), path)
+app = btchip(dongle)
+if app.maxDataLength != 2048:
+	raise BTChipException("Data length limit not delegated")
+try:
+	app.getRandom(8)
+	raise BTChipException("Failure not raised")
+except OSError:
+	pass
+dongle.close()
+reader = TraceReader(path)
+records = list(reader)
+if not records[-1].error or records[-1].response != bytearray(b"Device disconnected"):
+	raise BTChipException("Failure not recorded")
+dongle = ReplayDongle(path)
+failures = []
+for record in records:
+	try:
+		dongle.exchange(record.command)
+	except BTChipTransportException as e:
+		failures.append(e.message)
+	except BTChipException:
+		pass
+dongle.close()
+reader.close()
+if failures != [ "Device disconnected" ]:
+	raise BTChipException("Failure not replayed")
+
+# The trace buffer keeps the last exchanges, attaches them to exceptions and saves a replayable trace
+dongle = EmulatedDongle()
+traceBuffer = TraceBuffer(4)
+dongle.addObserver(traceBuffer)
+try:
+	session(dongle)
+except BTChipException:
+	pass
+entries = traceBuffer.getEntries()
+if len(entries) != 4 or entries[-1].sw != 0x63c2 or entries[-2].command[1] != 0x4e:
+	raise BTChipException("Invalid trace buffer")
+try:
+	btchip(dongle).verifyPin("0000")
+	raise BTChipException("Wrong PIN accepted")
+except BTChipException as e:
+	if e.trace is not None:
+		raise BTChipException("Trace attached to a status word")
+if "<= 63c2" not in formatTrace(entries):
+	raise BTChipException("Invalid trace format")
+traceBuffer.save(path)
+dongle = ReplayDongle(path)
+for entry in traceBuffer.getEntries():
+	try:
+		if dongle.exchange(entry.command) != entry.response:
+			raise BTChipException("Invalid saved trace")
+	except BTChipException as e:
+		if e.sw != entry.sw:
+			raise
+dongle.close()
+
+# Transport failures get the entries, concurrent exchanges keep the ring consistent
+class TimeoutDongle(EmulatedDongle):
+
+	def transmit(self, apdu, timeout=20000, event=None):
+		if apdu[1] == 0xc0:
+			raise BTChipTransportException("Timeout")
+		return EmulatedDongle.transmit(self, apdu, timeout, event)
+
+dongle = TimeoutDongle()
+traceBuffer = TraceBuffer(16)
+dongle.addObserver(traceBuffer)
+def exchanges():
+	for i in range(200):
+		dongle.exchange(bytearray([ 0xe0, 0xc4, 0x00, 0x00, 0x00 ]))
+threads = [ threading.Thread(target=exchanges) for i in range(4) ]
+for thread in threads:
+	thread.start()
+for thread in threads:
+	thread.join()
+if traceBuffer.written != 800 or len(traceBuffer.getEntries()) != 16:
+	raise BTChipException("Inconsistent trace buffer")
+try:
+	dongle.exchange(bytearray([ 0xe0, 0xc0, 0x00, 0x00, 0x08 ]))
+	raise BTChipException("Timeout not raised")
+except BTChipTransportException as e:
+	if e.trace is None or e.trace[-1].command[1] != 0xc0 or e.trace[-1].sw is not None:
+		raise BTChipException("Trace not attached to the transport failure")